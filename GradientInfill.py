@@ -18,20 +18,19 @@ Version: 1.0
 from ..Script import Script
 from UM.Logger import Logger
 from UM.Application import Application
-import re #To perform the search
+import importlib.util
+import json
+import os
+import sys
 from cura.Settings.ExtruderManager import ExtruderManager
-from collections import namedtuple
-from enum import Enum
-from typing import List, Tuple
 from UM.Message import Message
 from UM.i18n import i18nCatalog
 catalog = i18nCatalog("cura")
 
 __version__ = '1.5'
 
-
-Point2D = namedtuple('Point2D', 'x y')
-Segment = namedtuple('Segment', 'point1 point2')
+# module of the gradient algorithm shared with addGradientInfill.py, copied next to this script
+ENGINE_MODULE = "gradientInfillEngine"
 
 
 # MAX_FLOW = 350.0  # maximum extrusion flow
@@ -41,190 +40,30 @@ Segment = namedtuple('Segment', 'point1 point2')
 # gradient(segmentLength=gradientThickness / gradientDiscretization); use sensible values to not overload the printer
 
 
-class Infill(Enum):
-    """Enum for infill type."""
-
-    SMALL_SEGMENTS = 1  # infill with small segments like gyroid
-    LINEAR = 2  # linear infill like rectilinear or triangles
-
-class Section(Enum):
-    """Enum for section type."""
-
-    NOTHING = 0
-    INNER_WALL = 1
-    OUTER_WALL = 2
-    INFILL = 3
-
-
-def dist(segment: Segment, point: Point2D) -> float:
-    """Calculate the distance from a point to a line with finite length.
-
-    Args:
-        segment (Segment): line used for distance calculation
-        point (Point2D): point used for distance calculation
-
-    Returns:
-        float: distance between ``segment`` and ``point``
-    """
-    px = segment.point2.x - segment.point1.x
-    py = segment.point2.y - segment.point1.y
-    norm = px * px + py * py
-    u = ((point.x - segment.point1.x) * px + (point.y - segment.point1.y) * py) / float(norm)
-    if u > 1:
-        u = 1
-    elif u < 0:
-        u = 0
-    x = segment.point1.x + u * px
-    y = segment.point1.y + u * py
-    dx = x - point.x
-    dy = y - point.y
-
-    return (dx * dx + dy * dy) ** 0.5
-
-
-def get_points_distance(point1: Point2D, point2: Point2D) -> float:
-    """Calculate the euclidean distance between two points.
-
-    Args:
-        point1 (Point2D): first point
-        point2 (Point2D): second point
-
-    Returns:
-        float: euclidean distance between the points
-    """
-    return ((point1.x - point2.x) ** 2 + (point1.y - point2.y) ** 2) ** 0.5
-
-
-def min_distance_from_segment(segment: Segment, segments: List[Segment]) -> float:
-    """Calculate the minimum distance from the midpoint of ``segment`` to the nearest segment in ``segments``.
-
-    Args:
-        segment (Segment): segment to use for midpoint calculation
-        segments (List[Segment]): segments list
-
-    Returns:
-        float: the smallest distance from the midpoint of ``segment`` to the nearest segment in the list
-    """
-    middlePoint = Point2D((segment.point1.x + segment.point2.x) / 2, (segment.point1.y + segment.point2.y) / 2)
-
-    return min(dist(s, middlePoint) for s in segments)
-
-
-def getXY(currentLine: str) -> Point2D:
-    """Create a ``Point2D`` object from a gcode line.
+def load_engine():
+    """Import the gradient engine from the folder of this script.
 
-    Args:
-        currentLine (str): gcode line
+    Cura loads the post processing scripts by path, so their folder is not on the module search path. The engine
+    only needs the standard library and uses NumPy for faster distances when Cura bundles it.
 
     Raises:
-        SyntaxError: when the regular expressions cannot find the relevant coordinates in the gcode
-
-    Returns:
-        Point2D: the parsed coordinates
-    """
-    searchX = re.search(r"X(\d*\.?\d*)", currentLine)
-    searchY = re.search(r"Y(\d*\.?\d*)", currentLine)
-    if searchX and searchY:
-        elementX = searchX.group(1)
-        elementY = searchY.group(1)
-    else:
-        raise SyntaxError('Gcode file parsing error for line {currentLine}')
-
-    return Point2D(float(elementX), float(elementY))
-
-
-def mapRange(a: Tuple[float, float], b: Tuple[float, float], s: float) -> float:
-    """Calculate a multiplier for the extrusion value from the distance to the perimeter.
-
-    Args:
-        a (Tuple[float, float]): a tuple containing:
-            - a1 (float): the minimum distance to the perimeter (always zero at the moment)
-            - a2 (float): the maximum distance to the perimeter where the interpolation is performed
-        b (Tuple[float, float]): a tuple containing:
-            - b1 (float): the maximum flow as a fraction
-            - b2 (float): the minimum flow as a fraction
-        s (float): the euclidean distance from the middle of a segment to the nearest perimeter
-
-    Returns:
-        float: a multiplier for the modified extrusion value
-    """
-    (a1, a2), (b1, b2) = a, b
-
-    return b1 + ((s - a1) * (b2 - b1) / (a2 - a1))
-
-
-def get_extrusion_command(x: float, y: float, extrusion: float) -> str:
-    """Format a gcode string from the X, Y coordinates and extrusion value.
-
-    Args:
-        x (float): X coordinate
-        y (float): Y coordinate
-        extrusion (float): Extrusion value
-
-    Returns:
-        str: Gcode line
-    """
-    return "G1 X{} Y{} E{}".format(round(x, 3), round(y, 3), round(extrusion, 5))
-
-
-def is_begin_layer_line(line: str) -> bool:
-    """Check if current line is the start of a layer section.
-
-    Args:
-        line (str): Gcode line
-
-    Returns:
-        bool: True if the line is the start of a layer section
-    """
-    return line.startswith(";LAYER:")
-
-
-def is_begin_inner_wall_line(line: str) -> bool:
-    """Check if current line is the start of an inner wall section.
-
-    Args:
-        line (str): Gcode line
-
-    Returns:
-        bool: True if the line is the start of an inner wall section
-    """
-    return line.startswith(";TYPE:WALL-INNER")
-
-
-def is_begin_outer_wall_line(line: str) -> bool:
-    """Check if current line is the start of an outer wall section.
-
-    Args:
-        line (str): Gcode line
-
-    Returns:
-        bool: True if the line is the start of an outer wall section
-    """
-    return line.startswith(";TYPE:WALL-OUTER")
-
-
-def is_extrusion_line(line: str) -> bool:
-    """Check if current line is a standard printing segment.
-
-    Args:
-        line (str): Gcode line
-
-    Returns:
-        bool: True if the line is a standard printing segment
-    """
-    return "G1" in line and " X" in line and "Y" in line and "E" in line
-
-
-def is_begin_infill_segment_line(line: str) -> bool:
-    """Check if current line is the start of an infill.
-
-    Args:
-        line (str): Gcode line
+        FileNotFoundError: when gradientInfillEngine.py is not next to this script
 
     Returns:
-        bool: True if the line is the start of an infill section
+        module: the gradientInfillEngine module
     """
-    return line.startswith(";TYPE:FILL")
+    engine = sys.modules.get(ENGINE_MODULE)
+    if engine is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ENGINE_MODULE + ".py")
+        spec = importlib.util.spec_from_file_location(ENGINE_MODULE, path)
+        engine = importlib.util.module_from_spec(spec)
+        sys.modules[ENGINE_MODULE] = engine
+        try:
+            spec.loader.exec_module(engine)
+        except BaseException:
+            del sys.modules[ENGINE_MODULE]
+            raise
+    return engine
 
 
 def mfill_mode(Mode):
@@ -327,6 +166,39 @@ class GradientInfill(Script):
                     "value": "math.floor(maxflow)", 
                     "minimum_value": 100
                 },
+                "analyticlinear":
+                {
+                    "label": "Subdivide only in gradient",
+                    "description": "Only applicable for linear infills; calculate where the lines enter the gradient and only subdivide these parts, the rest of each line is printed with the minimum flow",
+                    "type": "bool",
+                    "default_value": false
+                },
+                "mergetolerance":
+                {
+                    "label": "Merge tolerance",
+                    "description": "Only applicable for linear infills; merge consecutive segments of a line whose flow, and speed, differ by less than this value. 0 to disable",
+                    "unit": "%",
+                    "type": "float",
+                    "default_value": 0.0,
+                    "minimum_value": 0.0,
+                    "maximum_value_warning": 20.0
+                },
+                "gradientprofile":
+                {
+                    "label": "Gradient profile",
+                    "description": "Shape of the flow between the walls and the gradient distance",
+                    "type": "enum",
+                    "options": {"linear": "Linear", "exponential": "Exponential", "smoothstep": "Smoothstep", "points": "Control points"},
+                    "default_value": "linear"
+                },
+                "profilepoints":
+                {
+                    "label": "Profile control points",
+                    "description": "Comma separated distance:position pairs, the distance as a fraction of the gradient distance and the position as a fraction of the way from max to min flow",
+                    "type": "str",
+                    "default_value": "0:0,0.3:0.8,1:1",
+                    "enabled": "gradientprofile == 'points'"
+                },
                 "gradualspeed":
                 {
                     "label": "Gradual speed",
@@ -387,12 +259,14 @@ class GradientInfill(Script):
         extruder_id  = self.getSettingValueByKey("extruder_nb")
         extruder_id = extruder_id -1
         gradual_speed= bool(self.getSettingValueByKey("gradualspeed"))
-        max_over_speed_factor = float(self.getSettingValueByKey("maxoverspeed"))
-        max_over_speed_factor = max_over_speed_factor /100
-        min_over_speed_factor = float(self.getSettingValueByKey("minoverspeed"))
-        min_over_speed_factor = min_over_speed_factor /100
+        max_over_speed = float(self.getSettingValueByKey("maxoverspeed"))
+        min_over_speed = float(self.getSettingValueByKey("minoverspeed"))
 
         test_outer_wall= bool(self.getSettingValueByKey("testouterwall"))
+        analytic_linear = bool(self.getSettingValueByKey("analyticlinear"))
+        merge_tolerance = float(self.getSettingValueByKey("mergetolerance"))
+        gradient_profile = self.getSettingValueByKey("gradientprofile")
+        profile_points = self.getSettingValueByKey("profilepoints")
         
 
         
@@ -427,8 +301,6 @@ class GradientInfill(Script):
             return None
         
         """Parse Gcode and modify infill portions with an extrusion width gradient."""
-        currentSection = Section.NOTHING
-        lastPosition = Point2D(-10000, -10000)
         gradientDiscretizationLength = gradient_thickness / gradient_discretization
 
         infill_type=mfill_mode(infillpattern)
@@ -445,168 +317,39 @@ class GradientInfill(Script):
             Message('Gcode must be generate without Connect Infill Lines mode activated' , title = catalog.i18nc("@info:title", "Post Processing")).show()
             return None      
 
+        try:
+            engine = load_engine()
+        except FileNotFoundError:
+            Logger.log('d', 'Gradient engine not found : ' + ENGINE_MODULE + '.py')
+            Message('Copy ' + ENGINE_MODULE + '.py into the same scripts folder as GradientInfill.py' , title = catalog.i18nc("@info:title", "Post Processing")).show()
+            return None
+
         Logger.log('d',  "GradientFill Param : " + str(gradientDiscretizationLength) + "/" + str(max_flow) + "/" + str(min_flow) + "/" + str(gradient_discretization)+ "/" + str(gradient_thickness) )
         Logger.log('d',  "Pattern Param : " + infillpattern + "/" + str(infill_type) )
 
-        for layer in data:
-            layer_index = data.index(layer)
-            lines = layer.split("\n")
-            for currentLine in lines:
-                new_Line=""
-                stringFeed = ""
-                line_index = lines.index(currentLine)
-                
-                if is_begin_layer_line(currentLine):
-                    perimeterSegments = []
-                    
-                if is_begin_inner_wall_line(currentLine):
-                    currentSection = Section.INNER_WALL
-                    # Logger.log('d', 'is_begin_inner_wall_line'  )
-
-                if is_begin_outer_wall_line(currentLine):
-                    currentSection = Section.OUTER_WALL
-                    # Logger.log('d', 'is_begin_outer_wall_line' )
-
-                if currentSection == Section.INNER_WALL and test_outer_wall == False:
-                    if is_extrusion_line(currentLine):
-                        perimeterSegments.append(Segment(getXY(currentLine), lastPosition))
-
-                if currentSection == Section.OUTER_WALL and test_outer_wall == True:
-                    if is_extrusion_line(currentLine):
-                        perimeterSegments.append(Segment(getXY(currentLine), lastPosition))
-
-                if is_begin_infill_segment_line(currentLine):
-                    # Log Size of perimeterSegments for debuging
-                    Logger.log('d', 'PerimeterSegments seg : {}'.format(len(perimeterSegments)))
-                    currentSection = Section.INFILL
-                    # ! Important 
-                    continue
-
-                if currentSection == Section.INFILL:
-                    if "F" in currentLine and "G1" in currentLine:
-                        searchSpeed = re.search(r"F(\d*\.?\d*)", currentLine)
-                        
-                        if searchSpeed:
-                            current_feed=float(searchSpeed.group(1))
-                            new_Line="G1 F{}\n".format(current_feed)
-                        else:
-                            Logger.log('d', 'Gcode file parsing error for line : ' + currentLine )
-
-                    if "E" in currentLine and "G1" in currentLine and "X" in currentLine and "Y" in currentLine:
-                        currentPosition = getXY(currentLine)
-                        splitLine = currentLine.split(" ")
-                        
-                        # if infill_type == Infill.LINEAR:  
-                        if infill_type == 2:
-                            # find extrusion length
-                            for element in splitLine:
-                                if "E" in element:
-                                    extrusionLength = float(element[1:])
-
-                            segmentLength = get_points_distance(lastPosition, currentPosition)
-                            segmentSteps = segmentLength / gradientDiscretizationLength
-                            extrusionLengthPerSegment = extrusionLength / segmentSteps
-                            segmentDirection = Point2D((currentPosition.x - lastPosition.x) / segmentLength * gradientDiscretizationLength,(currentPosition.y - lastPosition.y) / segmentLength * gradientDiscretizationLength)
- 
-                            if segmentSteps >= 2:
-                                # new_Line=new_Line+"; GradientInfill segmentSteps >= 2\n"
-                                for step in range(int(segmentSteps)):
-                                    segmentEnd = Point2D(lastPosition.x + segmentDirection.x, lastPosition.y + segmentDirection.y)
-                                    shortestDistance = min_distance_from_segment(Segment(lastPosition, segmentEnd), perimeterSegments)
-                                    if shortestDistance < gradient_thickness:
-                                        segmentExtrusion = extrusionLengthPerSegment * mapRange((0, gradient_thickness), (max_flow / 100, min_flow / 100), shortestDistance)
-                                        segmentFeed = current_feed / mapRange((0, gradient_thickness), (max_flow / 100, min_flow / 100), shortestDistance)
-    
-                                        if gradual_speed:
-                                            if segmentFeed > (current_feed * max_over_speed_factor):
-                                                segmentFeed = current_feed * max_over_speed_factor
-                                            if segmentFeed < (current_feed * min_over_speed_factor):
-                                                segmentFeed = current_feed * min_over_speed_factor
-                                            stringFeed = " F{}".format(int(segmentFeed))
-
-                                    else:
-                                        segmentExtrusion = extrusionLengthPerSegment * min_flow / 100
-                                        if min_flow>0:
-                                            segmentFeed = current_feed / (min_flow / 100)
-                                        else:
-                                            segmentFeed = current_feed * max_over_speed_factor
-                                            
-                                            
-                                        if gradual_speed:
-                                            if segmentFeed > (current_feed * max_over_speed_factor):
-                                                segmentFeed = current_feed * max_over_speed_factor
-                                            if segmentFeed < (current_feed * min_over_speed_factor):
-                                                segmentFeed = current_feed * min_over_speed_factor
-                                            stringFeed = " F{}".format(int(segmentFeed))
-
-                                    new_Line=new_Line + get_extrusion_command(segmentEnd.x, segmentEnd.y, segmentExtrusion) + stringFeed + "\n"
-                                    lastPosition = segmentEnd
-
-                                # MissingSegment
-                                segmentLengthRatio = get_points_distance(lastPosition, currentPosition) / segmentLength
-                                segmentFeed = current_feed / ( max_flow / 100 )
-                                if segmentFeed < (current_feed * min_over_speed_factor):
-                                    segmentFeed = current_feed * min_over_speed_factor
-                                if gradual_speed:
-                                    stringFeed = " F{}".format(int(segmentFeed))
-                    
-                                new_Line=new_Line+get_extrusion_command(currentPosition.x,currentPosition.y,segmentLengthRatio * extrusionLength * max_flow / 100) + stringFeed # + " ; Last line"
-                                
-                                lines[line_index] = new_Line
-                                
-                            else :
-                                outPutLine = ""
-                                # outPutLine = "; GradientInfill segmentSteps < 2\n"
-                               
-                                for element in splitLine:
-                                    if "E" in element:
-                                        outPutLine = outPutLine + "E" + str(round(extrusionLength * link_flow / 100, 5))
-                                    else:
-                                        outPutLine = outPutLine + element + " "
-                                outPutLine = outPutLine # + "\n"
-                                lines[line_index] = outPutLine
-                                
-                            # writtenToFile = 1
-                            
-                        # gyroid or honeycomb
-                        # if infill_type == Infill.SMALL_SEGMENTS:
-                        if infill_type == 1:
-                            shortestDistance = min_distance_from_segment(Segment(lastPosition, currentPosition), perimeterSegments)
-
-                            outPutLine = new_Line
-                            if shortestDistance < gradient_thickness:
-                                for element in splitLine:
-                                    if "E" in element:
-                                        newE = float(element[1:]) * mapRange((0, gradient_thickness), (max_flow / 100, min_flow / 100), shortestDistance)
-                                        segmentFeed = current_feed / mapRange((0, gradient_thickness), (max_flow / 100, min_flow / 100), shortestDistance)
-                                        if gradual_speed:
-                                            if segmentFeed > (current_feed * max_over_speed_factor):
-                                                segmentFeed = current_feed * max_over_speed_factor
-                                            if segmentFeed < (current_feed * min_over_speed_factor):
-                                                segmentFeed = current_feed * min_over_speed_factor
-                                            stringFeed = " F{}".format(int(segmentFeed))
-
-                                        outPutLine = outPutLine + "E" + str(round(newE, 5))
-                                        # test if F already define in line
-                                        if not " F" in outPutLine and gradual_speed:
-                                            outPutLine = outPutLine + stringFeed
-                                    else:
-                                        outPutLine = outPutLine + element + " "
-
-                                outPutLine = outPutLine # + "\n"
-                                lines[line_index] = outPutLine
-                    #
-                    # comment like ;MESH:NONMESH 
-                    #
-                    if ";" in currentLine:
-                        currentSection = Section.NOTHING
-                        lines[line_index] = currentLine # other Comment 
-                #
-                # line with move
-                #
-                if "X" in currentLine and "Y" in currentLine and ("G1" in currentLine or "G0" in currentLine):
-                    lastPosition = getXY(currentLine)
-
-            final_lines = "\n".join(lines)
-            data[layer_index] = final_lines
+        points = None
+        if gradient_profile == "points":
+            try:
+                points = engine.parse_profile_points(profile_points)
+            except ValueError as error:
+                Logger.log('d', 'Illegal profile control points : ' + str(error))
+                Message('Illegal profile control points : ' + str(error), title = catalog.i18nc("@info:title", "Post Processing")).show()
+                return None
+
+        # NumPy is optional, the engine falls back to pure Python distances without it
+        settings = engine.GradientSettings(
+            engine.InfillType(infill_type), max_flow, min_flow, gradient_thickness, gradient_discretization,
+            engine.Engine.NUMPY, None,
+            short_distance_flow=link_flow, gradual_speed=gradual_speed, max_over_speed=max_over_speed,
+            min_over_speed=min_over_speed, use_outer_wall=test_outer_wall, analytic_linear=analytic_linear,
+            merge_tolerance=merge_tolerance, gradient_profile=engine.GradientProfile[gradient_profile.upper()],
+            profile_points=points)
+        stats = engine.ProcessingStats()
+
+        # the engine works on lines ending with a newline, the last line of a layer may have none
+        layers = [layer if layer.endswith("\n") else layer + "\n" for layer in data]
+        for layer_index, outputLayer in enumerate(engine.transform_layers(layers, settings, stats=stats)):
+            data[layer_index] = outputLayer if data[layer_index].endswith("\n") else outputLayer[:-1]
+
+        Logger.log('d', 'GradientInfill stats : ' + json.dumps(stats.as_dict()))
         return data
@@ -6,24 +6,69 @@ License: MIT
 Author: Stefan Hermann - CNC Kitchen
 Version: 1.0
 """
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import queue
 import re
-from collections import namedtuple
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
 from enum import Enum
-from typing import List, Tuple
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import gradientInfillEngine
+from gradientInfillEngine import (  # noqa: F401 re-exported for the CLI and earlier users of this module
+    INITIAL_STATE,
+    MAX_BATCH_LINES,
+    DistanceField,
+    Engine,
+    FlowAnalysis,
+    GcodeMove,
+    GradientProcessor,
+    GradientProfile,
+    GradientSettings,
+    InfillBatch,
+    InfillType,
+    LayerCache,
+    LayerState,
+    LayerStats,
+    Marker,
+    NullOutput,
+    Point2D,
+    ProcessingStats,
+    Section,
+    Segment,
+    dist,
+    get_extrusion_command,
+    get_extrusion_commands,
+    get_points_distance,
+    getXY,
+    mapRange,
+    min_distance_from_segment,
+    numpy_min_distances,
+    parse_gcode_line,
+    parse_profile_points,
+    process_lines,
+    resolve_engine,
+    set_extrusion,
+    tokenize,
+    transform_layers,
+)
 
 __version__ = '1.0'
 
 
-class InfillType(Enum):
-    """Enum for infill type."""
-
-    SMALL_SEGMENTS = 1  # infill with small segments like honeycomb or gyroid
-    LINEAR = 2  # linear infill like rectilinear or triangles
-
-
-Point2D = namedtuple('Point2D', 'x y')
-Segment = namedtuple('Segment', 'point1 point2')
-
 # EDIT this section for your creation parameters
 
 INPUT_FILE_NAME = "cloverleaf_wHole_gyroid.gcode"
@@ -36,187 +81,837 @@ MIN_FLOW = 50.0  # minimum extrusion flow
 GRADIENT_THICKNESS = 6.0  # thickness of the gradient (max to min) in mm
 GRADIENT_DISCRETIZATION = 4.0  # only applicable for linear infills; number of segments within the
 # gradient(segmentLength=gradientThickness / gradientDiscretization); use sensible values to not overload the printer
+ENGINE = Engine.NUMPY  # falls back to Engine.PYTHON when NumPy is not installed
+FIELD_RESOLUTION = 0.1  # only applicable for Engine.DISTANCE_FIELD; pixel size of the wall distance field in mm
+SHORT_DISTANCE_FLOW = None  # only applicable for linear infills; flow of lines shorter than two gradient steps,
+# None uses MAX_FLOW
+GRADUAL_SPEED = False  # scale the feed rate of the infill inversely to its flow
+MAX_OVER_SPEED = 200.0  # only applicable with GRADUAL_SPEED; maximum feed rate in percent of the original feed rate
+MIN_OVER_SPEED = 60.0  # only applicable with GRADUAL_SPEED; minimum feed rate in percent of the original feed rate
+USE_OUTER_WALL = False  # measure the distance to the outer wall instead of the inner walls
+ANALYTIC_LINEAR = False  # only applicable for linear infills; subdivide only the parts of the lines inside the
+# gradient and print the rest of each line as one move with MIN_FLOW
+MERGE_TOLERANCE = 0.0  # only applicable for linear infills; merge consecutive segments of a line whose flows differ by
+# less than this many percent, and with GRADUAL_SPEED whose feed rates differ by less than this many percent; 0 is off
+GRADIENT_PROFILE = GradientProfile.LINEAR  # shape of the flow between the walls and GRADIENT_THICKNESS
+PROFILE_POINTS = None  # only applicable for GradientProfile.POINTS; (distance, position) control points as fractions of
+# GRADIENT_THICKNESS and of the way from MAX_FLOW to MIN_FLOW, e.g. ((0, 0), (0.3, 0.8), (1, 1))
 
 # End edit
 
 
-class Section(Enum):
-    """Enum for section type."""
-
-    NOTHING = 0
-    INNER_WALL = 1
-    INFILL = 2
-
-
-def dist(segment: Segment, point: Point2D) -> float:
-    """Calculate the distance from a point to a line with finite length.
+# Location and approximate size in bytes of the on-disk ``ResultCache`` of the CLI
+RESULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "GradientInfill")
+RESULT_CACHE_SIZE = 1024 * 1024 * 1024
+# Seconds between two scans of the input folder of ``watch_folder``
+POLL_INTERVAL = 0.1
+# Number of bytes read at once when hashing an input file
+HASH_BLOCK_SIZE = 1024 * 1024
+# Minimum number of lines handed to a worker process by ``process_lines_parallel``
+PARALLEL_CHUNK_LINES = 20000
+# Approximate number of bytes of gcode buffered by the streaming pipeline of ``process_gcode``
+STREAM_MEMORY_LIMIT = 64 * 1024 * 1024
+# Number of layer chunks queued between the threads of ``process_pipelined``
+PIPELINE_QUEUE_CHUNKS = 4
+# Number of queued output bytes written at once by ``BulkWriter``
+OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+# Maximum number of buffers of a single ``os.writev`` call
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+# Encoding of the gcode bytes decoded by ``process_mapped``
+GCODE_ENCODING = "utf-8"
+# Lines ending an inner or outer wall section, and lines a skipped section of ``process_mapped`` stops at
+WALL_END_MARKERS = {
+    Section.INNER_WALL: (b";TYPE:WALL-OUTER", b";TYPE:FILL"),
+    Section.OUTER_WALL: (b";TYPE:WALL-INNER", b";TYPE:FILL"),
+}
+SECTION_MARKERS = (b";LAYER:", b";TYPE:WALL-INNER", b";TYPE:FILL")
+OUTER_WALL_MARKER = b";TYPE:WALL-OUTER"
+# E parameter of a G0 or G1 move in undecoded gcode, for the extrusion of the sections skipped by ``map_gcode``
+MOVE_EXTRUSION = re.compile(rb"^G[01] [^;\n]* E([-+]?[0-9]*\.?[0-9]+)", re.MULTILINE)
+# Suffixes of the compressed gcode files read and written by ``open_gcode``, zstd requires the zstandard package
+COMPRESSION_SUFFIXES = (".gz", ".zst")
+# Number of uncompressed bytes passed at once to and from the compression thread, and blocks queued in between
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+COMPRESSION_QUEUE_BLOCKS = 8
+# gzip level of the written files, the level of the gzip command; higher levels are much slower for little gain
+GZIP_LEVEL = 6
+# Suffixes of the gcode files picked up by ``watch_folder`` and the batch mode of the CLI
+GCODE_SUFFIXES = (".gcode",) + tuple(".gcode" + suffix for suffix in COMPRESSION_SUFFIXES)
+
+
+def carry_state(lines: List[str], state: LayerState) -> LayerState:
+    """Calculate the state after ``lines`` without modifying them.
+
+    Only the section markers are followed forwards; the position and the feed are taken from the last moves that
+    set them.
 
     Args:
-        segment (Segment): line used for distance calculation
-        point (Point2D): point used for distance calculation
+        lines (List[str]): gcode lines
+        state (LayerState): state before the first line
 
     Returns:
-        float: distance between ``segment`` and ``point``
+        LayerState: the state ``process_lines`` returns for the same lines
     """
-    px = segment.point2.x - segment.point1.x
-    py = segment.point2.y - segment.point1.y
-    norm = px * px + py * py
-    u = ((point.x - segment.point1.x) * px + (point.y - segment.point1.y) * py) / float(norm)
-    if u > 1:
-        u = 1
-    elif u < 0:
-        u = 0
-    x = segment.point1.x + u * px
-    y = segment.point1.y + u * py
-    dx = x - point.x
-    dy = y - point.y
+    currentSection, lastPosition, currentFeed = state
+    for line in lines:
+        if ";" in line:
+            marker = parse_gcode_line(line).marker
+            if marker == Marker.INNER_WALL:
+                currentSection = Section.INNER_WALL
+            elif marker == Marker.OUTER_WALL:
+                currentSection = Section.OUTER_WALL
+            elif marker == Marker.INFILL:
+                currentSection = Section.INFILL
+            elif currentSection == Section.INFILL:
+                currentSection = Section.NOTHING
 
-    return (dx * dx + dy * dy) ** 0.5
+    lastPosition, currentFeed = find_last_moves(reversed(lines), lastPosition, currentFeed)
 
+    return LayerState(currentSection, lastPosition, currentFeed)
 
-def get_points_distance(point1: Point2D, point2: Point2D) -> float:
-    """Calculate the euclidean distance between two points.
+
+def find_last_moves(
+    reversedLines: Iterable[str], lastPosition: Point2D, currentFeed: Optional[float], find_feed: bool = True
+) -> Tuple[Point2D, Optional[float]]:
+    """Find the position and the G1 feed rate set last, reading the lines backwards.
 
     Args:
-        point1 (Point2D): first point
-        point2 (Point2D): second point
+        reversedLines (Iterable[str]): gcode lines, last line first
+        lastPosition (Point2D): position before the lines
+        currentFeed (Optional[float]): feed rate before the lines
+        find_feed (bool): False when only the position is searched, ``currentFeed`` is then returned unchanged
 
     Returns:
-        float: euclidean distance between the points
+        Tuple[Point2D, Optional[float]]: position and feed rate after the lines
     """
-    return ((point1.x - point2.x) ** 2 + (point1.y - point2.y) ** 2) ** 0.5
+    positionFound = False
+    feedFound = not find_feed
+    for line in reversedLines:
+        move = parse_gcode_line(line)
+        if not positionFound and move.command in ("G0", "G1") and move.x is not None and move.y is not None:
+            lastPosition = Point2D(move.x, move.y)
+            positionFound = True
+        if not feedFound and move.command == "G1" and move.f is not None:
+            currentFeed = move.f
+            feedFound = True
+        if positionFound and feedFound:
+            break
+
+    return lastPosition, currentFeed
 
 
-def min_distance_from_segment(segment: Segment, segments: List[Segment]) -> float:
-    """Calculate the minimum distance from the midpoint of ``segment`` to the nearest segment in ``segments``.
+def split_layers(lines: Iterable[str], min_lines: int = PARALLEL_CHUNK_LINES) -> Iterator[List[str]]:
+    """Group gcode lines into chunks that start at a layer boundary.
 
     Args:
-        segment (Segment): segment to use for midpoint calculation
-        segments (List[Segment]): segments list
+        lines (Iterable[str]): gcode lines
+        min_lines (int): minimum number of lines of a chunk; consecutive layers are grouped until it is reached
 
-    Returns:
-        float: the smallest distance from the midpoint of ``segment`` to the nearest segment in the list
+    Yields:
+        List[str]: chunk of whole layers, the first chunk also holds the lines before the first layer
     """
-    middlePoint = Point2D((segment.point1.x + segment.point2.x) / 2, (segment.point1.y + segment.point2.y) / 2)
+    chunk = []
+    for line in lines:
+        if len(chunk) >= min_lines and line.startswith(";LAYER:"):
+            yield chunk
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield chunk
+
+
+def process_chunk(
+    lines: List[str], settings: GradientSettings, state: LayerState
+) -> Tuple[str, ProcessingStats]:
+    """Run ``process_lines`` on a chunk of layers in a worker process and return the modified gcode and statistics."""
+    outputFile = io.StringIO()
+    stats = ProcessingStats()
+    process_lines(lines, outputFile, settings, state, stats)
+    return outputFile.getvalue(), stats
+
+
+def process_lines_parallel(
+    lines: Iterable[str],
+    outputFile: TextIO,
+    settings: GradientSettings,
+    jobs: int,
+    stats: Optional[ProcessingStats] = None,
+) -> None:
+    """Modify the infill portions of ``lines`` on ``jobs`` worker processes.
 
-    return min(dist(s, middlePoint) for s in segments)
+    The lines are split at layer boundaries. The state each chunk starts with is computed ahead with
+    ``carry_state``, so the chunks are processed concurrently and written back in order. At most two chunks per
+    worker are in flight to bound the memory use.
 
+    Args:
+        lines (Iterable[str]): gcode lines
+        outputFile (TextIO): file the modified lines are written to
+        settings (GradientSettings): gradient parameters
+        jobs (int): number of worker processes
+        stats (Optional[ProcessingStats]): statistics the work of all chunks is added to
+    """
+    state = INITIAL_STATE
+    pending = deque()
 
-def getXY(currentLine: str) -> Point2D:
-    """Create a ``Point2D`` object from a gcode line.
+    def write_result() -> None:
+        output, chunkStats = pending.popleft().result()
+        outputFile.write(output)
+        if stats is not None:
+            stats.merge(chunkStats)
 
-    Args:
-        currentLine (str): gcode line
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for chunk in split_layers(lines):
+            pending.append(executor.submit(process_chunk, chunk, settings, state))
+            state = carry_state(chunk, state)
+            if len(pending) >= 2 * jobs:
+                write_result()
+        while pending:
+            write_result()
 
-    Raises:
-        SyntaxError: when the regular expressions cannot find the relevant coordinates in the gcode
 
-    Returns:
-        Point2D: the parsed coordinates
+def read_gcode(input_file_name: str) -> Iterator[str]:
+    """Read stage of the streaming pipeline: yield the lines of a gcode file, compressed files are decompressed.
+
+    Args:
+        input_file_name (str): path of the gcode file
+
+    Yields:
+        str: gcode line
     """
-    searchX = re.search(r"X(\d*\.?\d*)", currentLine)
-    searchY = re.search(r"Y(\d*\.?\d*)", currentLine)
-    if searchX and searchY:
-        elementX = searchX.group(1)
-        elementY = searchY.group(1)
-    else:
-        raise SyntaxError(f'Gcode file parsing error for line {currentLine}')
+    with open_gcode(input_file_name) as gcodeFile:
+        yield from gcodeFile
 
-    return Point2D(float(elementX), float(elementY))
 
+def chunk_layers(lines: Iterable[str], max_chunk_size: int = STREAM_MEMORY_LIMIT // 2) -> Iterator[List[str]]:
+    """Layer chunker stage of the streaming pipeline: group lines by layer.
 
-def mapRange(a: Tuple[float, float], b: Tuple[float, float], s: float) -> float:
-    """Calculate a multiplier for the extrusion value from the distance to the perimeter.
+    A chunk ends before each ;LAYER: line. A layer longer than ``max_chunk_size`` characters is cut into several
+    chunks, ``GradientProcessor`` carries the walls and the infill section over the cut.
 
     Args:
-        a (Tuple[float, float]): a tuple containing:
-            - a1 (float): the minimum distance to the perimeter (always zero at the moment)
-            - a2 (float): the maximum distance to the perimeter where the interpolation is performed
-        b (Tuple[float, float]): a tuple containing:
-            - b1 (float): the maximum flow as a fraction
-            - b2 (float): the minimum flow as a fraction
-        s (float): the euclidean distance from the middle of a segment to the nearest perimeter
+        lines (Iterable[str]): gcode lines
+        max_chunk_size (int): maximum number of characters of a chunk
 
-    Returns:
-        float: a multiplier for the modified extrusion value
+    Yields:
+        List[str]: lines of a layer or of a part of a layer
     """
-    (a1, a2), (b1, b2) = a, b
+    chunk = []
+    size = 0
+    for line in lines:
+        if chunk and (size + len(line) > max_chunk_size or line.startswith(";LAYER:")):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield chunk
+
+
+def compression_of(file_name: str) -> str:
+    """Return the compression suffix of ``file_name``, one of ``COMPRESSION_SUFFIXES``, or "" for plain gcode."""
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_name.lower().endswith(suffix):
+            return suffix
+    return ""
 
-    return b1 + ((s - a1) * (b2 - b1) / (a2 - a1))
 
+def compressed_stream(rawFile: BinaryIO, compression: str, mode: str) -> BinaryIO:
+    """Wrap ``rawFile`` in a stream that decompresses its content, or compresses what is written to it.
 
-def get_extrusion_command(x: float, y: float, extrusion: float) -> str:
-    """Format a gcode string from the X, Y coordinates and extrusion value.
+    Written gzip streams hold neither a file name nor a time stamp, so the same gcode gives the same bytes.
 
     Args:
-        x (float): X coordinate
-        y (float): Y coordinate
-        extrusion (float): Extrusion value
+        rawFile (BinaryIO): binary file opened for reading or writing
+        compression (str): ".gz" or ".zst"
+        mode (str): "r" or "w"
+
+    Raises:
+        ImportError: for zstd when the zstandard package is not installed
 
     Returns:
-        str: Gcode line
+        BinaryIO: the decompressing or compressing stream
+    """
+    if compression == ".gz":
+        if mode == "r":
+            return gzip.GzipFile(filename="", mode="rb", fileobj=rawFile)
+        return gzip.GzipFile(filename="", mode="wb", compresslevel=GZIP_LEVEL, fileobj=rawFile, mtime=0)
+    if zstandard is None:
+        raise ImportError("Reading and writing zstd compressed gcode requires the zstandard package")
+    if mode == "r":
+        return zstandard.ZstdDecompressor().stream_reader(rawFile)
+    return zstandard.ZstdCompressor().stream_writer(rawFile)
+
+
+class BackgroundReader(io.RawIOBase):
+    """Raw stream of the decompressed content of a file, decompressed ahead on a background thread.
+
+    The thread stays at most ``COMPRESSION_QUEUE_BLOCKS`` blocks ahead of the reader. zlib and zstd release the GIL,
+    so the decompression overlaps with the processing of the lines read before.
     """
-    return "G1 X{} Y{} E{}\n".format(round(x, 3), round(y, 3), round(extrusion, 5))
 
+    def __init__(self, file_name: str):
+        """Start decompressing ``file_name``, compressed as told by its suffix."""
+        super().__init__()
+        self.blocks: "queue.Queue[Optional[bytes]]" = queue.Queue(COMPRESSION_QUEUE_BLOCKS)
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._decompress, args=(file_name,), daemon=True)
+        self.thread.start()
+
+    def _decompress(self, file_name: str) -> None:
+        """Queue the decompressed blocks of ``file_name``, followed by None."""
+        try:
+            with open(file_name, "rb") as rawFile, compressed_stream(rawFile, compression_of(file_name), "r") as data:
+                for block in iter(lambda: data.read(COMPRESSION_BLOCK_SIZE), b""):
+                    if not self._put(block):
+                        return
+        except BaseException as exception:  # raised in the reading thread
+            self.error = exception
+        self._put(None)
+
+    def _put(self, block: Optional[bytes]) -> bool:
+        """Queue ``block``, return False when the stream was closed in the meantime."""
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self) -> bool:
+        """The stream is readable."""
+        return True
+
+    def readinto(self, buffer) -> int:
+        """Copy the next decompressed bytes into ``buffer`` and return their number, 0 at the end of the file."""
+        if not self.pending:
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self.pending = memoryview(block)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self) -> None:
+        """Stop the thread, also when the file was not read to its end."""
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+        super().close()
+
+
+class BackgroundWriter(io.RawIOBase):
+    """Raw stream that compresses what is written to it into a file on a background thread.
+
+    At most ``COMPRESSION_QUEUE_BLOCKS`` blocks wait for the thread. Errors of the thread are raised by the next
+    ``write`` or by ``close``.
+    """
 
-def is_begin_layer_line(line: str) -> bool:
-    """Check if current line is the start of a layer section.
+    def __init__(self, file_name: str):
+        """Start a compressed ``file_name``, compressed as told by its suffix."""
+        super().__init__()
+        self.blocks: "queue.Queue[Optional[bytes]]" = queue.Queue(COMPRESSION_QUEUE_BLOCKS)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._compress, args=(file_name,), daemon=True)
+        self.thread.start()
+
+    def _compress(self, file_name: str) -> None:
+        """Compress the queued blocks into ``file_name`` until None is queued."""
+        try:
+            with open(file_name, "wb") as rawFile, compressed_stream(rawFile, compression_of(file_name), "w") as data:
+                for block in iter(self.blocks.get, None):
+                    data.write(block)
+        except BaseException as exception:  # raised in the writing thread
+            self.error = exception
+            # keep taking the blocks so that the writer is never blocked
+            for _ in iter(self.blocks.get, None):
+                pass
+
+    def writable(self) -> bool:
+        """The stream is writable."""
+        return True
+
+    def write(self, data) -> int:
+        """Queue a copy of ``data`` for the compression and return its size."""
+        if self.error is not None:
+            raise self.error
+        self.blocks.put(bytes(data))
+        return len(data)
+
+    def close(self) -> None:
+        """Wait until everything written is compressed and the file is closed."""
+        if not self.closed:
+            super().close()
+            self.blocks.put(None)
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+
+
+def open_gcode(file_name: str, mode: str = "r") -> TextIO:
+    """Open a gcode file as text for reading or writing.
+
+    Files ending with one of ``COMPRESSION_SUFFIXES`` are decompressed while they are read, or compressed while they
+    are written, on a background thread; other files are opened with ``open``.
 
     Args:
-        line (str): Gcode line
+        file_name (str): path of the gcode file
+        mode (str): "r" or "w"
 
     Returns:
-        bool: True if the line is the start of a layer section
+        TextIO: the opened file
     """
-    return line.startswith(";LAYER:")
+    if not compression_of(file_name):
+        return open(file_name, mode)
+    if mode == "r":
+        return io.TextIOWrapper(io.BufferedReader(BackgroundReader(file_name), COMPRESSION_BLOCK_SIZE))
+    return io.TextIOWrapper(io.BufferedWriter(BackgroundWriter(file_name), COMPRESSION_BLOCK_SIZE))
 
 
-def is_begin_inner_wall_line(line: str) -> bool:
-    """Check if current line is the start of an inner wall section.
+def write_gcode(chunks: Iterable[str], outputFile: TextIO) -> None:
+    """Writer stage of the streaming pipeline: write the modified gcode chunks in order.
 
     Args:
-        line (str): Gcode line
+        chunks (Iterable[str]): modified gcode
+        outputFile (TextIO): file the gcode is written to
+    """
+    for chunk in chunks:
+        outputFile.write(chunk)
 
-    Returns:
-        bool: True if the line is the start of an inner wall section
+
+class PipelineClosed(Exception):
+    """Raised by ``PipelineQueue.put`` when the consuming stage stopped."""
+
+
+class PipelineQueue:
+    """Bounded queue of chunks between two stages of ``process_pipelined`` that times the stalls of both sides.
+
+    A full queue blocks the producing stage, an empty queue the consuming stage; ``put_seconds`` and ``get_seconds``
+    add up the time they wait. An error of the producer is raised in the consumer once the chunks before it are
+    consumed.
     """
-    return line.startswith(";TYPE:WALL-INNER")
 
+    END = object()
+
+    def __init__(self, max_chunks: int = PIPELINE_QUEUE_CHUNKS):
+        """Create an empty queue holding at most ``max_chunks`` chunks."""
+        self.chunks: queue.Queue = queue.Queue(max_chunks)
+        self.closed = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.put_seconds = 0.0
+        self.get_seconds = 0.0
+
+    def put(self, chunk: object) -> None:
+        """Queue ``chunk``, waiting while the queue is full.
+
+        Raises:
+            PipelineClosed: when the consumer closed the queue
+        """
+        start = time.perf_counter()
+        while True:
+            if self.closed.is_set():
+                raise PipelineClosed()
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.put_seconds += time.perf_counter() - start
+
+    def produce(self, chunks: Iterable[object]) -> None:
+        """Queue all ``chunks`` followed by the end of the queue, or the error raised while iterating over them."""
+        try:
+            for chunk in chunks:
+                self.put(chunk)
+        except PipelineClosed:
+            return
+        except BaseException as exception:  # raised in the consuming stage
+            self.error = exception
+        try:
+            self.put(self.END)
+        except PipelineClosed:
+            pass
+
+    def __iter__(self) -> Iterator[object]:
+        """Yield the queued chunks until the end of the queue."""
+        while True:
+            start = time.perf_counter()
+            chunk = self.chunks.get()
+            self.get_seconds += time.perf_counter() - start
+            if chunk is self.END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield chunk
+
+    def close(self) -> None:
+        """Stop the producer, the chunks it queues from now on are dropped."""
+        self.closed.set()
+
+
+def process_pipelined(
+    input_file_name: str,
+    outputFile: TextIO,
+    settings: GradientSettings,
+    memory_limit: int = STREAM_MEMORY_LIMIT,
+    stats: Optional[ProcessingStats] = None,
+) -> None:
+    """Run the streaming pipeline with the reader and the writer on their own threads.
+
+    The stages of ``process_gcode`` are connected by two ``PipelineQueue`` queues of layer chunks: a reader thread
+    runs ``read_gcode`` and ``chunk_layers``, this thread runs ``transform_layers`` and a writer thread runs
+    ``write_gcode``, so reading and writing overlap with the computation. The chunks are smaller than in the
+    sequential pipeline, so that the queued chunks stay within ``memory_limit``. The time each stage waits for the
+    others is added to the ``*_stall_seconds`` counters of ``stats``.
+
+    Args:
+        input_file_name (str): path of the gcode file
+        outputFile (TextIO): file the modified lines are written to
+        settings (GradientSettings): gradient parameters
+        memory_limit (int): approximate number of bytes of gcode buffered between the stages
+        stats (Optional[ProcessingStats]): statistics the work is added to
+    """
+    stats = stats if stats is not None else ProcessingStats()
+    inputChunks = PipelineQueue()
+    outputChunks = PipelineQueue()
+    chunkSize = memory_limit // 2 // (PIPELINE_QUEUE_CHUNKS + 2)
+    reader = threading.Thread(
+        target=inputChunks.produce, args=(chunk_layers(read_gcode(input_file_name), chunkSize),), daemon=True
+    )
+    writerErrors: List[BaseException] = []
+
+    def write() -> None:
+        try:
+            write_gcode(outputChunks, outputFile)
+        except BaseException as exception:  # raised in this thread
+            writerErrors.append(exception)
+            outputChunks.close()
+
+    writer = threading.Thread(target=write, daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        outputChunks.produce(transform_layers(inputChunks, settings, max_batch_lines=memory_limit // 1024, stats=stats))
+    finally:
+        inputChunks.close()
+        reader.join()
+        writer.join()
+    stats.read_stall_seconds += inputChunks.put_seconds
+    stats.compute_stall_seconds += inputChunks.get_seconds + outputChunks.put_seconds
+    stats.write_stall_seconds += outputChunks.get_seconds
+    if writerErrors:
+        raise writerErrors[0]
+    if outputChunks.error is not None:
+        raise outputChunks.error
+
+
+class BulkWriter:
+    """Output buffer collecting bytes and zero-copy slices of the input that are written together.
+
+    The pieces are written with a single scatter-gather ``os.writev`` call where available, otherwise joined once.
+    """
 
-def is_end_inner_wall_line(line: str) -> bool:
-    """Check if current line is the start of an outer wall section.
+    def __init__(self, outputFile: BinaryIO, buffer_size: int = OUTPUT_BUFFER_SIZE):
+        """Start buffering.
+
+        Args:
+            outputFile (BinaryIO): unbuffered binary file the pieces are written to
+            buffer_size (int): number of queued bytes that triggers a write
+        """
+        self.outputFile = outputFile
+        self.buffer_size = buffer_size
+        self.pieces: List[Union[bytes, memoryview]] = []
+        self.size = 0
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        """Queue ``data``, the queue is written once it holds ``buffer_size`` bytes."""
+        if data:
+            self.pieces.append(data)
+            self.size += len(data)
+            if self.size >= self.buffer_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """Write all queued pieces."""
+        pieces = self.pieces
+        if hasattr(os, "writev"):
+            fileno = self.outputFile.fileno()
+            while pieces:
+                written = os.writev(fileno, pieces[:IOV_MAX])
+                while pieces and written >= len(pieces[0]):
+                    written -= len(pieces.pop(0))
+                if written:
+                    pieces[0] = memoryview(pieces[0])[written:]
+        elif pieces:
+            self.outputFile.write(b"".join(pieces))
+        self.pieces = []
+        self.size = 0
+
+
+def find_line_start(mapped: mmap.mmap, prefixes: Tuple[bytes, ...], start: int) -> int:
+    """Find the first line at or after the line starting at ``start`` that begins with one of ``prefixes``.
 
     Args:
-        line (str): Gcode line
+        mapped (mmap.mmap): mapped gcode
+        prefixes (Tuple[bytes, ...]): line prefixes to look for
+        start (int): offset of a line start
 
     Returns:
-        bool: True if the line is the start of an outer wall section
+        int: offset of the found line, or the size of ``mapped`` when there is none
     """
-    return line.startswith(";TYPE:WALL-OUTER")
+    found = len(mapped)
+    for prefix in prefixes:
+        if mapped[start:start + len(prefix)] == prefix:
+            return start
+        offset = mapped.find(b"\n" + prefix, start, found)
+        if offset >= 0:
+            found = offset + 1
+    return found
 
 
-def is_extrusion_line(line: str) -> bool:
-    """Check if current line is a standard printing segment.
+def find_line_end(mapped: mmap.mmap, offset: int) -> int:
+    """Return the offset after the newline that ends the line containing ``offset``."""
+    if offset >= len(mapped):
+        return len(mapped)
+    end = mapped.find(b"\n", offset)
+    return len(mapped) if end < 0 else end + 1
 
-    Args:
-        line (str): Gcode line
 
-    Returns:
-        bool: True if the line is a standard printing segment
+def decode_lines(data: bytes) -> List[str]:
+    """Decode gcode bytes into lines that keep their newline."""
+    return list(io.StringIO(data.decode(GCODE_ENCODING, "surrogateescape"), newline="\n"))
+
+
+def has_carriage_returns(input_file_name: str) -> bool:
+    """Check whether a gcode file holds carriage returns, the slices of ``process_mapped`` would keep them."""
+    with open(input_file_name, "rb") as gcodeFile:
+        if os.fstat(gcodeFile.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(gcodeFile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped.find(b"\r") >= 0
+
+
+def iter_lines_backwards(mapped: mmap.mmap, start: int, end: int) -> Iterator[str]:
+    """Yield the decoded lines between ``start`` and ``end``, last line first."""
+    while end > start:
+        lineStart = max(start, mapped.rfind(b"\n", start, end - 1) + 1)
+        yield mapped[lineStart:end].decode(GCODE_ENCODING, "surrogateescape")
+        end = lineStart
+
+
+def find_last_feed(mapped: mmap.mmap, start: int, end: int, currentFeed: Optional[float]) -> Optional[float]:
+    """Return the feed rate set last by a G1 move between ``start`` and ``end``, ``currentFeed`` when none sets one.
+
+    Only the lines holding an ``F`` are decoded, sections without a G1 feed rate are not parsed line by line.
     """
-    return "G1" in line and " X" in line and "Y" in line and "E" in line
+    while end > start:
+        offset = mapped.rfind(b"F", start, end)
+        if offset < 0:
+            break
+        lineStart = max(start, mapped.rfind(b"\n", start, offset) + 1)
+        line = mapped[lineStart:find_line_end(mapped, offset)].decode(GCODE_ENCODING, "surrogateescape")
+        move = parse_gcode_line(line)
+        if move.command == "G1" and move.f is not None:
+            return move.f
+        end = lineStart
+
+    return currentFeed
+
 
+def sum_extrusion(data: bytes) -> float:
+    """Add up the E parameters of the G0 and G1 moves of undecoded gcode bytes."""
+    return sum(float(match.group(1)) for match in MOVE_EXTRUSION.finditer(data))
 
-def is_begin_infill_segment_line(line: str) -> bool:
-    """Check if current line is the start of an infill.
+
+def map_gcode(gcodeFile: BinaryIO, processor: GradientProcessor, writer: Optional[BulkWriter] = None) -> None:
+    """Run ``processor`` over the memory-mapped ``gcodeFile``, decoding only its wall and infill sections.
+
+    Line and layer boundaries are found on the raw bytes. All sections except the infill are written to ``writer``
+    as zero-copy slices of the mapped input, the position and feed rate after a skipped section are read from its
+    last lines. Without a ``writer`` nothing is written, which is the dry run of ``analyze_gcode``: the extrusion of
+    the skipped sections is then added to the analysis of ``processor`` with ``sum_extrusion``.
 
     Args:
-        line (str): Gcode line
+        gcodeFile (BinaryIO): gcode file opened for binary reading
+        processor (GradientProcessor): state machine the wall and infill sections are fed to
+        writer (Optional[BulkWriter]): output of the modified gcode, None for a dry run
+    """
+    wallSection = processor.wallSection
+    sectionMarkers = SECTION_MARKERS + ((OUTER_WALL_MARKER,) if wallSection == Section.OUTER_WALL else ())
+    analysis = processor.analysis
+    discard = io.StringIO()
+    if os.fstat(gcodeFile.fileno()).st_size == 0:
+        return
+    with mmap.mmap(gcodeFile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        size = len(mapped)
+        position = 0
+        while position < size:
+            if processor.currentSection == Section.INFILL:
+                # the infill section ends with the first line holding a comment
+                comment = mapped.find(b";", position)
+                end = find_line_end(mapped, size if comment < 0 else comment)
+                infill = io.StringIO() if writer is not None else NullOutput()
+                processor.process(decode_lines(mapped[position:end]), infill)
+                if end == size:
+                    processor.finish(infill)
+                if writer is not None:
+                    writer.write(infill.getvalue().encode(GCODE_ENCODING, "surrogateescape"))
+            elif processor.currentSection == wallSection:
+                end = find_line_end(mapped, find_line_start(mapped, WALL_END_MARKERS[wallSection], position))
+                processor.process(decode_lines(mapped[position:end]), discard)
+                if writer is not None:
+                    writer.write(view[position:end])
+            else:
+                marker = find_line_start(mapped, sectionMarkers, position)
+                processor.lastPosition, _ = find_last_moves(
+                    iter_lines_backwards(mapped, position, marker), processor.lastPosition, None, find_feed=False
+                )
+                processor.currentFeed = find_last_feed(mapped, position, marker, processor.currentFeed)
+                if analysis is not None:
+                    analysis.extrusion += sum_extrusion(view[position:marker])
+                end = find_line_end(mapped, marker)
+                processor.process(decode_lines(mapped[marker:end]), discard)
+                if writer is not None:
+                    writer.write(view[position:end])
+            discard.seek(0)
+            discard.truncate()
+            position = end
+        # nothing is pending outside the infill, this records the statistics of the last layer
+        processor.finish(discard)
+        if writer is not None:
+            writer.flush()
+        view.release()
+
+
+def process_mapped(
+    input_file_name: str,
+    output_file_name: str,
+    settings: GradientSettings,
+    max_batch_lines: int = MAX_BATCH_LINES,
+    stats: Optional[ProcessingStats] = None,
+) -> None:
+    """Modify the infill portions of a memory-mapped gcode file.
 
-    Returns:
-        bool: True if the line is the start of an infill section
+    Only the wall and infill sections are decoded for ``GradientProcessor``; all sections except the infill are
+    written as zero-copy slices of the mapped input, see ``map_gcode``.
+
+    Args:
+        input_file_name (str): path of the gcode file
+        output_file_name (str): path of the modified gcode file
+        settings (GradientSettings): gradient parameters
+        max_batch_lines (int): maximum number of infill lines queued for a batched distance evaluation
+        stats (Optional[ProcessingStats]): statistics the work is added to
     """
-    return line.startswith(";TYPE:FILL")
+    processor = GradientProcessor(settings, max_batch_lines=max_batch_lines, stats=stats)
+    with open(input_file_name, "rb") as gcodeFile, open(output_file_name, "wb", buffering=0) as outputFile:
+        map_gcode(gcodeFile, processor, BulkWriter(outputFile))
+
+
+class ResultCache:
+    """On-disk cache of processed gcode files, addressed by the content of the input file and the settings.
+
+    Every entry is a copy of an output file named after the SHA-256 digest of its input file, the settings and the
+    source of this module and the engine, so changes to the code never return stale results. Hits refresh the
+    modification time of their entry and the least recently used entries are deleted once the entries exceed
+    ``max_size`` bytes.
+    """
+
+    def __init__(self, directory: str = RESULT_CACHE_DIR, max_size: int = RESULT_CACHE_SIZE):
+        """Open the cache, creating ``directory`` when needed.
+
+        Args:
+            directory (str): folder holding the entries
+            max_size (int): approximate number of bytes kept
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(input_file_name: str, settings: GradientSettings, compression: str = "") -> str:
+        """Hash the content of ``input_file_name``, the settings, the output compression and the source code."""
+        digest = hashlib.sha256()
+        with open(input_file_name, "rb") as inputFile:
+            for block in iter(lambda: inputFile.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        for sourceFileName in (__file__, gradientInfillEngine.__file__):
+            with open(sourceFileName, "rb") as sourceFile:
+                digest.update(sourceFile.read())
+        parameters = []
+        for name, value in settings._replace(engine=resolve_engine(settings.engine))._asdict().items():
+            if isinstance(value, Enum):
+                value = value.name
+            elif isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            parameters.append((name, value))
+        digest.update(repr(parameters).encode())
+        digest.update(compression.encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        """Path of the entry of ``key``."""
+        return os.path.join(self.directory, key + ".gcode")
+
+    def fetch(self, key: str, output_file_name: str) -> bool:
+        """Copy the entry of ``key`` to ``output_file_name``.
+
+        Returns:
+            bool: whether the entry existed
+        """
+        try:
+            shutil.copyfile(self.path(key), output_file_name)
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key: str, output_file_name: str) -> None:
+        """Copy ``output_file_name`` into the cache as the entry of ``key`` and evict old entries."""
+        if os.path.getsize(output_file_name) > self.max_size:
+            return
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(handle)
+        try:
+            shutil.copyfile(output_file_name, temporary)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used entries until the entries fit into ``max_size`` bytes."""
+        entries = []
+        with os.scandir(self.directory) as files:
+            for entry in files:
+                if entry.name.endswith(".gcode"):
+                    # other processes sharing the cache may delete entries at any time
+                    try:
+                        info = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for _, entrySize, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entrySize
 
 
 def process_gcode(
@@ -227,128 +922,351 @@ def process_gcode(
     min_flow: float,
     gradient_thickness: float,
     gradient_discretization: float,
+    engine: Engine = Engine.NUMPY,
+    jobs: int = 1,
+    memory_limit: int = STREAM_MEMORY_LIMIT,
+    use_mmap: bool = False,
+    field_resolution: float = FIELD_RESOLUTION,
+    short_distance_flow: Optional[float] = None,
+    gradual_speed: bool = False,
+    max_over_speed: float = MAX_OVER_SPEED,
+    min_over_speed: float = MIN_OVER_SPEED,
+    use_outer_wall: bool = False,
+    analytic_linear: bool = False,
+    merge_tolerance: float = MERGE_TOLERANCE,
+    gradient_profile: GradientProfile = GRADIENT_PROFILE,
+    profile_points: Optional[Tuple[Tuple[float, float], ...]] = PROFILE_POINTS,
+    result_cache: Optional[ResultCache] = None,
+    stats: Optional[ProcessingStats] = None,
+    pipelined: bool = False,
 ) -> None:
-    """Parse input Gcode file and modify infill portions with an extrusion width gradient."""
-    currentSection = Section.NOTHING
-    lastPosition = Point2D(-10000, -10000)
-    gradientDiscretizationLength = gradient_thickness / gradient_discretization
-
-    with open(input_file_name, "r") as gcodeFile, open(output_file_name, "w+") as outputFile:
-        for currentLine in gcodeFile:
-            writtenToFile = 0
-            if is_begin_layer_line(currentLine):
-                perimeterSegments = []
-
-            if is_begin_inner_wall_line(currentLine):
-                currentSection = Section.INNER_WALL
+    """Parse input Gcode file and modify infill portions with an extrusion width gradient.
+
+    The moves of each infill section are collected and their distances to the walls are evaluated in one batch by
+    ``engine``; ``Engine.NUMPY`` and ``Engine.DISTANCE_FIELD`` fall back to ``Engine.PYTHON`` when NumPy is not
+    installed, ``field_resolution`` is the pixel size of the distance field in mm. With ``jobs`` greater than 1 the
+    layers are processed on that many worker processes, 0 uses all CPU cores.
+
+    Linear infill lines shorter than two gradient steps are printed with ``short_distance_flow`` percent, by default
+    ``max_flow``. With ``gradual_speed`` the feed rate of the modified moves is scaled inversely to their flow,
+    between ``min_over_speed`` and ``max_over_speed`` percent of the original feed rate. ``use_outer_wall`` measures
+    the distances to the outer wall instead of the inner walls. With ``analytic_linear`` the parts of the linear
+    infill lines closer than ``gradient_thickness`` to a wall are calculated exactly and only they are subdivided,
+    the rest of each line is a single move with ``min_flow``. A ``merge_tolerance`` above 0 merges the consecutive
+    segments of a linear infill line whose flows, and feed rates, differ by less than that many percent; the number of
+    eliminated lines is counted in ``stats.lines_merged``. ``gradient_profile`` is the shape of the flow between the
+    walls and ``gradient_thickness``; profiles other than ``GradientProfile.LINEAR`` are compiled into a
+    ``ProfileTable``, ``GradientProfile.POINTS`` interpolates ``profile_points``.
+
+    The file is streamed through ``read_gcode``, ``chunk_layers``, ``transform_layers`` and ``write_gcode``.
+    ``memory_limit`` is the approximate number of bytes of gcode buffered between these stages: half of it for
+    the input chunk, the rest for the queued infill lines and their output. With ``use_mmap`` a sequential run maps
+    the input file instead and writes the sections outside the infill as slices of it, see ``process_mapped``. With
+    ``pipelined`` a sequential run reads and writes on separate threads instead, see ``process_pipelined``.
+
+    Files ending with .gz are read and written gzip compressed, files ending with .zst zstd compressed when the
+    zstandard package is installed; the compression runs on a background thread, see ``open_gcode``. ``use_mmap`` is
+    ignored for compressed files and for files with CRLF line endings, which only the streaming path converts to
+    newlines.
+
+    With a ``result_cache`` the output is copied from the cache when the same input file was processed with the same
+    settings before, otherwise it is stored there. The counters and timers of the run are added to ``stats``.
+    """
+    settings = GradientSettings(
+        infill_type,
+        max_flow,
+        min_flow,
+        gradient_thickness,
+        gradient_discretization,
+        engine,
+        field_resolution,
+        short_distance_flow,
+        gradual_speed,
+        max_over_speed,
+        min_over_speed,
+        use_outer_wall,
+        analytic_linear,
+        merge_tolerance,
+        gradient_profile,
+        profile_points,
+    )
+    if result_cache is not None:
+        key = result_cache.key(input_file_name, settings, compression_of(output_file_name))
+        if result_cache.fetch(key, output_file_name):
+            if stats is not None:
+                stats.result_cache_hits += 1
+            return
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    compressed = compression_of(input_file_name) or compression_of(output_file_name)
+    if use_mmap and jobs <= 1 and not pipelined and not compressed and not has_carriage_returns(input_file_name):
+        process_mapped(input_file_name, output_file_name, settings, memory_limit // 1024, stats)
+    else:
+        with open_gcode(output_file_name, "w") as outputFile:
+            if jobs > 1:
+                process_lines_parallel(read_gcode(input_file_name), outputFile, settings, jobs, stats)
+            elif pipelined:
+                process_pipelined(input_file_name, outputFile, settings, memory_limit, stats)
+            else:
+                chunks = chunk_layers(read_gcode(input_file_name), memory_limit // 2)
+                layers = transform_layers(chunks, settings, max_batch_lines=memory_limit // 1024, stats=stats)
+                write_gcode(layers, outputFile)
 
-            if currentSection == Section.INNER_WALL and is_extrusion_line(currentLine):
-                perimeterSegments.append(Segment(getXY(currentLine), lastPosition))
+    if result_cache is not None:
+        result_cache.store(key, output_file_name)
 
-            if is_end_inner_wall_line(currentLine):
-                currentSection = Section.NOTHING
 
-            if is_begin_infill_segment_line(currentLine):
-                currentSection = Section.INFILL
-                outputFile.write(currentLine)
-                continue
+# outcome of one file of ``process_batch``, ``error`` is None on success
+FileResult = namedtuple('FileResult', 'input_file_name output_file_name size lines seconds error')
+
+
+def process_file(input_file_name: str, output_file_name: str, options: dict) -> FileResult:
+    """Run ``process_gcode`` on one file of a batch and report failures instead of raising them.
+
+    Args:
+        input_file_name (str): path of the gcode file
+        output_file_name (str): path of the modified gcode file
+        options (dict): keyword arguments of ``process_gcode``
 
-            if currentSection == Section.INFILL:
-                if "F" in currentLine and "G1" in currentLine:
-                    # python3.6+ f-string variant:
-                    # outputFile.write("G1 F{ re.search(r"F(\d*\.?\d*)", currentLine).group(1)) }\n"
-                    searchSpeed = re.search(r"F(\d*\.?\d*)", currentLine)
-                    if searchSpeed:
-                        outputFile.write("G1 F{}\n".format(searchSpeed.group(1)))
-                    else:
-                        raise SyntaxError(f'Gcode file parsing error for line {currentLine}')
-                if "E" in currentLine and "G1" in currentLine and " X" in currentLine and "Y" in currentLine:
-                    currentPosition = getXY(currentLine)
-                    splitLine = currentLine.split(" ")
-
-                    if infill_type == InfillType.LINEAR:
-                        # find extrusion length
-                        for element in splitLine:
-                            if "E" in element:
-                                extrusionLength = float(element[1:])
-                        segmentLength = get_points_distance(lastPosition, currentPosition)
-                        segmentSteps = segmentLength / gradientDiscretizationLength
-                        extrusionLengthPerSegment = extrusionLength / segmentSteps
-                        segmentDirection = Point2D(
-                            (currentPosition.x - lastPosition.x) / segmentLength * gradientDiscretizationLength,
-                            (currentPosition.y - lastPosition.y) / segmentLength * gradientDiscretizationLength,
-                        )
-                        if segmentSteps >= 2:
-                            for step in range(int(segmentSteps)):
-                                segmentEnd = Point2D(
-                                    lastPosition.x + segmentDirection.x, lastPosition.y + segmentDirection.y
-                                )
-                                shortestDistance = min_distance_from_segment(
-                                    Segment(lastPosition, segmentEnd), perimeterSegments
-                                )
-                                if shortestDistance < gradient_thickness:
-                                    segmentExtrusion = extrusionLengthPerSegment * mapRange(
-                                        (0, gradient_thickness), (max_flow / 100, min_flow / 100), shortestDistance
-                                    )
-                                else:
-                                    segmentExtrusion = extrusionLengthPerSegment * min_flow / 100
-
-                                outputFile.write(get_extrusion_command(segmentEnd.x, segmentEnd.y, segmentExtrusion))
-
-                                lastPosition = segmentEnd
-                            # MissingSegment
-                            segmentLengthRatio = get_points_distance(lastPosition, currentPosition) / segmentLength
-
-                            outputFile.write(
-                                get_extrusion_command(
-                                    currentPosition.x,
-                                    currentPosition.y,
-                                    segmentLengthRatio * extrusionLength * max_flow / 100,
-                                )
-                            )
-                        else:
-                            outPutLine = ""
-                            for element in splitLine:
-                                if "E" in element:
-                                    outPutLine = outPutLine + "E" + str(round(extrusionLength * max_flow / 100, 5))
-                                else:
-                                    outPutLine = outPutLine + element + " "
-                            outPutLine = outPutLine + "\n"
-                            outputFile.write(outPutLine)
-                        writtenToFile = 1
-
-                    # gyroid or honeycomb
-                    if infill_type == InfillType.SMALL_SEGMENTS:
-                        shortestDistance = min_distance_from_segment(
-                            Segment(lastPosition, currentPosition), perimeterSegments
-                        )
-
-                        outPutLine = ""
-                        if shortestDistance < gradient_thickness:
-                            for element in splitLine:
-                                if "E" in element:
-                                    newE = float(element[1:]) * mapRange(
-                                        (0, gradient_thickness), (max_flow / 100, min_flow / 100), shortestDistance
-                                    )
-                                    outPutLine = outPutLine + "E" + str(round(newE, 5))
-                                else:
-                                    outPutLine = outPutLine + element + " "
-                            outPutLine = outPutLine + "\n"
-                            outputFile.write(outPutLine)
-                            writtenToFile = 1
-                if ";" in currentLine:
-                    currentSection = Section.NOTHING
-
-            # line with move
-            if " X" in currentLine and " Y" in currentLine and ("G1" in currentLine or "G0" in currentLine):
-                lastPosition = getXY(currentLine)
-
-            # write uneditedLine
-            if writtenToFile == 0:
-                outputFile.write(currentLine)
+    Returns:
+        FileResult: size, lines read, time and error of the file
+    """
+    stats = ProcessingStats()
+    start = time.perf_counter()
+    error = None
+    try:
+        process_gcode(input_file_name, output_file_name, stats=stats, **options)
+    except Exception as exception:  # a broken file must not stop the batch
+        error = "{}: {}".format(type(exception).__name__, str(exception).strip())
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+    size = os.path.getsize(input_file_name) if os.path.exists(input_file_name) else 0
+    return FileResult(input_file_name, output_file_name, size, stats.lines_read, time.perf_counter() - start, error)
+
+
+def process_batch(files: Sequence[Tuple[str, str]], jobs: int = 1, **options) -> Iterator[FileResult]:
+    """Process many gcode files on a pool of worker processes.
+
+    Every file is processed by a single worker, the results are yielded as soon as each file is done so a slow file
+    does not hold back the others.
+
+    Args:
+        files (Sequence[Tuple[str, str]]): pairs of input and output paths
+        jobs (int): number of worker processes, 0 uses all CPU cores
+        **options: keyword arguments of ``process_gcode`` like ``infill_type`` or ``max_flow``
+
+    Yields:
+        FileResult: outcome of each file in the order of completion
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(process_file, *paths, options): paths for paths in files}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as exception:  # e.g. a worker process that was killed
+                input_file_name, output_file_name = futures[future]
+                error = "{}: {}".format(type(exception).__name__, str(exception).strip())
+                yield FileResult(input_file_name, output_file_name, 0, 0, 0.0, error)
+
+
+# small layer run by every worker of ``watch_folder`` before the first file: a square wall and a few infill moves
+WARM_UP_GCODE = (
+    [";LAYER:0\n", "G0 X0 Y0\n", ";TYPE:WALL-INNER\n"]
+    + ["G1 X{} Y{} E0.1\n".format(x, y) for x, y in ((20, 0), (20, 20), (0, 20), (0, 0))]
+    + [";TYPE:FILL\n", "G1 F1800 E1\n"]
+    + ["G1 X{} Y{} E0.05\n".format(1 + i, 1 + i % 3) for i in range(18)]
+    + [";MESH:NONMESH\n"]
+)
+
+
+def settings_from_options(options: dict) -> GradientSettings:
+    """Return the gradient parameters of the keyword arguments ``options`` of ``process_gcode``."""
+    return GradientSettings(
+        options.get("infill_type", InfillType.SMALL_SEGMENTS),
+        options.get("max_flow", MAX_FLOW),
+        options.get("min_flow", MIN_FLOW),
+        options.get("gradient_thickness", GRADIENT_THICKNESS),
+        options.get("gradient_discretization", GRADIENT_DISCRETIZATION),
+        options.get("engine", Engine.NUMPY),
+        options.get("field_resolution", FIELD_RESOLUTION),
+        options.get("short_distance_flow"),
+        options.get("gradual_speed", False),
+        options.get("max_over_speed", MAX_OVER_SPEED),
+        options.get("min_over_speed", MIN_OVER_SPEED),
+        options.get("use_outer_wall", False),
+        options.get("analytic_linear", False),
+        options.get("merge_tolerance", MERGE_TOLERANCE),
+        options.get("gradient_profile", GRADIENT_PROFILE),
+        options.get("profile_points", PROFILE_POINTS),
+    )
+
+
+def warm_up(options: dict) -> None:
+    """Load and exercise the engine of ``options`` in a worker process, so the first file is not slowed down."""
+    process_lines(WARM_UP_GCODE, io.StringIO(), settings_from_options(options), INITIAL_STATE)
+
+
+def analyze_gcode(
+    input_file_name: str,
+    memory_limit: int = STREAM_MEMORY_LIMIT,
+    stats: Optional[ProcessingStats] = None,
+    **options,
+) -> FlowAnalysis:
+    """Dry run of ``process_gcode``: collect the flows and extrusion of the gradient without writing any gcode.
+
+    The distances are evaluated like in a normal run, but the infill moves are only recorded in the returned
+    ``FlowAnalysis`` instead of being formatted. An uncompressed file is mapped and only its wall and infill sections
+    are decoded, the extrusion of the other sections is read from the raw bytes, see ``map_gcode``.
+
+    Args:
+        input_file_name (str): path of the gcode file, compressed files are decompressed
+        memory_limit (int): approximate number of bytes of infill moves queued for a batched distance evaluation
+        stats (Optional[ProcessingStats]): statistics the work is added to
+        **options: keyword arguments of ``process_gcode`` like ``infill_type`` or ``max_flow``, the ones that only
+            concern the output like ``jobs`` or ``use_mmap`` are ignored
+
+    Returns:
+        FlowAnalysis: flow histograms and extrusion per layer
+    """
+    analysis = FlowAnalysis()
+    processor = GradientProcessor(
+        settings_from_options(options), max_batch_lines=memory_limit // 1024, stats=stats, analysis=analysis
+    )
+    if compression_of(input_file_name):
+        output = NullOutput()
+        processor.process(read_gcode(input_file_name), output)
+        processor.finish(output)
+    else:
+        with open(input_file_name, "rb") as gcodeFile:
+            map_gcode(gcodeFile, processor)
+    return analysis
+
+
+def file_has_version(path: str, version: Tuple[int, int]) -> bool:
+    """Check whether the file at ``path`` still has the size and modification time ``version``."""
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (info.st_size, info.st_mtime_ns) == version
+
+
+def watch_folder(
+    input_dir: str, output_dir: str, jobs: int = 1, poll_interval: float = POLL_INTERVAL, **options
+) -> Iterator[FileResult]:
+    """Process every gcode file dropped into ``input_dir`` on a pool of warm worker processes, until interrupted.
+
+    The workers are started and warmed up with ``warm_up`` before the folder is scanned. A file is queued once its
+    size and modification time did not change for ``poll_interval`` seconds, so files still being written are left
+    alone, and when it has no output yet that is newer than itself. A file is never queued while its previous job
+    is still running, a file that changed during its job is queued again once the job is done. Every job writes to
+    its own temporary file in ``output_dir`` that is renamed to the name of the input file once it is complete, so
+    other programs never see partial results.
+
+    Args:
+        input_dir (str): folder scanned for gcode files, plain or compressed, see ``GCODE_SUFFIXES``
+        output_dir (str): folder the results are moved to, must differ from ``input_dir``
+        jobs (int): number of worker processes, 0 uses all CPU cores
+        poll_interval (float): seconds between two scans of ``input_dir``
+        **options: keyword arguments of ``process_gcode`` like ``infill_type`` or ``max_flow``
+
+    Raises:
+        ValueError: when ``input_dir`` and ``output_dir`` are the same folder
+
+    Yields:
+        FileResult: outcome of each file in the order of completion
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.samefile(input_dir, output_dir):
+        raise ValueError("The output folder must differ from the watched folder")
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # the pool starts a new worker for each task submitted while none is idle
+        wait([executor.submit(warm_up, options) for _ in range(jobs)])
+        # size and modification time of each file, and when they were first seen
+        seen: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        # versions of the files in progress, and of failed files or files changed during their job, which are
+        # processed again once they change
+        queued: Dict[str, Tuple[int, int]] = {}
+        pending: Dict[Future, Tuple[str, str, str, Tuple[int, int]]] = {}
+        while True:
+            now = time.monotonic()
+            scan = {}
+            with os.scandir(input_dir) as files:
+                for entry in files:
+                    if entry.name.endswith(GCODE_SUFFIXES) and entry.is_file():
+                        info = entry.stat()
+                        version = (info.st_size, info.st_mtime_ns)
+                        previous = seen.get(entry.path)
+                        unchanged = previous is not None and previous[0] == version
+                        scan[entry.path] = previous if unchanged else (version, now)
+            seen = scan
+
+            running = {path for path, _, _, _ in pending.values()}
+            for path, (version, since) in seen.items():
+                if now - since < poll_interval or path in running or queued.get(path) == version:
+                    continue
+                outputPath = os.path.join(output_dir, os.path.basename(path))
+                # queued files failed or changed during their job, their output is missing or stale
+                upToDate = os.path.exists(outputPath) and os.stat(outputPath).st_mtime_ns >= version[1]
+                if path not in queued and upToDate:
+                    continue
+                queued[path] = version
+                # every job has its own temporary file, which keeps the suffix that tells the compression of the output
+                suffix = "." + os.path.basename(path)
+                handle, temporary = tempfile.mkstemp(dir=output_dir, prefix=".partial.", suffix=suffix)
+                os.close(handle)
+                future = executor.submit(process_file, path, temporary, options)
+                pending[future] = (path, outputPath, temporary, version)
+
+            if not pending:
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, outputPath, temporary, version = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as exception:  # e.g. a worker process that was killed
+                    error = "{}: {}".format(type(exception).__name__, str(exception).strip())
+                    result = FileResult(path, outputPath, 0, 0, 0.0, error)
+                if result.error is None:
+                    try:
+                        os.replace(temporary, outputPath)
+                        result = result._replace(output_file_name=outputPath)
+                    except OSError as exception:  # e.g. an output folder that was removed
+                        error = "{}: {}".format(type(exception).__name__, str(exception).strip())
+                        result = result._replace(output_file_name=outputPath, error=error)
+                if result.error is not None:
+                    if os.path.exists(temporary):
+                        os.remove(temporary)
+                elif file_has_version(path, version):
+                    del queued[path]
+                yield result
 
 
 if __name__ == '__main__':
     process_gcode(
-        INPUT_FILE_NAME, OUTPUT_FILE_NAME, INFILL_TYPE, MAX_FLOW, MIN_FLOW, GRADIENT_THICKNESS, GRADIENT_DISCRETIZATION
+        INPUT_FILE_NAME,
+        OUTPUT_FILE_NAME,
+        INFILL_TYPE,
+        MAX_FLOW,
+        MIN_FLOW,
+        GRADIENT_THICKNESS,
+        GRADIENT_DISCRETIZATION,
+        ENGINE,
+        short_distance_flow=SHORT_DISTANCE_FLOW,
+        gradual_speed=GRADUAL_SPEED,
+        max_over_speed=MAX_OVER_SPEED,
+        min_over_speed=MIN_OVER_SPEED,
+        use_outer_wall=USE_OUTER_WALL,
+        analytic_linear=ANALYTIC_LINEAR,
+        merge_tolerance=MERGE_TOLERANCE,
+        gradient_profile=GRADIENT_PROFILE,
+        profile_points=PROFILE_POINTS,
     )
@@ -9,8 +9,42 @@ Version: 1.0
 __version__ = 1.0
 
 import argparse
+import glob
+import json
 import os.path
-from addGradientInfill import process_gcode, InfillType, MIN_FLOW, MAX_FLOW, GRADIENT_THICKNESS, GRADIENT_DISCRETIZATION
+import sys
+import time
+from typing import List, Optional, Tuple
+from addGradientInfill import (
+    analyze_gcode,
+    process_batch,
+    process_gcode,
+    watch_folder,
+    ProcessingStats,
+    ResultCache,
+    Engine,
+    GradientProfile,
+    InfillType,
+    MIN_FLOW,
+    MAX_FLOW,
+    GRADIENT_THICKNESS,
+    GRADIENT_DISCRETIZATION,
+    ENGINE,
+    FIELD_RESOLUTION,
+    MAX_OVER_SPEED,
+    MIN_OVER_SPEED,
+    MERGE_TOLERANCE,
+    GRADIENT_PROFILE,
+    STREAM_MEMORY_LIMIT,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_SIZE,
+    POLL_INTERVAL,
+    GCODE_SUFFIXES,
+    compression_of,
+    parse_profile_points,
+)
+
+OUTPUT_SUFFIX = "_infill_gradient"
 
 SCRIPT_DESCRIPTION = (
     "This script allows adding gradient infill to a gcode file produced by Cura slicer.\n"
@@ -31,6 +65,24 @@ GRADIENT_DISCRETIZATION_HELP = (
     "overload the printer. Default {0}".format(GRADIENT_DISCRETIZATION)
 )
 
+ENGINE_HELP = (
+    "Engine used to calculate the distances to the walls.\n"
+    "Set 1 or \"PYTHON\" for the pure-Python engine.\n"
+    "Set 2 or \"NUMPY\" for vectorized batches, falls back to PYTHON when NumPy is not installed.\n"
+    "Set 3 or \"DISTANCE_FIELD\" for lookups in a rasterized distance field of the walls, accurate to about "
+    "--field_resolution, falls back to PYTHON when NumPy is not installed. "
+    "Default: {0}".format(ENGINE.name)
+)
+
+PROFILE_HELP = (
+    "Shape of the flow between the walls and the gradient thickness.\n"
+    "Set 1 or \"LINEAR\" for a straight ramp from --max_flow to --min_flow.\n"
+    "Set 2 or \"EXPONENTIAL\" for an exponential decay that drops quickly next to the walls.\n"
+    "Set 3 or \"SMOOTHSTEP\" for a cubic ease in and out.\n"
+    "Set 4 or \"POINTS\" to interpolate the control points of --profile_points. "
+    "Default: {0}".format(GRADIENT_PROFILE.name)
+)
+
 
 def arg_to_infill_type(arg: str) -> InfillType:
     """Check that the user-provided infill type is valid and return the corresponding Enum value.
@@ -50,17 +102,207 @@ def arg_to_infill_type(arg: str) -> InfillType:
     raise argparse.ArgumentTypeError("Illegal infill type: ", arg)
 
 
+def arg_to_engine(arg: str) -> Engine:
+    """Check that the user-provided engine is valid and return the corresponding Enum value.
+
+    Args:
+        arg (str): user-provided command-line argument
+
+    Raises:
+        argparse.ArgumentTypeError: when an illegal value is passed
+
+    Returns:
+        Engine: a valid engine
+    """
+    for engine in Engine:
+        if arg.upper() in (engine.name, str(engine.value)):
+            return engine
+    raise argparse.ArgumentTypeError("Illegal engine: ", arg)
+
+
+def arg_to_gradient_profile(arg: str) -> GradientProfile:
+    """Check that the user-provided gradient profile is valid and return the corresponding Enum value.
+
+    Args:
+        arg (str): user-provided command-line argument
+
+    Raises:
+        argparse.ArgumentTypeError: when an illegal value is passed
+
+    Returns:
+        GradientProfile: a valid gradient profile
+    """
+    for profile in GradientProfile:
+        if arg.upper() in (profile.name, str(profile.value)):
+            return profile
+    raise argparse.ArgumentTypeError("Illegal gradient profile: ", arg)
+
+
+def arg_to_profile_points(arg: str) -> Tuple[Tuple[float, float], ...]:
+    """Check that the user-provided control points are valid and return them as pairs.
+
+    Args:
+        arg (str): user-provided command-line argument like "0:0,0.3:0.8,1:1"
+
+    Raises:
+        argparse.ArgumentTypeError: when an illegal value is passed
+
+    Returns:
+        Tuple[Tuple[float, float], ...]: control points sorted by distance
+    """
+    try:
+        return parse_profile_points(arg)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError("Illegal profile points: {0}".format(error))
+
+
+def default_output_path(input_path: str, output_dir: Optional[str] = None) -> str:
+    """Name the output file after the input file, in ``output_dir`` when given, compressed like the input file.
+
+    Args:
+        input_path (str): path of the input gcode file
+        output_dir (Optional[str]): folder of the output file, defaults to the folder of the input file
+
+    Returns:
+        str: path of the output gcode file
+    """
+    compression = compression_of(input_path)
+    head, ext = os.path.splitext(input_path[:len(input_path) - len(compression)])
+    if ext == "":
+        ext = ".gcode"
+    if output_dir is not None:
+        head = os.path.join(output_dir, os.path.basename(head))
+    return "{0}{1}{2}{3}".format(head, OUTPUT_SUFFIX, ext, compression)
+
+
+def find_batch_inputs(patterns: List[str]) -> List[str]:
+    """List the gcode files of a batch, skipping outputs of earlier runs.
+
+    Args:
+        patterns (List[str]): folders, whose ``*.gcode`` files are used, also when compressed, files or glob patterns
+
+    Returns:
+        List[str]: sorted paths of the input files
+    """
+    paths = set()
+    for pattern in patterns:
+        folderPatterns = [pattern]
+        if os.path.isdir(pattern):
+            folderPatterns = [os.path.join(pattern, "*" + suffix) for suffix in GCODE_SUFFIXES]
+        for folderPattern in folderPatterns:
+            paths.update(glob.glob(folderPattern, recursive=True))
+    return sorted(
+        path
+        for path in paths
+        if os.path.isfile(path)
+        and not os.path.splitext(path[:len(path) - len(compression_of(path))])[0].endswith(OUTPUT_SUFFIX)
+    )
+
+
+def run_batch(
+    inputs: List[str], output_dir: Optional[str], jobs: int, stats_path: Optional[str], **options
+) -> bool:
+    """Process ``inputs`` with ``process_batch``, print the progress and a summary of the timings.
+
+    Args:
+        inputs (List[str]): paths of the input gcode files
+        output_dir (Optional[str]): folder of the output files, None writes them next to the input files
+        jobs (int): number of worker processes, 0 uses all CPU cores
+        stats_path (Optional[str]): file the results are written to as JSON, "-" for the console, None for no JSON
+        **options: keyword arguments of ``process_gcode``
+
+    Returns:
+        bool: whether all files were processed successfully
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    files = [(path, default_output_path(path, output_dir)) for path in inputs]
+    start = time.perf_counter()
+    results = []
+    for result in process_batch(files, jobs, **options):
+        results.append(result)
+        if result.error is None:
+            print("[{0}/{1}] {2} -> {3} in {4:.2f} s".format(
+                len(results), len(files), result.input_file_name, result.output_file_name, result.seconds
+            ), flush=True)
+        else:
+            print("[{0}/{1}] FAILED {2}: {3}".format(
+                len(results), len(files), result.input_file_name, result.error
+            ), flush=True)
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if result.error is not None]
+    size = sum(result.size for result in results)
+    lines = sum(result.lines for result in results)
+    print("\n{0} files processed, {1} failed in {2:.2f} s: {3:.1f} MB/s, {4:.0f} lines/s".format(
+        len(results) - len(failed), len(failed), elapsed, size / (1024 * 1024) / max(elapsed, 1e-9),
+        lines / max(elapsed, 1e-9)
+    ))
+    print("{0:>10}  {1}".format("seconds", "file"))
+    for result in sorted(results, key=lambda result: result.seconds, reverse=True):
+        print("{0:>10.2f}  {1}{2}".format(result.seconds, result.input_file_name, "  FAILED" if result.error else ""))
+
+    if stats_path is not None:
+        report = {
+            "files": len(results),
+            "failed": len(failed),
+            "total_seconds": elapsed,
+            "bytes": size,
+            "lines_read": lines,
+            "results": [result._asdict() for result in results],
+        }
+        if stats_path == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(stats_path, "w") as statsFile:
+                json.dump(report, statsFile, indent=2)
+    return not failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="GradientInfillCLI", description=SCRIPT_DESCRIPTION)
-    parser.add_argument(
-        "-i", "--input", type=argparse.FileType('r'), required=True, help="Path to the input gcode file"
+    inputGroup = parser.add_mutually_exclusive_group(required=True)
+    inputGroup.add_argument(
+        "-i",
+        "--input",
+        type=argparse.FileType('r'),
+        help="Path to the input gcode file, .gz files are read gzip compressed and .zst files zstd compressed",
+    )
+    inputGroup.add_argument(
+        "--batch",
+        nargs="+",
+        metavar="DIR_OR_GLOB",
+        help="process all *.gcode files of the folders, also when compressed as .gcode.gz or .gcode.zst, or the files "
+        "matching the glob patterns, with --jobs worker processes; outputs of earlier runs are skipped",
+    )
+    inputGroup.add_argument(
+        "--watch",
+        metavar="DIR",
+        help="keep running and process every gcode file dropped into DIR on --jobs warm worker processes, the "
+        "results are moved to --output_dir",
     )
     parser.add_argument(
         "-o",
         "--output",
         type=argparse.FileType('w+'),
         required=False,
-        help="Path to the output gcode file to be created",
+        help="Path to the output gcode file to be created, .gz files are written gzip compressed and .zst files zstd "
+        "compressed, default next to the input file and compressed like it",
+    )
+    parser.add_argument(
+        "--output_dir",
+        help="only applicable for --batch and --watch; folder of the output files, default next to the inputs for "
+        "--batch",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        required=False,
+        default=POLL_INTERVAL,
+        help="only applicable for --watch; seconds between two scans of the watched folder, default {0}".format(
+            POLL_INTERVAL
+        ),
     )
     parser.add_argument(
         "--infill_type",
@@ -93,18 +335,244 @@ if __name__ == "__main__":
     parser.add_argument(
         "--discretization", type=int, required=False, default=GRADIENT_DISCRETIZATION, help=GRADIENT_DISCRETIZATION_HELP
     )
+    parser.add_argument("--engine", type=arg_to_engine, required=False, help=ENGINE_HELP, default=ENGINE.name)
+    parser.add_argument(
+        "--field_resolution",
+        type=float,
+        required=False,
+        default=FIELD_RESOLUTION,
+        help="only applicable for the DISTANCE_FIELD engine; pixel size of the distance field in mm, "
+        "default {0}".format(FIELD_RESOLUTION),
+    )
+    parser.add_argument(
+        "--short_distance_flow",
+        type=int,
+        required=False,
+        help="only applicable for linear infills; extrusion flow of lines shorter than two gradient steps, default "
+        "the maximum flow",
+    )
+    parser.add_argument(
+        "--gradual_speed",
+        action="store_true",
+        help="scale the feed rate of the modified infill moves inversely to their flow",
+    )
+    parser.add_argument(
+        "--max_over_speed",
+        type=int,
+        required=False,
+        default=MAX_OVER_SPEED,
+        help="only applicable with --gradual_speed; maximum feed rate in percent of the original feed rate, "
+        "default {0}".format(MAX_OVER_SPEED),
+    )
+    parser.add_argument(
+        "--min_over_speed",
+        type=int,
+        required=False,
+        default=MIN_OVER_SPEED,
+        help="only applicable with --gradual_speed; minimum feed rate in percent of the original feed rate, "
+        "default {0}".format(MIN_OVER_SPEED),
+    )
+    parser.add_argument(
+        "--outer_wall",
+        action="store_true",
+        help="measure the distances to the outer wall instead of the inner walls",
+    )
+    parser.add_argument(
+        "--analytic_linear",
+        action="store_true",
+        help="only applicable for linear infills; calculate where the lines enter the gradient and only subdivide "
+        "these parts, the rest of each line is printed as one move with the minimum flow",
+    )
+    parser.add_argument(
+        "--merge_tolerance",
+        type=float,
+        required=False,
+        default=MERGE_TOLERANCE,
+        help="only applicable for linear infills; merge consecutive segments of a line whose flows, and with "
+        "--gradual_speed whose feed rates, differ by less than this many percent, the number of eliminated lines is "
+        "reported by --stats as lines_merged, default {0} (off)".format(MERGE_TOLERANCE),
+    )
+    parser.add_argument(
+        "--gradient_profile",
+        type=arg_to_gradient_profile,
+        required=False,
+        help=PROFILE_HELP,
+        default=GRADIENT_PROFILE.name,
+    )
+    parser.add_argument(
+        "--profile_points",
+        type=arg_to_profile_points,
+        required=False,
+        metavar="D:P,...",
+        help="only applicable for --gradient_profile POINTS; comma separated distance:position control points, the "
+        "distance as a fraction of the gradient thickness and the position as a fraction of the way from --max_flow "
+        "to --min_flow, e.g. 0:0,0.3:0.8,1:1",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        required=False,
+        default=1,
+        help="number of worker processes the layers are split across, or with --batch the number of files "
+        "processed at once, 0 uses all CPU cores, default 1",
+    )
+    parser.add_argument(
+        "--memory_limit",
+        type=int,
+        required=False,
+        default=STREAM_MEMORY_LIMIT // (1024 * 1024),
+        help="approximate MB of gcode buffered while streaming the file, default {0}".format(
+            STREAM_MEMORY_LIMIT // (1024 * 1024)
+        ),
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="memory-map the input file and copy the sections outside the infill without decoding them",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="read and write the gcode on separate threads while the gradient is computed; the time each stage waits "
+        "for the others is reported by --stats",
+    )
+    parser.add_argument(
+        "--no-cache",
+        "--no_cache",
+        dest="no_cache",
+        action="store_true",
+        help="always process the input file instead of reusing a result cached in {0}".format(RESULT_CACHE_DIR),
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        required=False,
+        default=RESULT_CACHE_SIZE // (1024 * 1024),
+        help="MB of results kept in the cache, the least recently used ones are deleted first, default {0}".format(
+            RESULT_CACHE_SIZE // (1024 * 1024)
+        ),
+    )
+    parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="write the counters and timers of the run, or with --batch the per-file results, as JSON to FILE, or to "
+        "the console when FILE is omitted",
+    )
+    parser.add_argument(
+        "--analyze",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="dry run: write the flow histogram and the extra extrusion of the gradient per layer as JSON to FILE, or "
+        "to the console when FILE is omitted, instead of the modified gcode",
+    )
     args = parser.parse_args()
+    if args.gradient_profile == GradientProfile.POINTS and args.profile_points is None:
+        parser.error("--gradient_profile POINTS requires --profile_points")
+
+    result_cache = None if args.no_cache else ResultCache(RESULT_CACHE_DIR, args.cache_size * 1024 * 1024)
+
+    options = dict(
+        infill_type=args.infill_type,
+        max_flow=args.max_flow,
+        min_flow=args.min_flow,
+        gradient_thickness=args.thickness,
+        gradient_discretization=args.discretization,
+        engine=args.engine,
+        memory_limit=args.memory_limit * 1024 * 1024,
+        use_mmap=args.mmap,
+        pipelined=args.pipelined,
+        field_resolution=args.field_resolution,
+        short_distance_flow=args.short_distance_flow,
+        gradual_speed=args.gradual_speed,
+        max_over_speed=args.max_over_speed,
+        min_over_speed=args.min_over_speed,
+        use_outer_wall=args.outer_wall,
+        analytic_linear=args.analytic_linear,
+        merge_tolerance=args.merge_tolerance,
+        gradient_profile=args.gradient_profile,
+        profile_points=args.profile_points,
+        result_cache=result_cache,
+    )
+
+    if args.analyze is not None and (args.batch is not None or args.watch is not None):
+        parser.error("--analyze works on a single input file")
+
+    if args.batch is not None:
+        if args.output is not None:
+            parser.error("use --output_dir instead of --output with --batch")
+        inputs = find_batch_inputs(args.batch)
+        if not inputs:
+            parser.error("no gcode files found for --batch {0}".format(" ".join(args.batch)))
+        succeeded = run_batch(inputs, args.output_dir, args.jobs, args.stats, **options)
+        sys.exit(0 if succeeded else 1)
+
+    if args.watch is not None:
+        if args.output_dir is None:
+            parser.error("--watch requires --output_dir")
+        print("Watching {0}, results are moved to {1}".format(args.watch, args.output_dir), flush=True)
+        try:
+            for result in watch_folder(args.watch, args.output_dir, args.jobs, args.poll_interval, **options):
+                if result.error is None:
+                    print("{0} -> {1} in {2:.2f} s".format(
+                        result.input_file_name, result.output_file_name, result.seconds
+                    ), flush=True)
+                else:
+                    print("FAILED {0}: {1}".format(result.input_file_name, result.error), flush=True)
+        except ValueError as error:
+            parser.error(str(error))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
 
     input_path = args.input.name
+    output_path = default_output_path(input_path) if args.output is None else args.output.name
+    stats = ProcessingStats() if args.stats else None
 
-    if args.output is None:
-        head, ext = os.path.splitext(input_path)
-        if ext == "":
-            ext = ".gcode"
-        output_path = "{0}_infill_gradient{1}".format(head, ext)
+    start = time.perf_counter()
+    if args.analyze is not None:
+        analysis = analyze_gcode(input_path, stats=stats, **options)
+        if args.analyze == "-":
+            json.dump(analysis.as_dict(), sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.analyze, "w") as analysisFile:
+                json.dump(analysis.as_dict(), analysisFile, indent=2)
     else:
-        output_path = args.output.name
+        process_gcode(
+            input_path,
+            output_path,
+            args.infill_type,
+            args.max_flow,
+            args.min_flow,
+            args.thickness,
+            args.discretization,
+            args.engine,
+            args.jobs,
+            args.memory_limit * 1024 * 1024,
+            args.mmap,
+            args.field_resolution,
+            args.short_distance_flow,
+            args.gradual_speed,
+            args.max_over_speed,
+            args.min_over_speed,
+            args.outer_wall,
+            args.analytic_linear,
+            args.merge_tolerance,
+            args.gradient_profile,
+            args.profile_points,
+            result_cache,
+            stats,
+            args.pipelined,
+        )
 
-    process_gcode(
-        input_path, output_path, args.infill_type, args.max_flow, args.min_flow, args.thickness, args.discretization
-    )
+    if stats is not None:
+        report = dict(stats.as_dict(), total_seconds=time.perf_counter() - start)
+        if args.stats == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.stats, "w") as statsFile:
+                json.dump(report, statsFile, indent=2)
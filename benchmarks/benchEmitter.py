@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the gcode emitter against the previous per-line formatting.
+
+Two workloads are timed: the sub-segments of LINEAR infill (``get_extrusion_commands`` against one
+``"G1 X{} Y{} E{}".format(round(...))`` per segment) and rewritten SMALL_SEGMENTS lines (``set_extrusion`` against
+rebuilding the line word by word with string concatenation).
+
+Usage: python benchmarks/benchEmitter.py [--segments 100000] [--repeat 5]
+"""
+import argparse
+import os.path
+import random
+import sys
+import timeit
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gradientInfillEngine import Point2D, get_extrusion_commands, set_extrusion  # noqa: E402
+
+
+def previous_extrusion_commands(points: List[Point2D], extrusions: List[float]) -> str:
+    """Format the sub-segments one command at a time, like ``get_extrusion_command`` did."""
+    output = ""
+    for point, extrusion in zip(points, extrusions):
+        output += "G1 X{} Y{} E{}\n".format(round(point.x, 3), round(point.y, 3), round(extrusion, 5))
+    return output
+
+
+def previous_rewritten_lines(lines: List[str], extrusions: List[float]) -> str:
+    """Rebuild each line word by word, like the SMALL_SEGMENTS path did."""
+    output = ""
+    for line, extrusion in zip(lines, extrusions):
+        outPutLine = ""
+        for element in line.split(" "):
+            if "E" in element:
+                outPutLine = outPutLine + "E" + str(round(extrusion, 5))
+            else:
+                outPutLine = outPutLine + element + " "
+        output += outPutLine + "\n"
+    return output
+
+
+def emitter_rewritten_lines(lines: List[str], extrusions: List[float]) -> str:
+    """Rewrite each line with ``set_extrusion`` and join them once."""
+    return "".join([set_extrusion(line, extrusion) for line, extrusion in zip(lines, extrusions)])
+
+
+def best_time(function: Callable[[], str], repeat: int) -> float:
+    """Return the best of ``repeat`` runs in seconds."""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(segments: int, repeat: int) -> None:
+    """Time both workloads and print the speedup of the emitter."""
+    random.seed(0)
+    points = [Point2D(random.uniform(0, 250), random.uniform(0, 250)) for _ in range(segments)]
+    extrusions = [random.uniform(0.001, 0.2) for _ in range(segments)]
+    lines = ["G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(p.x, p.y, e) for p, e in zip(points, extrusions)]
+
+    workloads = (
+        (
+            "linear sub-segments",
+            lambda: previous_extrusion_commands(points, extrusions),
+            lambda: get_extrusion_commands(points, extrusions),
+        ),
+        (
+            "rewritten lines",
+            lambda: previous_rewritten_lines(lines, extrusions),
+            lambda: emitter_rewritten_lines(lines, extrusions),
+        ),
+    )
+    print("{:<22} {:>12} {:>12} {:>9}".format("workload", "previous s", "emitter s", "speedup"))
+    for name, previous, emitter in workloads:
+        previousTime = best_time(previous, repeat)
+        emitterTime = best_time(emitter, repeat)
+        speedup = previousTime / emitterTime
+        print("{:<22} {:>12.4f} {:>12.4f} {:>8.1f}x".format(name, previousTime, emitterTime, speedup))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gcode emitter")
+    parser.add_argument("--segments", type=int, default=100000, help="number of formatted moves")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs, the best one is reported")
+    args = parser.parse_args()
+    main(args.segments, args.repeat)
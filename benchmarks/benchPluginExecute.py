@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the Cura plugin ``GradientInfill.execute`` for growing numbers of lines per layer.
+
+The plugin is loaded outside of Cura with minimal stand-ins for the Cura modules it imports.
+A linear implementation keeps the time per line constant when the layer size grows.
+
+Usage: python benchmarks/benchPluginExecute.py [--sizes 2000 8000 32000] [--layers 3]
+"""
+import argparse
+import importlib.util
+import math
+import os.path
+import sys
+import time
+import types
+from typing import List
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "GradientInfill.py")
+
+PLUGIN_SETTINGS = {
+    "gradientdiscretization": 4,
+    "maxflow": 350,
+    "minflow": 50,
+    "shortdistflow": 350,
+    "gradientthickness": 6.0,
+    "extruder_nb": 1,
+    "gradualspeed": True,
+    "maxoverspeed": 200,
+    "minoverspeed": 60,
+    "testouterwall": False,
+    "analyticlinear": False,
+    "mergetolerance": 0.0,
+    "gradientprofile": "linear",
+    "profilepoints": "0:0,0.3:0.8,1:1",
+}
+
+EXTRUDER_PROPERTIES = {
+    "infill_pattern": "gyroid",
+    "zig_zaggify_infill": False,
+    "relative_extrusion": True,
+    "infill_before_walls": False,
+}
+
+
+def install_cura_stand_ins() -> None:
+    """Register the modules imported by the plugin in ``sys.modules``."""
+
+    def module(name: str, **attributes) -> types.ModuleType:
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attributes)
+        mod.__path__ = []
+        sys.modules[name] = mod
+        return mod
+
+    class Script:
+        def getSettingValueByKey(self, key):
+            return PLUGIN_SETTINGS[key]
+
+    class Extruder:
+        def getProperty(self, key, name):
+            return EXTRUDER_PROPERTIES[key]
+
+    class GlobalStack:
+        extruderList = [Extruder()]
+
+        def getProperty(self, key, name):
+            return 1
+
+    class Application:
+        @staticmethod
+        def getInstance():
+            return Application()
+
+        def getGlobalContainerStack(self):
+            return GlobalStack()
+
+    class Logger:
+        @staticmethod
+        def log(level, message):
+            pass
+
+    class Message:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def show(self):
+            pass
+
+    class i18nCatalog:
+        def __init__(self, name):
+            pass
+
+        def i18nc(self, context, text):
+            return text
+
+    module("PostProcessingPlugin")
+    module("PostProcessingPlugin.scripts")
+    module("PostProcessingPlugin.Script", Script=Script)
+    module("UM")
+    module("UM.Logger", Logger=Logger)
+    module("UM.Application", Application=Application)
+    module("UM.Message", Message=Message)
+    module("UM.i18n", i18nCatalog=i18nCatalog)
+    module("cura")
+    module("cura.Settings")
+    module("cura.Settings.ExtruderManager", ExtruderManager=object)
+
+
+def load_plugin():
+    """Import ``GradientInfill.py`` the way Cura's post processing plugin does."""
+    install_cura_stand_ins()
+    spec = importlib.util.spec_from_file_location("PostProcessingPlugin.scripts.GradientInfill", PLUGIN_PATH)
+    plugin = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = plugin
+    spec.loader.exec_module(plugin)
+    return plugin.GradientInfill()
+
+
+def make_layer(layer: int, lines: int, wallPoints: int = 400) -> str:
+    """Create a layer with a circular inner wall and gyroid-like infill of about ``lines`` lines.
+
+    The wall keeps the same number of segments for every layer size so that only the line count changes.
+    """
+    radius = 40.0
+    output = [";LAYER:{}".format(layer), "G0 F3000 X{:.3f} Y100.000".format(100 + radius), ";TYPE:WALL-INNER"]
+    for i in range(1, wallPoints + 1):
+        angle = 2 * math.pi * i / wallPoints
+        output.append(
+            "G1 X{:.3f} Y{:.3f} E0.03".format(100 + radius * math.cos(angle), 100 + radius * math.sin(angle))
+        )
+    output += [";TYPE:FILL", "G1 F2700 E-6.5", "G0 F3000 X65.000 Y65.000", "G1 F1800 E6.5"]
+    infillLines = lines - len(output)
+    # the samples are spread over a fixed 35 x 140 pattern so that every size sees the same mix of near-wall and
+    # interior infill
+    for i in range(infillLines):
+        row, column = divmod(i * 4099 % 4900, 140)
+        x = 65 + column * 0.5
+        y = 65 + row * 2 + 1.5 * math.sin(x)
+        output.append("G1 X{:.3f} Y{:.3f} E0.02".format(x, y))
+    output.append(";MESH:NONMESH")
+    return "\n".join(output)
+
+
+def main(sizes: List[int], layers: int) -> None:
+    """Time ``execute`` for each layer size and print the time per line."""
+    script = load_plugin()
+    print("{:>10} {:>12} {:>14}".format("lines", "seconds", "us per line"))
+    for size in sizes:
+        data = [";FLAVOR:Marlin\nM83"] + [make_layer(layer, size) for layer in range(layers)]
+        lineCount = sum(layer.count("\n") + 1 for layer in data)
+        start = time.perf_counter()
+        script.execute(data)
+        elapsed = time.perf_counter() - start
+        print("{:>10} {:>12.3f} {:>14.2f}".format(size, elapsed, elapsed / lineCount * 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Cura plugin for growing layer sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 8000, 32000], help="lines per layer")
+    parser.add_argument("--layers", type=int, default=3, help="number of layers")
+    args = parser.parse_args()
+    main(args.sizes, args.layers)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Benchmark of ``process_gcode`` on synthetic gcode of growing size and wall complexity.
+
+The inputs are created by ``generateGcode.py`` and kept in the work directory between runs. Every case runs in a
+fresh interpreter so that its peak memory (maximum resident set size) is measured on its own. The results are
+printed as JSON, one record per case with the throughput in lines per second.
+
+Usage: python benchmarks/benchProcessGcode.py [--layers 20 100] [--wall_segments 500 5000] [--parts 1 36]
+       [--infill_types SMALL_SEGMENTS LINEAR] [--engines PYTHON NUMPY] [--output results.json]
+"""
+import argparse
+import json
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from addGradientInfill import Engine, InfillType, LayerCache, process_gcode  # noqa: E402
+import gradientInfillEngine  # noqa: E402
+from generateGcode import generate_gcode  # noqa: E402
+
+WORK_DIR = os.path.join(tempfile.gettempdir(), "GradientInfillBenchmark")
+
+
+def input_file(layers: int, wall_segments: int, infill_type: InfillType, parts: int = 1) -> str:
+    """Return the path of the synthetic input of a case, generating it on first use.
+
+    Plates of several parts use smaller parts, so that they still fit on a printer bed.
+    """
+    name = "{}_{}_{}".format(infill_type.name.lower(), layers, wall_segments)
+    if parts > 1:
+        name += "_{}parts".format(parts)
+    path = os.path.join(WORK_DIR, name + ".gcode")
+    if not os.path.exists(path):
+        os.makedirs(WORK_DIR, exist_ok=True)
+        radius = 40.0 if parts == 1 else 15.0
+        with open(path + ".tmp", "w") as outputFile:
+            generate_gcode(outputFile, layers, wall_segments, infill_type=infill_type, radius=radius, parts=parts)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def run_case(input_path: str, infill_type: InfillType, engine: Engine, layer_cache: bool) -> dict:
+    """Process ``input_path`` in this interpreter and return the time and peak memory."""
+    if not layer_cache:
+        gradientInfillEngine.LAYER_CACHE = LayerCache(0)
+    start = time.perf_counter()
+    process_gcode(input_path, input_path + ".out", infill_type, 350.0, 50.0, 6.0, 4.0, engine)
+    seconds = time.perf_counter() - start
+    os.remove(input_path + ".out")
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    return {"seconds": seconds, "peak_memory_mb": peak_mb}
+
+
+def main(
+    layers: List[int],
+    wall_segments: List[int],
+    parts: List[int],
+    infill_types: List[InfillType],
+    engines: List[Engine],
+    layer_cache: bool,
+    output: str,
+) -> None:
+    """Run every combination of the arguments in a separate interpreter and write the JSON records."""
+    records = []
+    for infill_type in infill_types:
+        for layerCount in layers:
+            for segments, partCount in ((segments, partCount) for segments in wall_segments for partCount in parts):
+                path = input_file(layerCount, segments, infill_type, partCount)
+                with open(path, "rb") as inputFile:
+                    lineCount = sum(1 for _ in inputFile)
+                for engine in engines:
+                    command = [
+                        sys.executable, os.path.abspath(__file__), "--run_case", path, infill_type.name, engine.name
+                    ]
+                    if not layer_cache:
+                        command.append("--no_layer_cache")
+                    result = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+                    record = {
+                        "infill_type": infill_type.name,
+                        "layers": layerCount,
+                        "wall_segments": segments,
+                        "parts": partCount,
+                        "engine": engine.name,
+                        "lines": lineCount,
+                        "bytes": os.path.getsize(path),
+                        "seconds": round(result["seconds"], 4),
+                        "lines_per_second": round(lineCount / result["seconds"]),
+                        "peak_memory_mb": round(result["peak_memory_mb"], 1),
+                    }
+                    records.append(record)
+                    print(json.dumps(record), file=sys.stderr)
+
+    report = json.dumps({"python": sys.version.split()[0], "layer_cache": layer_cache, "results": records}, indent=2)
+    if output:
+        with open(output, "w") as outputFile:
+            outputFile.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark process_gcode on synthetic gcode")
+    parser.add_argument("--layers", type=int, nargs="+", default=[20, 100], help="numbers of layers")
+    parser.add_argument(
+        "--wall_segments", type=int, nargs="+", default=[500, 5000], help="numbers of inner wall segments per layer"
+    )
+    parser.add_argument("--parts", type=int, nargs="+", default=[1], help="numbers of parts per plate")
+    parser.add_argument(
+        "--infill_types",
+        type=lambda arg: InfillType[arg.upper()],
+        nargs="+",
+        default=list(InfillType),
+        help="infill types, SMALL_SEGMENTS and/or LINEAR",
+    )
+    parser.add_argument(
+        "--engines", type=lambda arg: Engine[arg.upper()], nargs="+", default=[Engine.NUMPY], help="distance engines"
+    )
+    parser.add_argument(
+        "--no_layer_cache", action="store_true", help="disable the reuse of wall geometry across identical layers"
+    )
+    parser.add_argument("--output", help="file the JSON report is written to instead of stdout")
+    parser.add_argument("--run_case", nargs=3, metavar=("INPUT", "INFILL_TYPE", "ENGINE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        path, infillName, engineName = args.run_case
+        print(json.dumps(run_case(path, InfillType[infillName], Engine[engineName], not args.no_layer_cache)))
+    else:
+        main(
+            args.layers,
+            args.wall_segments,
+            args.parts,
+            args.infill_types,
+            args.engines,
+            not args.no_layer_cache,
+            args.output,
+        )
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Accuracy and speed of the ``DistanceField`` engine against the exact ``dist()`` based distances.
+
+A layer with a lattice of circular walls is built, the distances of random samples to the walls are evaluated
+exactly (``numpy_min_distances``, checked against ``dist`` on a subset) and with distance fields of several
+resolutions. The lookup error is bounded by about one pixel and the lookup time does not grow with the number of
+wall segments.
+
+Usage: python benchmarks/checkDistanceField.py [--segments 20000] [--samples 100000] [--resolutions 0.2 0.1 0.06]
+"""
+import argparse
+import math
+import os.path
+import random
+import sys
+import time
+from typing import List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from addGradientInfill import GRADIENT_THICKNESS  # noqa: E402
+from gradientInfillEngine import (  # noqa: E402
+    DistanceField,
+    Point2D,
+    Segment,
+    WallHierarchy,
+    dist,
+    numpy_min_distances,
+)
+
+
+def make_walls(segments: int, holes: int = 100) -> List[Segment]:
+    """Create a 10 x 10 lattice of circular walls with ``segments`` segments in total."""
+    perHole = max(3, segments // holes)
+    walls = []
+    for hole in range(holes):
+        centerX, centerY = 20 + 16 * (hole % 10), 20 + 16 * (hole // 10)
+        angles = [2 * math.pi * i / perHole for i in range(perHole + 1)]
+        points = [Point2D(centerX + 5 * math.cos(angle), centerY + 5 * math.sin(angle)) for angle in angles]
+        walls += [Segment(a, b) for a, b in zip(points, points[1:])]
+    return walls
+
+
+def main(segments: int, samples: int, resolutions: List[float]) -> None:
+    """Compare the distance field lookups of each resolution with the exact distances."""
+    random.seed(0)
+    walls = make_walls(segments)
+    pointsX = [random.uniform(10, 170) for _ in range(samples)]
+    pointsY = [random.uniform(10, 170) for _ in range(samples)]
+    wallArray = np.array(walls, dtype=float).reshape(-1, 2, 2)
+
+    # the vectorized kernel is checked against ``dist`` on a subset and used as the exact reference
+    hierarchy = WallHierarchy(wallArray.ravel().tolist(), GRADIENT_THICKNESS)
+    subset = range(0, samples, max(1, samples // 200))
+    exact = numpy_min_distances(pointsX, pointsY, wallArray, GRADIENT_THICKNESS)
+    reference = [min(min(dist(s, Point2D(pointsX[i], pointsY[i])) for s in walls), GRADIENT_THICKNESS) for i in subset]
+    assert np.allclose(exact[list(subset)], reference)
+    assert np.allclose(exact[list(subset)], [hierarchy.min_distance(Point2D(pointsX[i], pointsY[i])) for i in subset])
+
+    print("{} wall segments, {} samples, gradient thickness {} mm".format(len(walls), samples, GRADIENT_THICKNESS))
+    print("{:>10} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "resolution", "pixels", "build s", "lookup s", "max error", "mean error"
+    ))
+    for resolution in resolutions:
+        start = time.perf_counter()
+        field = DistanceField(wallArray, GRADIENT_THICKNESS, resolution)
+        built = time.perf_counter()
+        distances = field.lookup(pointsX, pointsY)
+        looked = time.perf_counter()
+        errors = np.abs(distances - exact)
+        # fields above FIELD_MAX_CELLS are not rasterized and fall back to the exact kernel
+        pixels = field.values.size if field.values is not None else "exact"
+        print("{:>10} {:>10} {:>12.3f} {:>12.4f} {:>12.4f} {:>12.5f}".format(
+            resolution, pixels, built - start, looked - built, errors.max(), errors.mean()
+        ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the distance field engine against the exact distances")
+    parser.add_argument("--segments", type=int, default=20000, help="number of wall segments")
+    parser.add_argument("--samples", type=int, default=100000, help="number of infill samples")
+    parser.add_argument("--resolutions", type=float, nargs="+", default=[0.2, 0.1, 0.06], help="pixel sizes in mm")
+    args = parser.parse_args()
+    main(args.segments, args.samples, args.resolutions)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Generator of synthetic Cura-style gcode for reproducible benchmarks.
+
+Every layer holds ``parts`` round parts on a square grid, each with ``holes`` round holes: the inner walls
+(``;TYPE:WALL-INNER``), the outer walls (``;TYPE:WALL-OUTER``) and the infill (``;TYPE:FILL``) with relative extrusion,
+the walls of all parts first. The wall complexity is the number of wall segments per part and layer, shared between
+the part and its holes. The infill is either gyroid-like small segments or
+long linear lines that alternate their direction every layer; both are clipped to the inside of the part.
+
+Usage: python benchmarks/generateGcode.py -o synthetic.gcode [--layers 100] [--wall_segments 2000] [--holes 8]
+       [--parts 1] [--infill_type SMALL_SEGMENTS]
+"""
+import argparse
+import math
+import os.path
+import sys
+from typing import List, TextIO, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from addGradientInfill import InfillType  # noqa: E402
+
+CENTER = 100.0  # X and Y of the center of the part
+LAYER_HEIGHT = 0.2
+LINE_WIDTH = 0.4
+EXTRUSION_PER_MM = 0.033  # relative E per mm of a 0.4 mm x 0.2 mm line
+SMALL_SEGMENT_LENGTH = 0.5  # X step of the gyroid-like infill
+
+HEADER = (
+    ";FLAVOR:Marlin\n"
+    ";Generated with benchmarks/generateGcode.py\n"
+    "M83 ;relative extrusion mode\n"
+    "G92 E0\n"
+    "G1 F1500 E-6.5\n"
+)
+FOOTER = ";End of Gcode\n"
+
+# circle of the part or of a hole: center X, center Y and radius
+Circle = Tuple[float, float, float]
+
+
+def part_circles(radius: float, holes: int, centerX: float = CENTER, centerY: float = CENTER) -> List[Circle]:
+    """Return the outline of the part followed by its holes, spread on a ring at half the part radius."""
+    circles = [(centerX, centerY, radius)]
+    holeRadius = min(radius / 6, radius * math.sin(math.pi / max(holes, 2)) / 3)
+    for hole in range(holes):
+        angle = 2 * math.pi * hole / holes
+        circles.append((centerX + radius / 2 * math.cos(angle), centerY + radius / 2 * math.sin(angle), holeRadius))
+    return circles
+
+
+def plate_parts(parts: int, radius: float, holes: int) -> List[List[Circle]]:
+    """Return the circles of ``parts`` parts on a square grid, the first part centered at ``CENTER``."""
+    columns = math.ceil(math.sqrt(parts))
+    pitch = 2 * radius + 4
+    return [
+        part_circles(radius, holes, CENTER + pitch * (part % columns), CENTER + pitch * (part // columns))
+        for part in range(parts)
+    ]
+
+
+def write_circle(outputFile: TextIO, circle: Circle, segments: int, offset: float) -> None:
+    """Write a closed wall around ``circle``, grown by ``offset``, made of ``segments`` extrusion moves."""
+    x, y, radius = circle
+    radius += offset
+    outputFile.write("G0 X{:.3f} Y{:.3f}\n".format(x + radius, y))
+    length = 2 * math.pi * radius / segments
+    for i in range(1, segments + 1):
+        angle = 2 * math.pi * i / segments
+        outputFile.write(
+            "G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(
+                x + radius * math.cos(angle), y + radius * math.sin(angle), length * EXTRUSION_PER_MM
+            )
+        )
+
+
+def is_inside(circles: List[Circle], x: float, y: float, margin: float) -> bool:
+    """Check whether a point is inside the part and outside its holes, at least ``margin`` from every wall."""
+    cx, cy, radius = circles[0]
+    if (x - cx) ** 2 + (y - cy) ** 2 > (radius - margin) ** 2:
+        return False
+    return all((x - hx) ** 2 + (y - hy) ** 2 > (holeRadius + margin) ** 2 for hx, hy, holeRadius in circles[1:])
+
+
+def chord_intervals(circles: List[Circle], y: float, margin: float) -> List[Tuple[float, float]]:
+    """Cut the horizontal line at ``y`` into the intervals inside the part and outside its holes."""
+    cx, cy, radius = circles[0]
+    radius -= margin
+    if abs(y - cy) >= radius:
+        return []
+    half = math.sqrt(radius * radius - (y - cy) ** 2)
+    intervals = [(cx - half, cx + half)]
+    for hx, hy, holeRadius in circles[1:]:
+        holeRadius += margin
+        if abs(y - hy) >= holeRadius:
+            continue
+        holeHalf = math.sqrt(holeRadius * holeRadius - (y - hy) ** 2)
+        cut = []
+        for start, end in intervals:
+            if start < hx - holeHalf:
+                cut.append((start, min(end, hx - holeHalf)))
+            if end > hx + holeHalf:
+                cut.append((max(start, hx + holeHalf), end))
+        intervals = cut
+    return intervals
+
+
+def write_small_segments(outputFile: TextIO, circles: List[Circle], layer: int, spacing: float) -> None:
+    """Write gyroid-like rows of short segments whose phase shifts from layer to layer."""
+    cx, cy, radius = circles[0]
+    rows = int(radius / spacing)
+    for row in range(-rows, rows + 1):
+        rowY = cy + row * spacing
+        x = cx - radius
+        extruding = False
+        while x < cx + radius:
+            x += SMALL_SEGMENT_LENGTH
+            y = rowY + spacing / 3 * math.sin(x + layer * 0.7)
+            if not is_inside(circles, x, y, LINE_WIDTH):
+                extruding = False
+            elif extruding:
+                outputFile.write("G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(x, y, SMALL_SEGMENT_LENGTH * EXTRUSION_PER_MM))
+            else:
+                outputFile.write("G0 X{:.3f} Y{:.3f}\n".format(x, y))
+                extruding = True
+
+
+def write_linear(outputFile: TextIO, circles: List[Circle], layer: int, spacing: float) -> None:
+    """Write long lines, along X on even layers and along Y on odd layers."""
+    cx, cy, radius = circles[0]
+    if layer % 2:
+        # mirror the part on its diagonal, cut along X and swap the coordinates back
+        circles = [(y, x, r) for x, y, r in circles]
+    rows = int(radius / spacing)
+    for row in range(-rows, rows + 1):
+        y = cy + row * spacing
+        intervals = chord_intervals(circles, y, LINE_WIDTH)
+        if row % 2:
+            intervals = [(end, start) for start, end in reversed(intervals)]
+        for start, end in intervals:
+            points = ((start, y), (end, y)) if layer % 2 == 0 else ((y, start), (y, end))
+            outputFile.write("G0 X{:.3f} Y{:.3f}\n".format(*points[0]))
+            outputFile.write(
+                "G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(points[1][0], points[1][1], abs(end - start) * EXTRUSION_PER_MM)
+            )
+
+
+def generate_gcode(
+    outputFile: TextIO,
+    layers: int = 100,
+    wall_segments: int = 2000,
+    holes: int = 8,
+    infill_type: InfillType = InfillType.SMALL_SEGMENTS,
+    radius: float = 40.0,
+    infill_spacing: float = 2.0,
+    parts: int = 1,
+) -> None:
+    """Write a synthetic gcode file.
+
+    Args:
+        outputFile (TextIO): file the gcode is written to
+        layers (int): number of layers
+        wall_segments (int): number of inner wall segments per part and layer, half of them for the outline of the
+            part and the other half shared by the holes
+        holes (int): number of holes of the part
+        infill_type (InfillType): small segments or linear infill
+        radius (float): radius of the part in mm
+        infill_spacing (float): distance between the infill rows in mm
+        parts (int): number of parts of the plate
+    """
+    plate = plate_parts(parts, radius, holes)
+    outlineSegments = max(3, wall_segments // 2 if holes else wall_segments)
+    holeSegments = max(3, (wall_segments - outlineSegments) // holes) if holes else 0
+    writeInfill = write_linear if infill_type == InfillType.LINEAR else write_small_segments
+
+    outputFile.write(HEADER)
+    for layer in range(layers):
+        outputFile.write(";LAYER:{}\n".format(layer))
+        outputFile.write("G0 F3000 X{:.3f} Y{:.3f} Z{:.1f}\n".format(CENTER, CENTER, LAYER_HEIGHT * (layer + 1)))
+        outputFile.write(";TYPE:WALL-INNER\nG1 F1800 E6.5\n")
+        for circles in plate:
+            write_circle(outputFile, circles[0], outlineSegments, -LINE_WIDTH / 2)
+            for hole in circles[1:]:
+                write_circle(outputFile, hole, holeSegments, LINE_WIDTH / 2)
+        outputFile.write(";TYPE:WALL-OUTER\n")
+        for circles in plate:
+            write_circle(outputFile, circles[0], outlineSegments, LINE_WIDTH / 2)
+        outputFile.write(";TYPE:FILL\nG1 F2700 E-6.5\nG0 F3000\nG1 F1800 E6.5\n")
+        for circles in plate:
+            writeInfill(outputFile, circles, layer, infill_spacing)
+        outputFile.write(";MESH:NONMESH\n;TIME_ELAPSED:{:.1f}\n".format(layer * 12.5))
+    outputFile.write(FOOTER)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic Cura-style gcode")
+    parser.add_argument("-o", "--output", required=True, help="path of the gcode file to be created")
+    parser.add_argument("--layers", type=int, default=100, help="number of layers")
+    parser.add_argument(
+        "--wall_segments", type=int, default=2000, help="number of inner wall segments per part and layer"
+    )
+    parser.add_argument("--holes", type=int, default=8, help="number of holes of the part")
+    parser.add_argument(
+        "--infill_type",
+        type=lambda arg: InfillType[arg.upper()],
+        default=InfillType.SMALL_SEGMENTS,
+        help="SMALL_SEGMENTS or LINEAR",
+    )
+    parser.add_argument("--radius", type=float, default=40.0, help="radius of the part in mm")
+    parser.add_argument("--infill_spacing", type=float, default=2.0, help="distance between the infill rows in mm")
+    parser.add_argument("--parts", type=int, default=1, help="number of parts of the plate")
+    args = parser.parse_args()
+    with open(args.output, "w") as outputFile:
+        generate_gcode(
+            outputFile,
+            args.layers,
+            args.wall_segments,
+            args.holes,
+            args.infill_type,
+            args.radius,
+            args.infill_spacing,
+            args.parts,
+        )
@@ -0,0 +1,2074 @@
+#!/usr/bin/env python3
+"""
+Gradient Infill engine shared by the command line script and the Cura plugin.
+
+The gcode is parsed line by line, the walls of each layer are collected and the extrusion of the infill moves is
+scaled with their distance to the walls. The distances are evaluated by a pure-Python bounding volume hierarchy, or by
+vectorized kernels when NumPy is installed, so the engine runs in the Python bundled with Cura with or without it.
+
+License: MIT
+Author: Stefan Hermann - CNC Kitchen
+Version: 1.0
+"""
+import hashlib
+import io
+import math
+import re
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict, namedtuple
+from enum import Enum
+from itertools import chain
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__version__ = '1.0'
+
+
+class InfillType(Enum):
+    """Enum for infill type."""
+
+    SMALL_SEGMENTS = 1  # infill with small segments like honeycomb or gyroid
+    LINEAR = 2  # linear infill like rectilinear or triangles
+
+
+class Engine(Enum):
+    """Enum for the engine used to calculate the distances to the walls."""
+
+    PYTHON = 1  # pure-Python queries on a bounding volume hierarchy of the walls, one sample at a time
+    NUMPY = 2  # vectorized batches over a whole infill section, requires NumPy
+    DISTANCE_FIELD = 3  # bilinear lookups in a rasterized distance field of the walls, requires NumPy
+
+
+class GradientProfile(Enum):
+    """Enum for the shape of the flow gradient from the walls to the gradient thickness."""
+
+    LINEAR = 1  # straight ramp from the maximum to the minimum flow
+    EXPONENTIAL = 2  # exponential decay, the flow drops quickly next to the walls
+    SMOOTHSTEP = 3  # cubic ease in and out, flat next to the walls and at the gradient thickness
+    POINTS = 4  # piecewise linear through user-supplied control points
+
+
+Point2D = namedtuple('Point2D', 'x y')
+Segment = namedtuple('Segment', 'point1 point2')
+# queued infill moves, ``feed`` is the feed rate scaled by gradual speed or None to keep the feed rate
+SegmentMove = namedtuple('SegmentMove', 'line extrusion sample feed')
+# ``lastEnd``, ``lastExtrusion`` and ``lastFeed`` are the move of the missing segment of a subdivided linear line
+LinearMove = namedtuple('LinearMove', 'ends extrusion sample feed lastEnd lastExtrusion lastFeed')
+# linear infill line cut at the borders of the gradient band, ``samples`` holds None for the pieces outside the band
+BandMove = namedtuple('BandMove', 'ends extrusions samples feed')
+# flows and over speeds are in percent; short_distance_flow (None: max_flow) is the flow of linear infill lines
+# shorter than two gradient steps; gradual_speed scales the feed rate inversely to the flow, limited to
+# min_over_speed..max_over_speed percent of the original feed rate; use_outer_wall measures the distances to the outer
+# wall instead of the inner walls; analytic_linear only subdivides the parts of linear infill lines inside the gradient;
+# merge_tolerance (0: off) merges consecutive pieces of a linear infill line whose flows differ by less than this many
+# percent, and whose feed rates by less than this many percent of each other; gradient_profile is the shape of the flow
+# between the walls and gradient_thickness, profile_points the (distance, position) control points of
+# GradientProfile.POINTS, both as fractions of gradient_thickness and of the way from max_flow to min_flow
+GradientSettings = namedtuple(
+    'GradientSettings',
+    'infill_type max_flow min_flow gradient_thickness gradient_discretization engine field_resolution '
+    'short_distance_flow gradual_speed max_over_speed min_over_speed use_outer_wall analytic_linear merge_tolerance '
+    'gradient_profile profile_points',
+    defaults=(None, False, 200.0, 60.0, False, False, 0.0, GradientProfile.LINEAR, None),
+)
+
+
+class Section(Enum):
+    """Enum for section type."""
+
+    NOTHING = 0
+    INNER_WALL = 1
+    INFILL = 2
+    OUTER_WALL = 3
+
+
+class Marker(Enum):
+    """Enum for the comments of a gcode line."""
+
+    NONE = 0  # no comment
+    COMMENT = 1  # any comment that is not a section marker
+    LAYER = 2  # ;LAYER:
+    INNER_WALL = 3  # ;TYPE:WALL-INNER
+    OUTER_WALL = 4  # ;TYPE:WALL-OUTER
+    INFILL = 5  # ;TYPE:FILL
+
+
+GcodeMove = namedtuple('GcodeMove', 'command x y e f marker')
+# state carried over a layer boundary: current section, last position and last G1 feed rate
+LayerState = namedtuple('LayerState', 'section position feed')
+INITIAL_STATE = LayerState(Section.NOTHING, Point2D(-10000, -10000), None)
+
+
+def dist(segment: Segment, point: Point2D) -> float:
+    """Calculate the distance from a point to a line with finite length.
+
+    Args:
+        segment (Segment): line used for distance calculation
+        point (Point2D): point used for distance calculation
+
+    Returns:
+        float: distance between ``segment`` and ``point``
+    """
+    px = segment.point2.x - segment.point1.x
+    py = segment.point2.y - segment.point1.y
+    norm = px * px + py * py
+    u = ((point.x - segment.point1.x) * px + (point.y - segment.point1.y) * py) / float(norm)
+    if u > 1:
+        u = 1
+    elif u < 0:
+        u = 0
+    x = segment.point1.x + u * px
+    y = segment.point1.y + u * py
+    dx = x - point.x
+    dy = y - point.y
+
+    return (dx * dx + dy * dy) ** 0.5
+
+
+def get_points_distance(point1: Point2D, point2: Point2D) -> float:
+    """Calculate the euclidean distance between two points.
+
+    Args:
+        point1 (Point2D): first point
+        point2 (Point2D): second point
+
+    Returns:
+        float: euclidean distance between the points
+    """
+    return ((point1.x - point2.x) ** 2 + (point1.y - point2.y) ** 2) ** 0.5
+
+
+def min_distance_from_segment(
+    segment: Segment, segments: Union[List[Segment], "WallHierarchy"]
+) -> float:
+    """Calculate the minimum distance from the midpoint of ``segment`` to the nearest segment in ``segments``.
+
+    Args:
+        segment (Segment): segment to use for midpoint calculation
+        segments (Union[List[Segment], WallHierarchy]): segments list, or a hierarchy of segments for a radius-limited
+            query
+
+    Returns:
+        float: the smallest distance from the midpoint of ``segment`` to the nearest segment in the list; a hierarchy
+        returns its radius when no segment is closer
+    """
+    middlePoint = Point2D((segment.point1.x + segment.point2.x) / 2, (segment.point1.y + segment.point2.y) / 2)
+
+    if isinstance(segments, WallHierarchy):
+        return segments.min_distance(middlePoint)
+    return min(dist(s, middlePoint) for s in segments)
+
+
+def band_interval(
+    start: Point2D, end: Point2D, wall: Tuple[float, float, float, float, float], radius: float
+) -> Optional[Tuple[float, float]]:
+    """Calculate the part of a line closer than ``radius`` to a wall segment.
+
+    The points closer than ``radius`` to the wall form a capsule: a rectangle along the wall and a circle around each
+    of its ends. The capsule is convex, so the line crosses it in a single interval enclosing the intervals of these
+    three pieces.
+
+    Args:
+        start (Point2D): start of the line, not equal to ``end``
+        end (Point2D): end of the line
+        wall (Tuple[float, float, float, float, float]): start point, direction and squared length of the wall segment
+        radius (float): distance from the wall
+
+    Returns:
+        Optional[Tuple[float, float]]: the interval as parameters between 0 (``start``) and 1 (``end``), or None when
+        the line stays at ``radius`` or further from the wall
+    """
+    x1, y1, px, py, norm = wall
+    sx, sy = start
+    dx = end.x - sx
+    dy = end.y - sy
+    fx = sx - x1
+    fy = sy - y1
+    # position across the wall times its length, both ends of a line further than radius on one side never reach it
+    across = fy * px - fx * py
+    acrossSlope = dy * px - dx * py
+    width = radius * norm ** 0.5
+    if (across > width and across + acrossSlope > width) or (across < -width and across + acrossSlope < -width):
+        return None
+
+    low = math.inf
+    high = -math.inf
+    # the circles around both ends of the wall, solving |start + t * d - end of the wall| = radius
+    a = dx * dx + dy * dy
+    squared = radius * radius
+    for cx, cy in ((fx, fy), (fx - px, fy - py)):
+        b = cx * dx + cy * dy
+        discriminant = b * b - a * (cx * cx + cy * cy - squared)
+        if discriminant > 0:
+            root = discriminant ** 0.5
+            if (-b - root) / a < low:
+                low = (-b - root) / a
+            if (-b + root) / a > high:
+                high = (-b + root) / a
+    # the rectangle: position along the wall times its length in [0, norm], position across within the width
+    if norm:
+        along = fx * px + fy * py
+        alongSlope = dx * px + dy * py
+        inside = True
+        rectangleLow = -math.inf
+        rectangleHigh = math.inf
+        for offset, slope, lower, upper in ((along, alongSlope, 0.0, norm), (across, acrossSlope, -width, width)):
+            if slope:
+                t1 = (lower - offset) / slope
+                t2 = (upper - offset) / slope
+                if t1 > t2:
+                    t1, t2 = t2, t1
+                if t1 > rectangleLow:
+                    rectangleLow = t1
+                if t2 < rectangleHigh:
+                    rectangleHigh = t2
+            elif not lower <= offset <= upper:
+                inside = False
+        if inside and rectangleLow < rectangleHigh:
+            if rectangleLow < low:
+                low = rectangleLow
+            if rectangleHigh > high:
+                high = rectangleHigh
+
+    if low < 0:
+        low = 0.0
+    if high > 1:
+        high = 1.0
+    return (low, high) if low < high else None
+
+
+def band_intervals(
+    start: Point2D, end: Point2D, walls: Iterable[Tuple[float, float, float, float, float]], radius: float
+) -> List[Tuple[float, float]]:
+    """Calculate the parts of a line closer than ``radius`` to any of ``walls``.
+
+    Args:
+        start (Point2D): start of the line
+        end (Point2D): end of the line
+        walls (Iterable[Tuple[float, float, float, float, float]]): start point, direction and squared length of the
+            wall segments
+        radius (float): distance from the walls, usually the gradient thickness
+
+    Returns:
+        List[Tuple[float, float]]: sorted, disjoint intervals as parameters between 0 (``start``) and 1 (``end``)
+    """
+    intervals = sorted(
+        interval for interval in (band_interval(start, end, wall, radius) for wall in walls) if interval is not None
+    )
+    merged: List[Tuple[float, float]] = []
+    for low, high in intervals:
+        if merged and low <= merged[-1][1]:
+            if high > merged[-1][1]:
+                merged[-1] = (merged[-1][0], high)
+        else:
+            merged.append((low, high))
+    return merged
+
+
+# Approximate number of bytes of wall geometry and distances kept by ``LAYER_CACHE``
+LAYER_CACHE_SIZE = 64 * 1024 * 1024
+# Approximate number of bytes of the key and bookkeeping of each ``LayerCache`` entry, charged even for empty values
+LAYER_CACHE_ENTRY_SIZE = 256
+# Number of point-segment pairs evaluated at once by ``numpy_min_distances``
+NUMPY_BATCH_SIZE = 1 << 18
+# Largest number of pixels of a ``DistanceField``, larger layers are evaluated by ``numpy_min_distances``
+FIELD_MAX_CELLS = 1 << 23
+# Maximum number of infill lines queued by ``GradientProcessor`` before their distances are evaluated
+MAX_BATCH_LINES = 50000
+# Maximum number of connected wall segments in a leaf of a ``WallHierarchy``, for single and vectorized queries
+LEAF_SEGMENTS = 4
+NUMPY_LEAF_SEGMENTS = 32
+# Margin by which the warm start lower bound of ``WallHierarchy.min_distance`` must exceed the radius to skip a search
+WARM_START_TOLERANCE = 1e-9
+
+# Width of the bins of the flow histograms of ``FlowAnalysis`` in percent
+FLOW_HISTOGRAM_BIN = 10.0
+# Number of entries of a ``ProfileTable`` between the walls and the gradient thickness
+PROFILE_TABLE_SIZE = 4096
+# Decay rate of ``GradientProfile.EXPONENTIAL`` over the gradient thickness
+PROFILE_EXPONENT = 4.0
+
+# Fixed precision formats of the extrusion moves and feed rates written by the emitter
+EXTRUSION_FORMAT = "%.5f"
+FEED_FORMAT = " F%d"
+EXTRUSION_COMMAND = "G1 X%.3f Y%.3f E" + EXTRUSION_FORMAT + "\n"
+EXTRUSION_FEED_COMMAND = "G1 X%.3f Y%.3f E" + EXTRUSION_FORMAT + FEED_FORMAT + "\n"
+EXTRUSION_PARAMETER = re.compile(r"(?<=\sE)[^\s;]*")
+
+
+# bounding box of a group of wall segments
+BoundingBox = namedtuple('BoundingBox', 'minX minY maxX maxY')
+
+
+def split_loops(walls: Sequence[float], max_length: int) -> List[Tuple[int, int]]:
+    """Split the wall segments of a layer into runs of connected segments of the same loop.
+
+    Each wall move starts where the previous one ended, so the end point of a segment equals the start point of the
+    segment before it. A run ends at a travel move between two loops, or after ``max_length`` segments.
+
+    Args:
+        walls (Sequence[float]): wall segments in the order of the gcode as a flat buffer of x1, y1, x2, y2 values
+        max_length (int): maximum number of segments of a run
+
+    Returns:
+        List[Tuple[int, int]]: index of the first segment and after the last segment of each run
+    """
+    runs = []
+    start = 0
+    count = len(walls) // 4
+    for index in range(1, count):
+        offset = 4 * index
+        connected = walls[offset + 2] == walls[offset - 4] and walls[offset + 3] == walls[offset - 3]
+        if index - start >= max_length or not connected:
+            runs.append((start, index))
+            start = index
+    if count:
+        runs.append((start, count))
+    return runs
+
+
+def bounding_box(boxes: Iterable[BoundingBox]) -> BoundingBox:
+    """Return the bounding box enclosing all ``boxes``."""
+    minX, minY, maxX, maxY = zip(*boxes)
+    return BoundingBox(min(minX), min(minY), max(maxX), max(maxY))
+
+
+class WallHierarchy:
+    """Bounding volume hierarchy of the wall loops of a layer for radius-limited distance queries.
+
+    Walls come as loops, one per island or hole. Every loop is cut into runs of at most ``leaf_size`` connected
+    segments, and the bounding boxes of the runs are grouped into a binary tree, split at the median of the longer
+    side. A query visits the nearer child first and skips every box further away than the radius or than the nearest
+    segment found so far, so the walls of the other parts of a plate are never looked at.
+    """
+
+    def __init__(self, walls: Sequence[float], radius: float, leaf_size: int = LEAF_SEGMENTS, vectorized=False):
+        """Build the hierarchy.
+
+        Args:
+            walls (Sequence[float]): wall segments of the layer in the order of the gcode as a flat buffer of x1, y1,
+                x2, y2 values, e.g. an ``array('d')``; it is not referenced after the hierarchy is built
+            radius (float): query radius, usually the gradient thickness
+            leaf_size (int): maximum number of segments of a leaf
+            vectorized (bool): also keep the leaves as NumPy arrays for ``min_distances``
+        """
+        self.radius = radius
+        self.boxes: List[BoundingBox] = []
+        # left child, right child, axis and coordinate of the split of inner nodes, None for leaves
+        self.children: List[Optional[Tuple[int, int, int, float]]] = []
+        # segments of the leaves as start point, direction and squared length, None for inner nodes
+        self.leaves: List[Optional[List[Tuple[float, float, float, float, float]]]] = []
+        # segments of the leaves as views of a single array of shape (n, 2, 2)
+        self.leafArrays: Dict[int, "np.ndarray"] = {}
+        self.segmentArray = np.array(walls, dtype=float).reshape(-1, 2, 2) if vectorized else None
+        # warm start of ``min_distance``: previous point, lower bound of its distance and its nearest segment
+        self.lastPoint = Point2D(0.0, 0.0)
+        self.lowerBound = 0.0
+        self.nearest: Optional[Tuple[float, float, float, float, float]] = None
+        # number of ``min_distance`` queries answered by the warm start without a search
+        self.skipped = 0
+        runs = split_loops(walls, leaf_size)
+        if runs:
+            boxes = []
+            for start, stop in runs:
+                xs = walls[4 * start:4 * stop:2]
+                ys = walls[4 * start + 1:4 * stop:2]
+                boxes.append(BoundingBox(min(xs), min(ys), max(xs), max(ys)))
+            self._build(walls, list(zip(boxes, runs)))
+
+    def _build(self, walls: Sequence[float], runs: List[Tuple[BoundingBox, Tuple[int, int]]]) -> int:
+        """Add the node enclosing ``runs`` and its descendants, and return the index of the node."""
+        node = len(self.boxes)
+        box = bounding_box(runBox for runBox, _ in runs)
+        self.boxes.append(box)
+        self.children.append(None)
+        self.leaves.append(None)
+        if len(runs) == 1:
+            start, stop = runs[0][1]
+            leaf = []
+            for offset in range(4 * start, 4 * stop, 4):
+                x1, y1, x2, y2 = walls[offset:offset + 4]
+                px = x2 - x1
+                py = y2 - y1
+                leaf.append((x1, y1, px, py, px * px + py * py))
+            self.leaves[node] = leaf
+            if self.segmentArray is not None:
+                self.leafArrays[node] = self.segmentArray[start:stop]
+            return node
+
+        axis = 0 if box.maxX - box.minX >= box.maxY - box.minY else 1
+        runs.sort(key=lambda run: run[0][axis] + run[0][axis + 2])
+        half = len(runs) // 2
+        lower, upper = runs[half - 1][0], runs[half][0]
+        split = (lower[axis] + lower[axis + 2] + upper[axis] + upper[axis + 2]) / 4
+        left = self._build(walls, runs[:half])
+        right = self._build(walls, runs[half:])
+        self.children[node] = (left, right, axis, split)
+        return node
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the hierarchy."""
+        size = 200 * len(self.boxes) + sum(100 * len(leaf) for leaf in self.leaves if leaf is not None)
+        return size + (self.segmentArray.nbytes if self.segmentArray is not None else 0)
+
+    def min_distance(self, point: Point2D) -> float:
+        """Calculate the distance from ``point`` to the nearest segment, capped at the radius.
+
+        Consecutive queries are warm-started from the previous one: the distance changes by at most the distance
+        moved, so a point that is still clearly beyond the radius is answered without a search, and the distance to
+        the previous nearest segment is the initial bound that prunes the others.
+
+        Args:
+            point (Point2D): point used for distance calculation
+
+        Returns:
+            float: distance to the nearest segment, or ``radius`` when no segment is closer than ``radius``
+        """
+        x, y = point
+        radius = self.radius
+        if not self.boxes:
+            return radius
+        lastX, lastY = self.lastPoint
+        self.lastPoint = point
+        lowerBound = self.lowerBound - math.hypot(x - lastX, y - lastY)
+        if lowerBound > radius + WARM_START_TOLERANCE:
+            self.lowerBound = lowerBound
+            self.skipped += 1
+            return radius
+
+        boxes, children, leaves = self.boxes, self.children, self.leaves
+        # the search stops at the radius, a miss still leaves the distance of the nearest pruned box as lower bound
+        shortestDistance = radius
+        shortestSquared = shortestDistance * shortestDistance
+        nearest = self.nearest
+        if nearest is not None:
+            x1, y1, px, py, norm = nearest
+            u = ((x - x1) * px + (y - y1) * py) / norm if norm else 0.0
+            if u > 1:
+                u = 1
+            elif u < 0:
+                u = 0
+            dx = x1 + u * px - x
+            dy = y1 + u * py - y
+            squared = dx * dx + dy * dy
+            if squared < shortestSquared:
+                shortestSquared = squared
+                shortestDistance = squared ** 0.5
+            else:
+                nearest = None
+        # smallest squared distance of the pruned boxes and the farther segments, the lower bound of a miss
+        floorSquared = math.inf
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            minX, minY, maxX, maxY = boxes[node]
+            dx = max(minX - x, 0.0, x - maxX)
+            dy = max(minY - y, 0.0, y - maxY)
+            squared = dx * dx + dy * dy
+            if squared >= shortestSquared:
+                if squared < floorSquared:
+                    floorSquared = squared
+                continue
+            leaf = leaves[node]
+            if leaf is None:
+                left, right, axis, split = children[node]
+                # the nearer child is pushed last and visited first
+                if (x if axis == 0 else y) < split:
+                    stack += (right, left)
+                else:
+                    stack += (left, right)
+                continue
+            # same arithmetic as ``dist``, a segment of zero length is measured to its start
+            for segment in leaf:
+                x1, y1, px, py, norm = segment
+                u = ((x - x1) * px + (y - y1) * py) / norm if norm else 0.0
+                if u > 1:
+                    u = 1
+                elif u < 0:
+                    u = 0
+                dx = x1 + u * px - x
+                dy = y1 + u * py - y
+                squared = dx * dx + dy * dy
+                if squared < shortestSquared:
+                    shortestSquared = squared
+                    shortestDistance = squared ** 0.5
+                    nearest = segment
+                elif squared < floorSquared:
+                    floorSquared = squared
+        self.nearest = nearest
+        self.lowerBound = shortestDistance if nearest is not None else floorSquared ** 0.5
+        return min(shortestDistance, radius)
+
+    def segments_near(self, box: BoundingBox) -> List[Tuple[float, float, float, float, float]]:
+        """Collect the segments of the leaves whose box is closer than the radius to ``box``.
+
+        Args:
+            box (BoundingBox): area of interest, e.g. the bounding box of an infill line
+
+        Returns:
+            List[Tuple[float, float, float, float, float]]: start point, direction and squared length of the segments
+        """
+        radiusSquared = self.radius * self.radius
+        segments = []
+        stack = [0] if self.boxes else []
+        while stack:
+            node = stack.pop()
+            minX, minY, maxX, maxY = self.boxes[node]
+            dx = max(minX - box.maxX, 0.0, box.minX - maxX)
+            dy = max(minY - box.maxY, 0.0, box.minY - maxY)
+            if dx * dx + dy * dy >= radiusSquared:
+                continue
+            if self.leaves[node] is None:
+                stack += self.children[node][:2]
+            else:
+                segments += self.leaves[node]
+        return segments
+
+    def min_distances(self, pointsX: Sequence[float], pointsY: Sequence[float]) -> "np.ndarray":
+        """Vectorized ``min_distance`` of many points, requires a hierarchy built with ``vectorized``.
+
+        The points are filtered down the tree: a node only receives the points whose nearest segment so far is
+        further away than its box.
+
+        Args:
+            pointsX (Sequence[float]): X coordinates of the points
+            pointsY (Sequence[float]): Y coordinates of the points
+
+        Returns:
+            np.ndarray: the smallest distance of each point to the segments, capped at the radius
+        """
+        pointsX = np.asarray(pointsX, dtype=float)
+        pointsY = np.asarray(pointsY, dtype=float)
+        distances = np.full(len(pointsX), float(self.radius))
+        if not self.boxes or not len(pointsX):
+            return distances
+
+        stack = [(0, np.arange(len(pointsX)))]
+        while stack:
+            node, indices = stack.pop()
+            minX, minY, maxX, maxY = self.boxes[node]
+            x = pointsX[indices]
+            y = pointsY[indices]
+            dx = np.maximum(np.maximum(minX - x, x - maxX), 0.0)
+            dy = np.maximum(np.maximum(minY - y, y - maxY), 0.0)
+            shortest = distances[indices]
+            near = dx * dx + dy * dy < shortest * shortest
+            if not near.any():
+                continue
+            indices = indices[near]
+            if self.children[node] is not None:
+                left, right = self.children[node][:2]
+                stack += ((right, indices), (left, indices))
+                continue
+            distances[indices] = np.minimum(
+                shortest[near],
+                numpy_min_distances(x[near], y[near], self.leafArrays[node], self.radius),
+            )
+        return distances
+
+
+def resolve_engine(engine: Engine) -> Engine:
+    """Return ``engine``, or ``Engine.PYTHON`` when ``engine`` needs NumPy and it is not installed."""
+    if engine in (Engine.NUMPY, Engine.DISTANCE_FIELD) and np is None:
+        return Engine.PYTHON
+    return engine
+
+
+def numpy_min_distances(
+    pointsX: Sequence[float],
+    pointsY: Sequence[float],
+    segments: "np.ndarray",
+    max_distance: float,
+    batch_size: int = NUMPY_BATCH_SIZE,
+) -> "np.ndarray":
+    """Vectorized ``dist`` from many points to their nearest segment, capped at ``max_distance``.
+
+    The points are processed in chunks so that no more than ``batch_size`` point-segment pairs are held in memory.
+
+    Args:
+        pointsX (Sequence[float]): X coordinates of the points
+        pointsY (Sequence[float]): Y coordinates of the points
+        segments (np.ndarray): segments as an array of shape (n, 2, 2)
+        max_distance (float): distance returned when no segment is closer
+        batch_size (int): maximum number of point-segment pairs per chunk
+
+    Returns:
+        np.ndarray: the smallest distance of each point to the segments
+    """
+    pointsX = np.asarray(pointsX, dtype=float)
+    pointsY = np.asarray(pointsY, dtype=float)
+    distances = np.full(len(pointsX), float(max_distance))
+    if not len(segments) or not len(pointsX):
+        return distances
+
+    x1 = segments[:, 0, 0]
+    y1 = segments[:, 0, 1]
+    px = segments[:, 1, 0] - x1
+    py = segments[:, 1, 1] - y1
+    norm = px * px + py * py
+    # degenerate segments: u becomes 0 and the distance is measured to point1
+    norm[norm == 0] = 1.0
+
+    step = max(1, batch_size // len(segments))
+    for start in range(0, len(pointsX), step):
+        x = pointsX[start:start + step, None]
+        y = pointsY[start:start + step, None]
+        u = ((x - x1) * px + (y - y1) * py) / norm
+        np.clip(u, 0, 1, out=u)
+        dx = x1 + u * px - x
+        dy = y1 + u * py - y
+        np.minimum(np.sqrt((dx * dx + dy * dy).min(axis=1)), max_distance, out=distances[start:start + step])
+
+    return distances
+
+
+class DistanceField:
+    """Distance from the wall segments of a layer, rasterized on a square grid and capped at a maximum distance.
+
+    The segments are sampled at half the grid spacing and their nearest grid points become the seeds of an exact
+    Euclidean distance transform; a query is a bilinear interpolation between the four surrounding grid points. The
+    error of a lookup is bounded by about one grid spacing, independent of the number of segments. Layers needing
+    more than ``max_cells`` grid points are not rasterized and are queried with ``numpy_min_distances`` instead.
+    """
+
+    def __init__(
+        self, segments: "np.ndarray", max_distance: float, resolution: float, max_cells: int = FIELD_MAX_CELLS
+    ):
+        """Rasterize the segments and compute the distance transform.
+
+        Args:
+            segments (np.ndarray): segments as an array of shape (n, 2, 2)
+            max_distance (float): distance returned when no segment is closer, usually the gradient thickness
+            resolution (float): spacing of the grid points in mm
+            max_cells (int): maximum number of grid points
+        """
+        self.segments = segments
+        self.max_distance = max_distance
+        self.resolution = resolution
+        self.values: Optional["np.ndarray"] = None
+        if not len(segments):
+            return
+
+        # grid points further than max_distance from the bounding box of the walls are never needed
+        margin = max_distance + 2 * resolution
+        points = segments.reshape(-1, 2)
+        self.originX, self.originY = points.min(axis=0) - margin
+        extent = points.max(axis=0) + margin - (self.originX, self.originY)
+        columns, rows = np.ceil(extent / resolution).astype(int) + 1
+        if rows * columns > max_cells:
+            return
+
+        radius = int(math.ceil(max_distance / resolution))
+        seeds = self._rasterize(rows, columns)
+        self.values = np.sqrt(self._squared_distances(seeds, radius).astype(np.float32)) * np.float32(resolution)
+        np.minimum(self.values, np.float32(max_distance), out=self.values)
+
+    def _rasterize(self, rows: int, columns: int) -> "np.ndarray":
+        """Mark the grid points nearest to samples taken along the segments at half the grid spacing."""
+        starts = self.segments[:, 0]
+        deltas = self.segments[:, 1] - starts
+        counts = np.ceil(np.hypot(deltas[:, 0], deltas[:, 1]) * 2 / self.resolution).astype(int) + 1
+        owners = np.repeat(np.arange(len(counts)), counts)
+        steps = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+        fractions = (steps / np.maximum(counts - 1, 1)[owners])[:, None]
+        samples = starts[owners] + deltas[owners] * fractions
+
+        seeds = np.zeros((rows, columns), dtype=bool)
+        seeds[
+            np.rint((samples[:, 1] - self.originY) / self.resolution).astype(int),
+            np.rint((samples[:, 0] - self.originX) / self.resolution).astype(int),
+        ] = True
+        return seeds
+
+    @staticmethod
+    def _squared_distances(seeds: "np.ndarray", radius: int) -> "np.ndarray":
+        """Calculate the squared distance in grid units from each grid point to the nearest seed.
+
+        The exact distance along each column is found with running maxima and minima of the seed rows, the rows are
+        then combined over a window of ``radius`` columns to each side. Distances larger than ``radius`` are capped
+        just above it.
+        """
+        rows, columns = seeds.shape
+        cap = radius + 1
+        rowIndex = np.arange(rows, dtype=np.int32)[:, None]
+        previous = np.maximum.accumulate(np.where(seeds, rowIndex, -2 * cap), axis=0)
+        following = np.minimum.accumulate(np.where(seeds, rowIndex, rows + 2 * cap)[::-1], axis=0)[::-1]
+        columnDistances = np.minimum(np.minimum(rowIndex - previous, following - rowIndex), cap)
+
+        padded = np.full((rows, columns + 2 * radius), cap * cap, dtype=np.int32)
+        padded[:, radius:radius + columns] = columnDistances * columnDistances
+        squared = np.full((rows, columns), cap * cap, dtype=np.int32)
+        for offset in range(-radius, radius + 1):
+            np.minimum(squared, padded[:, radius + offset:radius + offset + columns] + offset * offset, out=squared)
+        return squared
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the field and its segments."""
+        return self.segments.nbytes + (self.values.nbytes if self.values is not None else 0)
+
+    def segments_near(self, box: BoundingBox) -> List[Tuple[float, float, float, float, float]]:
+        """Collect the segments closer than ``max_distance`` to ``box``, like ``WallHierarchy.segments_near``."""
+        if not len(self.segments):
+            return []
+        low = self.segments.min(axis=1)
+        high = self.segments.max(axis=1)
+        dx = np.maximum(np.maximum(low[:, 0] - box.maxX, box.minX - high[:, 0]), 0.0)
+        dy = np.maximum(np.maximum(low[:, 1] - box.maxY, box.minY - high[:, 1]), 0.0)
+        near = self.segments[dx * dx + dy * dy < self.max_distance * self.max_distance]
+        starts = near[:, 0].tolist()
+        deltas = (near[:, 1] - near[:, 0]).tolist()
+        return [(x1, y1, px, py, px * px + py * py) for (x1, y1), (px, py) in zip(starts, deltas)]
+
+    def lookup(self, pointsX: Sequence[float], pointsY: Sequence[float]) -> "np.ndarray":
+        """Interpolate the distances of many points to the nearest segment, capped at ``max_distance``.
+
+        Args:
+            pointsX (Sequence[float]): X coordinates of the points
+            pointsY (Sequence[float]): Y coordinates of the points
+
+        Returns:
+            np.ndarray: the interpolated distance of each point, ``max_distance`` outside the grid
+        """
+        if self.values is None:
+            return numpy_min_distances(pointsX, pointsY, self.segments, self.max_distance)
+
+        gridX = (np.asarray(pointsX, dtype=float) - self.originX) / self.resolution
+        gridY = (np.asarray(pointsY, dtype=float) - self.originY) / self.resolution
+        rows, columns = self.values.shape
+        inside = (gridX >= 0) & (gridX < columns - 1) & (gridY >= 0) & (gridY < rows - 1)
+        distances = np.full(len(gridX), float(self.max_distance))
+
+        gridX = gridX[inside]
+        gridY = gridY[inside]
+        i = gridY.astype(int)
+        j = gridX.astype(int)
+        u = gridX - j
+        v = gridY - i
+        values = self.values
+        distances[inside] = (
+            (values[i, j] * (1 - u) + values[i, j + 1] * u) * (1 - v)
+            + (values[i + 1, j] * (1 - u) + values[i + 1, j + 1] * u) * v
+        )
+        return distances
+
+
+def getXY(currentLine: str) -> Point2D:
+    """Create a ``Point2D`` object from a gcode line.
+
+    Args:
+        currentLine (str): gcode line
+
+    Raises:
+        SyntaxError: when the regular expressions cannot find the relevant coordinates in the gcode
+
+    Returns:
+        Point2D: the parsed coordinates
+    """
+    searchX = re.search(r"X(-?\d*\.?\d*)", currentLine)
+    searchY = re.search(r"Y(-?\d*\.?\d*)", currentLine)
+    if searchX and searchY:
+        elementX = searchX.group(1)
+        elementY = searchY.group(1)
+    else:
+        raise SyntaxError(f'Gcode file parsing error for line {currentLine}')
+
+    return Point2D(float(elementX), float(elementY))
+
+
+def mapRange(a: Tuple[float, float], b: Tuple[float, float], s: float) -> float:
+    """Calculate a multiplier for the extrusion value from the distance to the perimeter.
+
+    Args:
+        a (Tuple[float, float]): a tuple containing:
+            - a1 (float): the minimum distance to the perimeter (always zero at the moment)
+            - a2 (float): the maximum distance to the perimeter where the interpolation is performed
+        b (Tuple[float, float]): a tuple containing:
+            - b1 (float): the maximum flow as a fraction
+            - b2 (float): the minimum flow as a fraction
+        s (float): the euclidean distance from the middle of a segment to the nearest perimeter; a NumPy array of
+            distances is mapped element-wise
+
+    Returns:
+        float: a multiplier for the modified extrusion value
+    """
+    (a1, a2), (b1, b2) = a, b
+
+    return b1 + ((s - a1) * (b2 - b1) / (a2 - a1))
+
+
+def scale_feed(feed: float, multiplier: float, settings: GradientSettings) -> float:
+    """Scale a feed rate inversely to a flow multiplier, for gradual speed.
+
+    Args:
+        feed (float): feed rate of the infill move
+        multiplier (float): flow multiplier of the infill move
+        settings (GradientSettings): gradient parameters with the over speed limits
+
+    Returns:
+        float: the scaled feed rate, between ``min_over_speed`` and ``max_over_speed`` percent of ``feed``
+    """
+    maxFeed = feed * settings.max_over_speed / 100
+    if multiplier <= 0:
+        return maxFeed
+    return min(max(feed / multiplier, feed * settings.min_over_speed / 100), maxFeed)
+
+
+def scale_feeds(feed: float, multipliers: Sequence[float], settings: GradientSettings) -> List[float]:
+    """Scale a feed rate with ``scale_feed`` for every flow multiplier of a NumPy array at once."""
+    multipliers = np.asarray(multipliers, dtype=float)
+    maxFeed = feed * settings.max_over_speed / 100
+    with np.errstate(divide="ignore"):
+        feeds = np.clip(feed / multipliers, feed * settings.min_over_speed / 100, maxFeed)
+    return np.where(multipliers <= 0, maxFeed, feeds).tolist()
+
+
+def speed_factor(multiplier: float, settings: GradientSettings) -> float:
+    """Return the factor ``scale_feed`` scales a feed rate with for a flow multiplier."""
+    if multiplier <= 0:
+        return settings.max_over_speed / 100
+    return min(max(1 / multiplier, settings.min_over_speed / 100), settings.max_over_speed / 100)
+
+
+def parse_profile_points(text: str) -> Tuple[Tuple[float, float], ...]:
+    """Parse the control points of ``GradientProfile.POINTS`` written like "0:0, 0.3:0.8, 1:1".
+
+    Args:
+        text (str): comma separated distance:position pairs, as fractions of the gradient thickness and of the way
+            from the maximum to the minimum flow
+
+    Returns:
+        Tuple[Tuple[float, float], ...]: control points sorted by distance
+
+    Raises:
+        ValueError: if a pair is malformed, outside 0..1 or fewer than two points are given
+    """
+    points = []
+    for pair in text.replace(" ", "").split(","):
+        distance, _, position = pair.partition(":")
+        point = (float(distance), float(position))
+        if not all(0 <= value <= 1 for value in point):
+            raise ValueError("profile point {} is outside 0..1".format(pair))
+        points.append(point)
+    if len(points) < 2:
+        raise ValueError("a gradient profile needs at least two control points")
+    return tuple(sorted(points))
+
+
+def profile_curve(profile: GradientProfile, points: Optional[Sequence[Tuple[float, float]]] = None) -> Callable:
+    """Return the shape of a gradient profile as a function of the relative distance to the walls.
+
+    Args:
+        profile (GradientProfile): shape of the gradient
+        points (Optional[Sequence[Tuple[float, float]]]): control points of ``GradientProfile.POINTS``
+
+    Returns:
+        Callable: function mapping a distance between 0 (at the walls) and 1 (at the gradient thickness) to the
+        position between the maximum (0) and the minimum flow (1)
+    """
+    if profile == GradientProfile.EXPONENTIAL:
+        return lambda t: (1 - math.exp(-PROFILE_EXPONENT * t)) / (1 - math.exp(-PROFILE_EXPONENT))
+    if profile == GradientProfile.SMOOTHSTEP:
+        return lambda t: t * t * (3 - 2 * t)
+    if profile == GradientProfile.POINTS:
+        if not points or len(points) < 2:
+            raise ValueError("GradientProfile.POINTS needs at least two profile_points")
+        points = sorted(points)
+        distances = [distance for distance, _ in points]
+
+        def interpolate(t: float) -> float:
+            index = bisect_right(distances, t)
+            if index == 0:
+                return points[0][1]
+            if index == len(points):
+                return points[-1][1]
+            (t1, f1), (t2, f2) = points[index - 1], points[index]
+            return f1 + (t - t1) * (f2 - f1) / (t2 - t1)
+
+        return interpolate
+    return lambda t: t
+
+
+class ProfileTable:
+    """Dense lookup table of the flow multipliers and feed rate factors of a gradient profile.
+
+    The profile is evaluated once at ``size`` distances evenly spaced between the walls and the gradient thickness,
+    every sample then costs a single lookup of the nearest entry, however complex the curve is.
+    """
+
+    def __init__(self, settings: GradientSettings, size: int = PROFILE_TABLE_SIZE):
+        """Compile the profile of ``settings`` into a table.
+
+        Args:
+            settings (GradientSettings): gradient parameters with the profile, the flows and the over speed limits
+            size (int): number of entries of the table
+        """
+        curve = profile_curve(settings.gradient_profile, settings.profile_points)
+        maxFlow = settings.max_flow / 100
+        minFlow = settings.min_flow / 100
+        self.size = size
+        self.scale = (size - 1) / settings.gradient_thickness
+        # flow multiplier and feed rate factor of each entry
+        self.entries = []
+        for index in range(size):
+            multiplier = maxFlow + (minFlow - maxFlow) * curve(index / (size - 1))
+            self.entries.append((multiplier, speed_factor(multiplier, settings)))
+        self.array = np.array(self.entries) if np is not None else None
+
+    def __len__(self) -> int:
+        """Number of entries, for the size estimate of ``LayerCache``."""
+        return self.size
+
+    def lookup(self, distance: float) -> Tuple[float, float]:
+        """Return the flow multiplier and the feed rate factor at ``distance`` from the walls."""
+        return self.entries[min(int(distance * self.scale + 0.5), self.size - 1)]
+
+    def lookup_all(self, distances: Sequence[float]) -> Tuple[List[float], List[float]]:
+        """Return the flow multipliers and the feed rate factors of all ``distances``, a NumPy array is vectorized."""
+        if self.array is not None and isinstance(distances, np.ndarray):
+            indices = np.minimum((distances * self.scale + 0.5).astype(np.intp), self.size - 1)
+            entries = self.array[indices]
+            return entries[:, 0].tolist(), entries[:, 1].tolist()
+        entries = [self.lookup(distance) for distance in distances]
+        return [multiplier for multiplier, _ in entries], [speed for _, speed in entries]
+
+
+def merge_pieces(
+    ends: Sequence[Point2D],
+    extrusions: Sequence[float],
+    multipliers: Sequence[float],
+    tolerance: float,
+    feeds: Optional[Sequence[float]] = None,
+) -> Tuple[List[Point2D], List[float], List[float]]:
+    """Merge consecutive pieces of a straight line whose flow multipliers differ by less than ``tolerance``.
+
+    A run of pieces is merged while every multiplier, and every feed rate when ``feeds`` are given, stays within
+    ``tolerance`` of the first piece of the run, the feed rates relative to it. The merged piece extrudes as much as
+    the pieces it replaces.
+
+    Args:
+        ends (Sequence[Point2D]): end points of the pieces
+        extrusions (Sequence[float]): extrusion of each piece before the gradient
+        multipliers (Sequence[float]): flow multiplier of each piece
+        tolerance (float): largest difference of the multipliers, and of the relative feed rates, of a merged run
+        feeds (Optional[Sequence[float]]): feed rate of each piece
+
+    Returns:
+        Tuple[List[Point2D], List[float], List[float]]: end points, extrusions before the gradient and mean flow
+        multipliers of the merged pieces
+    """
+    mergedEnds: List[Point2D] = []
+    mergedExtrusions: List[float] = []
+    scaledExtrusions: List[float] = []
+    runMultiplier = runFeed = 0.0
+    for index, (end, extrusion, multiplier) in enumerate(zip(ends, extrusions, multipliers)):
+        feed = None if feeds is None else feeds[index]
+        if (
+            mergedEnds
+            and abs(multiplier - runMultiplier) < tolerance
+            and (feed is None or abs(feed - runFeed) < tolerance * runFeed)
+        ):
+            mergedEnds[-1] = end
+            mergedExtrusions[-1] += extrusion
+            scaledExtrusions[-1] += extrusion * multiplier
+        else:
+            mergedEnds.append(end)
+            mergedExtrusions.append(extrusion)
+            scaledExtrusions.append(extrusion * multiplier)
+            runMultiplier = multiplier
+            runFeed = feed
+    mergedMultipliers = [
+        scaled / extrusion if extrusion else 0.0 for scaled, extrusion in zip(scaledExtrusions, mergedExtrusions)
+    ]
+    return mergedEnds, mergedExtrusions, mergedMultipliers
+
+
+def get_extrusion_command(x: float, y: float, extrusion: float, feed: Optional[float] = None) -> str:
+    """Format a gcode string from the X, Y coordinates and extrusion value.
+
+    Args:
+        x (float): X coordinate
+        y (float): Y coordinate
+        extrusion (float): Extrusion value
+        feed (Optional[float]): feed rate appended to the move, None for no F parameter
+
+    Returns:
+        str: Gcode line
+    """
+    if feed is None:
+        return EXTRUSION_COMMAND % (x, y, extrusion)
+    return EXTRUSION_FEED_COMMAND % (x, y, extrusion, feed)
+
+
+def get_extrusion_commands(
+    points: Sequence[Point2D], extrusions: Sequence[float], feeds: Optional[Sequence[float]] = None
+) -> str:
+    """Format the gcode of several consecutive extrusion moves with a single formatting operation.
+
+    Args:
+        points (Sequence[Point2D]): end points of the moves
+        extrusions (Sequence[float]): extrusion value of each move
+        feeds (Optional[Sequence[float]]): feed rate of each move, None for no F parameters
+
+    Returns:
+        str: Gcode lines
+    """
+    values = []
+    if feeds is None:
+        for point, extrusion in zip(points, extrusions):
+            values += (point.x, point.y, extrusion)
+        return (EXTRUSION_COMMAND * len(points)) % tuple(values)
+    for point, extrusion, feed in zip(points, extrusions, feeds):
+        values += (point.x, point.y, extrusion, feed)
+    return (EXTRUSION_FEED_COMMAND * len(points)) % tuple(values)
+
+
+def set_extrusion(line: str, extrusion: float, feed: Optional[float] = None) -> str:
+    """Replace the extrusion value of a gcode line.
+
+    Args:
+        line (str): Gcode line with an E parameter
+        extrusion (float): new extrusion value
+        feed (Optional[float]): feed rate inserted after the E parameter, None to keep the line without one
+
+    Returns:
+        str: Gcode line
+    """
+    value = EXTRUSION_FORMAT % extrusion if feed is None else (EXTRUSION_FORMAT + FEED_FORMAT) % (extrusion, feed)
+    head, separator, tail = line.partition(" E")
+    if not separator:
+        return EXTRUSION_PARAMETER.sub(value, line, 1)
+    return head + " E" + value + tail[len(tail.split(None, 1)[0]):]
+
+
+def is_begin_layer_line(line: str) -> bool:
+    """Check if current line is the start of a layer section.
+
+    Args:
+        line (str): Gcode line
+
+    Returns:
+        bool: True if the line is the start of a layer section
+    """
+    return line.startswith(";LAYER:")
+
+
+def is_begin_inner_wall_line(line: str) -> bool:
+    """Check if current line is the start of an inner wall section.
+
+    Args:
+        line (str): Gcode line
+
+    Returns:
+        bool: True if the line is the start of an inner wall section
+    """
+    return line.startswith(";TYPE:WALL-INNER")
+
+
+def is_end_inner_wall_line(line: str) -> bool:
+    """Check if current line is the start of an outer wall section.
+
+    Args:
+        line (str): Gcode line
+
+    Returns:
+        bool: True if the line is the start of an outer wall section
+    """
+    return line.startswith(";TYPE:WALL-OUTER")
+
+
+def is_extrusion_line(line: str) -> bool:
+    """Check if current line is a standard printing segment.
+
+    Args:
+        line (str): Gcode line
+
+    Returns:
+        bool: True if the line is a standard printing segment
+    """
+    return "G1" in line and " X" in line and "Y" in line and "E" in line
+
+
+def is_begin_infill_segment_line(line: str) -> bool:
+    """Check if current line is the start of an infill.
+
+    Args:
+        line (str): Gcode line
+
+    Returns:
+        bool: True if the line is the start of an infill section
+    """
+    return line.startswith(";TYPE:FILL")
+
+
+def parse_gcode_line(line: str) -> GcodeMove:
+    """Parse a gcode line in a single pass.
+
+    Only the parameters of G0 and G1 moves are parsed, other commands like firmware macros with ``EXTRUDER=``
+    arguments are passed through without parameters.
+
+    Args:
+        line (str): gcode line
+
+    Raises:
+        SyntaxError: when a X, Y, E or F parameter of a move is not a number
+
+    Returns:
+        GcodeMove: the command, the X, Y, E and F parameters (``None`` when missing) and the comment marker
+    """
+    code, semicolon, comment = line.partition(";")
+    if not semicolon:
+        marker = Marker.NONE
+    elif code:
+        marker = Marker.COMMENT
+    elif comment.startswith("LAYER:"):
+        marker = Marker.LAYER
+    elif comment.startswith("TYPE:WALL-INNER"):
+        marker = Marker.INNER_WALL
+    elif comment.startswith("TYPE:WALL-OUTER"):
+        marker = Marker.OUTER_WALL
+    elif comment.startswith("TYPE:FILL"):
+        marker = Marker.INFILL
+    else:
+        marker = Marker.COMMENT
+
+    words = code.split()
+    if not words:
+        return GcodeMove(None, None, None, None, None, marker)
+    if words[0] not in ("G0", "G1"):
+        return GcodeMove(words[0], None, None, None, None, marker)
+    x = y = e = f = None
+    try:
+        for word in words[1:]:
+            letter = word[0]
+            if letter == "X":
+                x = float(word[1:])
+            elif letter == "Y":
+                y = float(word[1:])
+            elif letter == "E":
+                e = float(word[1:])
+            elif letter == "F":
+                f = float(word[1:])
+    except ValueError:
+        raise SyntaxError(f'Gcode file parsing error for line {line}')
+
+    return GcodeMove(words[0], x, y, e, f, marker)
+
+
+def tokenize(lines: Iterable[str]) -> Iterator[Tuple[str, GcodeMove]]:
+    """Pair every line of ``lines`` with its parsed ``GcodeMove``.
+
+    Args:
+        lines (Iterable[str]): gcode lines
+
+    Yields:
+        Tuple[str, GcodeMove]: the line and its parsed content
+    """
+    for line in lines:
+        yield line, parse_gcode_line(line)
+
+
+def is_extrusion_move(move: GcodeMove) -> bool:
+    """Check if a parsed line is a standard printing segment.
+
+    Args:
+        move (GcodeMove): parsed gcode line
+
+    Returns:
+        bool: True if the line is a G1 move with X, Y and E parameters
+    """
+    return move.command == "G1" and move.x is not None and move.y is not None and move.e is not None
+
+
+# time, wall segments and distance evaluations of a single layer
+LayerStats = namedtuple('LayerStats', 'layer wall_segments distance_evaluations seconds')
+
+
+class ProcessingStats:
+    """Counters and timers of the processing loop.
+
+    ``parse_seconds`` covers the main loop, that is parsing the lines and running the state machine, without the
+    time spent building the wall geometry (``wall_seconds``), evaluating distances (``distance_seconds``) and
+    formatting the output (``emit_seconds``). Lines of sections that ``process_mapped`` copies without decoding are
+    not counted as read. The ``*_stall_seconds`` are the times the reader, the computation and the writer of
+    ``process_pipelined`` wait for each other.
+    """
+
+    def __init__(self):
+        """Start with all counters at zero."""
+        self.lines_read = 0
+        self.infill_moves_modified = 0
+        self.sub_segments = 0
+        self.lines_merged = 0
+        self.distance_evaluations = 0
+        self.distance_cache_hits = 0
+        self.distance_searches_skipped = 0
+        self.result_cache_hits = 0
+        self.max_wall_segments = 0
+        self.parse_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.distance_seconds = 0.0
+        self.emit_seconds = 0.0
+        self.read_stall_seconds = 0.0
+        self.compute_stall_seconds = 0.0
+        self.write_stall_seconds = 0.0
+        self.layers: List[LayerStats] = []
+
+    def add_layer(self, layer: LayerStats) -> None:
+        """Record the statistics of a finished layer."""
+        self.layers.append(layer)
+        self.max_wall_segments = max(self.max_wall_segments, layer.wall_segments)
+
+    def merge(self, other: "ProcessingStats") -> None:
+        """Add the counters and layers of ``other``, e.g. of a worker process, to these statistics."""
+        for name, value in vars(other).items():
+            if name == "layers":
+                self.layers.extend(value)
+            elif name == "max_wall_segments":
+                self.max_wall_segments = max(self.max_wall_segments, value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> dict:
+        """Return the statistics in a form that can be serialized as JSON."""
+        stats = {name: value for name, value in vars(self).items() if name != "layers"}
+        stats["layers"] = [layer._asdict() for layer in self.layers]
+        return stats
+
+
+# extrusion and flows of a layer of ``FlowAnalysis``, ``layer`` is None for the lines before the first layer
+LayerAnalysis = namedtuple(
+    'LayerAnalysis', 'layer flow_histogram extrusion infill_extrusion gradient_extrusion sub_segments'
+)
+
+
+class FlowAnalysis:
+    """Flows and extrusion of the infill moves a run would write, collected by a dry run instead of the gcode.
+
+    ``extrusion`` sums the E values of all moves of the original gcode and ``infill_extrusion`` those of the infill
+    moves, ``gradient_extrusion`` is the E the infill moves would extrude with the gradient. The flow histogram counts
+    the moves the gradient would generate or modify, in bins of ``bin_width`` percent; infill moves that are kept
+    unchanged only add their extrusion. ``sub_segments`` counts the pieces of the split infill moves like
+    ``ProcessingStats.sub_segments``, moves that only get a new flow are not counted.
+    """
+
+    def __init__(self, bin_width: float = FLOW_HISTOGRAM_BIN):
+        """Start with an empty analysis.
+
+        Args:
+            bin_width (float): width of the bins of the flow histograms in percent
+        """
+        self.bin_width = bin_width
+        self.layers: List[LayerAnalysis] = []
+        self.histogram: Dict[float, int] = defaultdict(int)
+        self.extrusion = 0.0
+        self.infill_extrusion = 0.0
+        self.gradient_extrusion = 0.0
+        self.sub_segments = 0
+
+    def add(self, multiplier: float, extrusion: float) -> None:
+        """Record a generated or modified infill move with the flow ``multiplier`` that extrudes ``extrusion``."""
+        self.histogram[math.floor(multiplier * 100 / self.bin_width) * self.bin_width] += 1
+        self.gradient_extrusion += extrusion
+
+    def keep(self, extrusion: float) -> None:
+        """Record an infill move that is written unchanged."""
+        self.gradient_extrusion += extrusion
+
+    def end_layer(self, layer: Optional[int]) -> None:
+        """Record the current layer, if anything was extruded, and start the next one."""
+        if self.extrusion or self.sub_segments:
+            self.layers.append(LayerAnalysis(
+                layer,
+                dict(sorted(self.histogram.items())),
+                self.extrusion,
+                self.infill_extrusion,
+                self.gradient_extrusion,
+                self.sub_segments,
+            ))
+        self.histogram = defaultdict(int)
+        self.extrusion = self.infill_extrusion = self.gradient_extrusion = 0.0
+        self.sub_segments = 0
+
+    def layer_dict(self, layer: LayerAnalysis) -> dict:
+        """Return ``layer`` in a form that can be serialized as JSON, with the extra extrusion of the gradient."""
+        extra = layer.gradient_extrusion - layer.infill_extrusion
+        return {
+            "layer": layer.layer,
+            "flow_histogram": {
+                "{:g}-{:g}".format(flow, flow + self.bin_width): count for flow, count in layer.flow_histogram.items()
+            },
+            "extrusion": round(layer.extrusion, 5),
+            "infill_extrusion": round(layer.infill_extrusion, 5),
+            "gradient_extrusion": round(layer.gradient_extrusion, 5),
+            "extra_extrusion": round(extra, 5),
+            "extra_percent": round(100 * extra / layer.extrusion, 3) if layer.extrusion > 0 else 0.0,
+            "sub_segments": layer.sub_segments,
+        }
+
+    def as_dict(self) -> dict:
+        """Return the totals of all layers and the layers in a form that can be serialized as JSON."""
+        histogram: Dict[float, int] = defaultdict(int)
+        for layer in self.layers:
+            for flow, count in layer.flow_histogram.items():
+                histogram[flow] += count
+        total = LayerAnalysis(
+            None,
+            dict(sorted(histogram.items())),
+            sum(layer.extrusion for layer in self.layers),
+            sum(layer.infill_extrusion for layer in self.layers),
+            sum(layer.gradient_extrusion for layer in self.layers),
+            sum(layer.sub_segments for layer in self.layers),
+        )
+        overall = self.layer_dict(total)
+        del overall["layer"]
+        return {"total": overall, "layers": [self.layer_dict(layer) for layer in self.layers]}
+
+
+class NullOutput:
+    """Output file of a dry run that drops everything written to it."""
+
+    def write(self, data: str) -> int:
+        """Drop ``data``."""
+        return len(data)
+
+
+def wall_digest(walls: Sequence[float]) -> bytes:
+    """Hash the set of wall segments of a layer, a flat buffer of x1, y1, x2, y2 values, independent of their order."""
+    return hashlib.blake2b(array("d", chain.from_iterable(sorted(zip(*[iter(walls)] * 4))))).digest()
+
+
+def samples_digest(samplesX: Sequence[float], samplesY: Sequence[float]) -> bytes:
+    """Hash the coordinates of the samples of an infill batch."""
+    digest = hashlib.blake2b(array("d", samplesX))
+    digest.update(array("d", samplesY))
+    return digest.digest()
+
+
+class LayerCache:
+    """Least recently used cache of the wall geometry of layers and of the distances evaluated against it.
+
+    Prismatic parts repeat the same walls, and often the same infill, for many layers. Entries are keyed by the
+    digests of the walls and samples, and the least recently used ones are evicted once the approximate size of all
+    entries exceeds ``max_size`` bytes. Every entry is charged ``LAYER_CACHE_ENTRY_SIZE`` on top of its value, so
+    many small values, like the empty band intervals of ``InfillBatch.add_band_move``, are bounded as well.
+    """
+
+    def __init__(self, max_size: int = LAYER_CACHE_SIZE):
+        """Create an empty cache.
+
+        Args:
+            max_size (int): approximate number of bytes kept, 0 disables the cache
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.entries: "OrderedDict[Hashable, Tuple[object, int]]" = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Check whether a value is cached for ``key``."""
+        return key in self.entries
+
+    def get(self, key: Hashable, create: Callable[[], object]) -> object:
+        """Return the value cached for ``key``, or create and cache it.
+
+        Args:
+            key (Hashable): key of the value
+            create (Callable[[], object]): function creating the value when it is not cached
+
+        Returns:
+            object: the cached or created value
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry[0]
+
+        value = create()
+        size = LAYER_CACHE_ENTRY_SIZE + (value.nbytes if hasattr(value, "nbytes") else 32 * len(value))
+        if size <= self.max_size:
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self.entries.popitem(last=False)[1][1]
+        return value
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self.entries.clear()
+        self.size = 0
+
+
+# cache shared by all ``GradientProcessor`` instances of a process, including the workers of the parallel mode
+LAYER_CACHE = LayerCache()
+
+
+class InfillBatch:
+    """Infill section collected for a single batched distance evaluation.
+
+    Lines written to the batch are kept in order. Infill moves keep the index of their samples and are formatted once
+    the distances of all samples of the section are known.
+    """
+
+    def __init__(
+        self,
+        perimeterSegments: Sequence[float],
+        settings: GradientSettings,
+        layer_cache: Optional[LayerCache] = None,
+        stats: Optional[ProcessingStats] = None,
+        analysis: Optional[FlowAnalysis] = None,
+    ):
+        """Prepare the wall geometry of the layer for the engine of ``settings``.
+
+        Args:
+            perimeterSegments (Sequence[float]): wall segments of the layer as a flat buffer of x1, y1, x2, y2 values
+            settings (GradientSettings): gradient parameters
+            layer_cache (Optional[LayerCache]): cache of the geometry and distances, defaults to ``LAYER_CACHE``
+            stats (Optional[ProcessingStats]): statistics the work of the batch is added to
+            analysis (Optional[FlowAnalysis]): analysis the infill moves are recorded in instead of being written
+        """
+        start = time.perf_counter()
+        self.stats = stats if stats is not None else ProcessingStats()
+        self.analysis = analysis
+        self.settings = settings
+        self.engine = resolve_engine(settings.engine)
+        self.gradient_thickness = settings.gradient_thickness
+        self.max_flow = settings.max_flow
+        self.min_flow = settings.min_flow
+        self.layer_cache = layer_cache if layer_cache is not None else LAYER_CACHE
+        self.geometryKey = (
+            wall_digest(perimeterSegments),
+            self.engine,
+            settings.gradient_thickness,
+            settings.field_resolution,
+        )
+        self.perimeter = self.layer_cache.get(
+            self.geometryKey, lambda: self.build_perimeter(perimeterSegments, settings)
+        )
+        # the linear profile keeps its closed form, the other profiles are compiled into a table once per settings
+        self.profile: Optional[ProfileTable] = None
+        if settings.gradient_profile != GradientProfile.LINEAR:
+            self.profile = self.layer_cache.get(
+                (
+                    settings.gradient_profile,
+                    settings.profile_points,
+                    settings.max_flow,
+                    settings.min_flow,
+                    settings.gradient_thickness,
+                    settings.max_over_speed,
+                    settings.min_over_speed,
+                ),
+                lambda: ProfileTable(settings),
+            )
+        self.items: List[Union[str, SegmentMove, LinearMove, BandMove]] = []
+        self.samplesX: List[float] = []
+        self.samplesY: List[float] = []
+        self.stats.wall_seconds += time.perf_counter() - start
+
+    def build_perimeter(
+        self, perimeterSegments: Sequence[float], settings: GradientSettings
+    ) -> Union[DistanceField, WallHierarchy]:
+        """Build the structure the engine queries for the distances to ``perimeterSegments``."""
+        if self.engine == Engine.NUMPY:
+            return WallHierarchy(perimeterSegments, settings.gradient_thickness, NUMPY_LEAF_SEGMENTS, vectorized=True)
+        if self.engine == Engine.DISTANCE_FIELD:
+            return DistanceField(
+                np.array(perimeterSegments, dtype=float).reshape(-1, 2, 2),
+                settings.gradient_thickness,
+                settings.field_resolution,
+            )
+        return WallHierarchy(perimeterSegments, settings.gradient_thickness)
+
+    def write(self, line: str) -> None:
+        """Queue a line that is written unchanged, a dry run drops it."""
+        if self.analysis is None:
+            self.items.append(line)
+
+    def add_fixed_move(self, line: str, extrusion: float, flow: float) -> None:
+        """Queue an infill move whose extrusion is scaled with a fixed ``flow`` in percent."""
+        if self.analysis is None:
+            self.items.append(set_extrusion(line, extrusion * flow / 100))
+        else:
+            self.analysis.add(flow / 100, extrusion * flow / 100)
+
+    def add_sample(self, segment: Segment) -> int:
+        """Queue the midpoint of ``segment`` for the distance evaluation and return its index."""
+        self.samplesX.append((segment.point1.x + segment.point2.x) / 2)
+        self.samplesY.append((segment.point1.y + segment.point2.y) / 2)
+        return len(self.samplesX) - 1
+
+    def add_segment_move(self, line: str, extrusion: float, segment: Segment, feed: Optional[float] = None) -> None:
+        """Queue a small infill segment whose extrusion, and ``feed`` when given, is scaled as a whole."""
+        self.items.append(SegmentMove(line, extrusion, self.add_sample(segment), feed))
+
+    def add_linear_move(
+        self,
+        start: Point2D,
+        ends: List[Point2D],
+        extrusionLengthPerSegment: float,
+        lastEnd: Point2D,
+        lastExtrusion: float,
+        feed: Optional[float] = None,
+    ) -> None:
+        """Queue a linear infill line subdivided at ``ends``, followed by a move to ``lastEnd`` for the missing segment.
+
+        The missing segment extrudes ``lastExtrusion`` at the maximum flow. The sub-segments get a feed rate scaled
+        from ``feed`` when it is given, the missing segment the feed rate of the maximum flow.
+        """
+        sample = len(self.samplesX)
+        for end in ends:
+            self.add_sample(Segment(start, end))
+            start = end
+        lastFeed = None if feed is None else scale_feed(feed, self.max_flow / 100, self.settings)
+        self.items.append(LinearMove(ends, extrusionLengthPerSegment, sample, feed, lastEnd, lastExtrusion, lastFeed))
+
+    def add_band_move(
+        self, start: Point2D, end: Point2D, extrusion: float, stepLength: float, feed: Optional[float] = None
+    ) -> None:
+        """Queue a linear infill line that is only subdivided where it is closer than the gradient thickness to a wall.
+
+        The parts of the line inside the gradient band are found exactly with ``band_intervals``, or taken from the
+        layer cache, and cut into pieces no longer than ``stepLength``, each with a sample for the distance
+        evaluation. Every part outside the band becomes a single move with the minimum flow.
+
+        Args:
+            start (Point2D): start of the line
+            end (Point2D): end of the line
+            extrusion (float): extrusion of the whole line
+            stepLength (float): maximum length of the pieces inside the band
+            feed (Optional[float]): feed rate the pieces are scaled from, None to keep the feed rate
+        """
+        begin = time.perf_counter()
+        box = BoundingBox(min(start.x, end.x), min(start.y, end.y), max(start.x, end.x), max(start.y, end.y))
+        # identical layers repeat the same lines, like the samples of ``distances``
+        intervals = self.layer_cache.get(
+            (self.geometryKey, start, end),
+            lambda: band_intervals(start, end, self.perimeter.segments_near(box), self.gradient_thickness),
+        )
+        self.stats.distance_seconds += time.perf_counter() - begin
+
+        length = get_points_distance(start, end)
+        dx = end.x - start.x
+        dy = end.y - start.y
+        ends: List[Point2D] = []
+        extrusions: List[float] = []
+        samples: List[Optional[int]] = []
+        previous = 0.0
+        pieceStart = start
+        for low, high in intervals:
+            if low > previous:
+                pieceStart = Point2D(start.x + dx * low, start.y + dy * low)
+                ends.append(pieceStart)
+                extrusions.append(extrusion * (low - previous))
+                samples.append(None)
+            steps = max(1, math.ceil((high - low) * length / stepLength))
+            for step in range(1, steps + 1):
+                t = low + (high - low) * step / steps
+                pieceEnd = end if t >= 1 else Point2D(start.x + dx * t, start.y + dy * t)
+                ends.append(pieceEnd)
+                extrusions.append(extrusion * (high - low) / steps)
+                samples.append(self.add_sample(Segment(pieceStart, pieceEnd)))
+                pieceStart = pieceEnd
+            previous = high
+        if previous < 1:
+            ends.append(end)
+            extrusions.append(extrusion * (1 - previous))
+            samples.append(None)
+        self.items.append(BandMove(ends, extrusions, samples, feed))
+
+    def distances(self) -> Sequence[float]:
+        """Return the distances of all samples to the nearest wall, reusing the distances of an identical batch."""
+        start = time.perf_counter()
+        key = (self.geometryKey, samples_digest(self.samplesX, self.samplesY))
+        if key in self.layer_cache:
+            self.stats.distance_cache_hits += len(self.samplesX)
+        else:
+            self.stats.distance_evaluations += len(self.samplesX)
+        distances = self.layer_cache.get(key, self.evaluate_distances)
+        self.stats.distance_seconds += time.perf_counter() - start
+        return distances
+
+    def evaluate_distances(self) -> Sequence[float]:
+        """Calculate the distances of all samples to the nearest wall, capped at the gradient thickness."""
+        if self.engine == Engine.NUMPY:
+            return self.perimeter.min_distances(self.samplesX, self.samplesY)
+        if self.engine == Engine.DISTANCE_FIELD:
+            return self.perimeter.lookup(self.samplesX, self.samplesY)
+        skipped = self.perimeter.skipped
+        distances = [self.perimeter.min_distance(Point2D(x, y)) for x, y in zip(self.samplesX, self.samplesY)]
+        self.stats.distance_searches_skipped += self.perimeter.skipped - skipped
+        return distances
+
+    def merge_pieces(
+        self,
+        ends: Sequence[Point2D],
+        extrusions: Sequence[float],
+        multipliers: Sequence[float],
+        feed: Optional[float],
+        speeds: Optional[Sequence[float]] = None,
+    ) -> Tuple[Sequence[Point2D], Sequence[float], Sequence[float], Optional[List[float]]]:
+        """Merge the pieces of a subdivided linear infill line with ``merge_pieces``.
+
+        Args:
+            ends (Sequence[Point2D]): end points of the pieces
+            extrusions (Sequence[float]): extrusion of each piece before the gradient
+            multipliers (Sequence[float]): flow multiplier of each piece
+            feed (Optional[float]): feed rate the pieces are scaled from, None for no F parameters
+            speeds (Optional[Sequence[float]]): feed rate factor of each piece from a ``ProfileTable``, None to scale
+                the feed rate with ``scale_feed``
+
+        Returns:
+            Tuple[Sequence[Point2D], Sequence[float], Sequence[float], Optional[List[float]]]: end points, extrusions
+            before the gradient, flow multipliers and feed rates of the remaining pieces
+        """
+        settings = self.settings
+        if feed is None:
+            feeds = None
+        elif speeds is not None:
+            feeds = [feed * speed for speed in speeds]
+        else:
+            feeds = self.scale_feeds(feed, multipliers)
+        if settings.merge_tolerance > 0:
+            count = len(ends)
+            ends, extrusions, multipliers = merge_pieces(
+                ends, extrusions, multipliers, settings.merge_tolerance / 100, feeds
+            )
+            self.stats.lines_merged += count - len(ends)
+            if feeds is not None:
+                feeds = self.scale_feeds(feed, multipliers)
+        return ends, extrusions, multipliers, feeds
+
+    def scale_feeds(self, feed: float, multipliers: Sequence[float]) -> List[float]:
+        """Scale ``feed`` with ``scale_feed`` for each of ``multipliers``, on an array for the NumPy engine."""
+        if self.engine != Engine.PYTHON:
+            return scale_feeds(feed, multipliers, self.settings)
+        return [scale_feed(feed, multiplier, self.settings) for multiplier in multipliers]
+
+    def format_pieces(
+        self,
+        ends: Sequence[Point2D],
+        extrusions: Sequence[float],
+        multipliers: Sequence[float],
+        feed: Optional[float],
+        speeds: Optional[Sequence[float]] = None,
+    ) -> str:
+        """Format the pieces of a subdivided linear infill line, merged with ``merge_pieces``.
+
+        Args:
+            ends (Sequence[Point2D]): end points of the pieces
+            extrusions (Sequence[float]): extrusion of each piece before the gradient
+            multipliers (Sequence[float]): flow multiplier of each piece
+            feed (Optional[float]): feed rate the pieces are scaled from, None for no F parameters
+            speeds (Optional[Sequence[float]]): feed rate factor of each piece, None to use ``scale_feed``
+
+        Returns:
+            str: Gcode lines
+        """
+        ends, extrusions, multipliers, feeds = self.merge_pieces(ends, extrusions, multipliers, feed, speeds)
+        return get_extrusion_commands(
+            ends, [extrusion * multiplier for extrusion, multiplier in zip(extrusions, multipliers)], feeds
+        )
+
+    def analyze_pieces(
+        self,
+        ends: Sequence[Point2D],
+        extrusions: Sequence[float],
+        multipliers: Sequence[float],
+        feed: Optional[float],
+        speeds: Optional[Sequence[float]] = None,
+    ) -> None:
+        """Record the pieces ``format_pieces`` would write in the analysis."""
+        _, extrusions, multipliers, _ = self.merge_pieces(ends, extrusions, multipliers, feed, speeds)
+        for extrusion, multiplier in zip(extrusions, multipliers):
+            self.analysis.add(multiplier, extrusion * multiplier)
+
+    def flush(self, outputFile: TextIO) -> None:
+        """Evaluate all samples, write the queued lines to ``outputFile`` at once and empty the batch.
+
+        A dry run records the infill moves in the analysis and writes nothing.
+        """
+        distances = self.distances()
+        start = time.perf_counter()
+        settings = self.settings
+        # feed rate factors of the samples and of the pieces outside the gradient, only for a ``ProfileTable``
+        speeds = None
+        if self.profile is not None:
+            multipliers, speeds = self.profile.lookup_all(distances)
+            outsideSpeed = speed_factor(self.min_flow / 100, settings)
+            if self.engine != Engine.PYTHON:
+                distances = distances.tolist()
+        elif self.engine != Engine.PYTHON:
+            ranges = (0, self.gradient_thickness), (self.max_flow / 100, self.min_flow / 100)
+            multipliers = mapRange(*ranges, distances).tolist()
+            distances = distances.tolist()
+        else:
+            ranges = (0, self.gradient_thickness), (self.max_flow / 100, self.min_flow / 100)
+            multipliers = [mapRange(*ranges, shortestDistance) for shortestDistance in distances]
+
+        gradient_thickness = self.gradient_thickness
+        analysis = self.analysis
+        output = []
+        modified = 0
+        subSegments = 0
+        for item in self.items:
+            if isinstance(item, LinearMove):
+                modified += 1
+                subSegments += len(item.ends)
+                pieceMultipliers = [
+                    multipliers[sample] if distances[sample] < gradient_thickness else self.min_flow / 100
+                    for sample in range(item.sample, item.sample + len(item.ends))
+                ]
+                pieceSpeeds = None
+                if speeds is not None and item.feed is not None:
+                    pieceSpeeds = [
+                        speeds[sample] if distances[sample] < gradient_thickness else outsideSpeed
+                        for sample in range(item.sample, item.sample + len(item.ends))
+                    ]
+                extrusions = [item.extrusion] * len(item.ends)
+                if analysis is None:
+                    output.append(self.format_pieces(item.ends, extrusions, pieceMultipliers, item.feed, pieceSpeeds))
+                    output.append(
+                        get_extrusion_command(item.lastEnd.x, item.lastEnd.y, item.lastExtrusion, item.lastFeed)
+                    )
+                else:
+                    self.analyze_pieces(item.ends, extrusions, pieceMultipliers, item.feed, pieceSpeeds)
+                    analysis.add(self.max_flow / 100, item.lastExtrusion)
+                    analysis.sub_segments += len(item.ends)
+            elif isinstance(item, BandMove):
+                modified += 1
+                subSegments += len(item.ends)
+                pieceMultipliers = [
+                    multipliers[sample]
+                    if sample is not None and distances[sample] < gradient_thickness
+                    else self.min_flow / 100
+                    for sample in item.samples
+                ]
+                pieceSpeeds = None
+                if speeds is not None and item.feed is not None:
+                    pieceSpeeds = [
+                        speeds[sample]
+                        if sample is not None and distances[sample] < gradient_thickness
+                        else outsideSpeed
+                        for sample in item.samples
+                    ]
+                if analysis is None:
+                    output.append(
+                        self.format_pieces(item.ends, item.extrusions, pieceMultipliers, item.feed, pieceSpeeds)
+                    )
+                else:
+                    self.analyze_pieces(item.ends, item.extrusions, pieceMultipliers, item.feed, pieceSpeeds)
+                    analysis.sub_segments += len(item.ends)
+            elif isinstance(item, SegmentMove):
+                if analysis is not None:
+                    if distances[item.sample] < gradient_thickness:
+                        modified += 1
+                        multiplier = multipliers[item.sample]
+                        analysis.add(multiplier, item.extrusion * multiplier)
+                    else:
+                        analysis.keep(item.extrusion)
+                elif distances[item.sample] < gradient_thickness:
+                    modified += 1
+                    multiplier = multipliers[item.sample]
+                    if item.feed is None:
+                        feed = None
+                    elif speeds is not None:
+                        feed = item.feed * speeds[item.sample]
+                    else:
+                        feed = scale_feed(item.feed, multiplier, settings)
+                    output.append(set_extrusion(item.line, item.extrusion * multiplier, feed))
+                else:
+                    output.append(item.line)
+            else:
+                output.append(item)
+        if output:
+            outputFile.write("".join(output))
+
+        self.stats.infill_moves_modified += modified
+        self.stats.sub_segments += subSegments
+        self.stats.emit_seconds += time.perf_counter() - start
+        self.items = []
+        self.samplesX = []
+        self.samplesY = []
+
+
+class GradientProcessor:
+    """Gradient infill state machine that can be fed the gcode in consecutive pieces.
+
+    The walls of the current layer and the pending infill are kept between calls to ``process``, so the pieces may
+    be cut anywhere. Pending infill is written when its section ends, when ``max_batch_lines`` lines are queued or
+    when ``finish`` is called.
+    """
+
+    def __init__(
+        self,
+        settings: GradientSettings,
+        state: LayerState = INITIAL_STATE,
+        max_batch_lines: int = MAX_BATCH_LINES,
+        layer_cache: Optional[LayerCache] = None,
+        stats: Optional[ProcessingStats] = None,
+        analysis: Optional[FlowAnalysis] = None,
+    ):
+        """Start processing.
+
+        Args:
+            settings (GradientSettings): gradient parameters
+            state (LayerState): state before the first line
+            max_batch_lines (int): maximum number of infill lines queued for a batched distance evaluation
+            layer_cache (Optional[LayerCache]): cache of the geometry and distances, defaults to ``LAYER_CACHE``
+            stats (Optional[ProcessingStats]): statistics the work is added to
+            analysis (Optional[FlowAnalysis]): analysis of a dry run the infill moves are recorded in, the
+                modified infill is then not written
+        """
+        self.settings = settings
+        self.layer_cache = layer_cache
+        self.stats = stats if stats is not None else ProcessingStats()
+        self.analysis = analysis
+        # number, processing time and distance evaluations at the start of the current layer
+        self.layer: Optional[int] = None
+        self.layerSeconds = 0.0
+        self.layerEvaluations = 0
+        self.currentSection, self.lastPosition, self.currentFeed = state
+        self.max_batch_lines = max_batch_lines
+        # section whose extrusion moves are the walls the distances are measured to
+        self.wallSection = Section.OUTER_WALL if settings.use_outer_wall else Section.INNER_WALL
+        # wall segments of the current layer as x1, y1, x2, y2 values, the buffer is emptied and reused every layer
+        self.perimeterSegments = array("d")
+        self.infillBatch: Optional[InfillBatch] = None
+
+    @property
+    def state(self) -> LayerState:
+        """State after the lines processed so far."""
+        return LayerState(self.currentSection, self.lastPosition, self.currentFeed)
+
+    def process(self, lines: Iterable[str], outputFile: TextIO) -> None:
+        """Modify the infill portions of ``lines`` with an extrusion width gradient and write them to ``outputFile``.
+
+        Args:
+            lines (Iterable[str]): gcode lines
+            outputFile (TextIO): file the modified lines are written to
+        """
+        settings = self.settings
+        stats = self.stats
+        analysis = self.analysis
+        currentSection, lastPosition, currentFeed = self.currentSection, self.lastPosition, self.currentFeed
+        perimeterSegments = self.perimeterSegments
+        infillBatch = self.infillBatch
+        gradient_thickness = settings.gradient_thickness
+        gradientDiscretizationLength = gradient_thickness / settings.gradient_discretization
+        wallSection = self.wallSection
+        shortDistanceFlow = settings.max_flow if settings.short_distance_flow is None else settings.short_distance_flow
+        start = layerStart = time.perf_counter()
+        workSeconds = stats.wall_seconds + stats.distance_seconds + stats.emit_seconds
+        linesRead = 0
+
+        for currentLine, move in tokenize(lines):
+            linesRead += 1
+            writtenToFile = 0
+            if analysis is not None and move.e is not None and move.command in ("G0", "G1"):
+                analysis.extrusion += move.e
+            if move.marker == Marker.LAYER:
+                if infillBatch is not None:
+                    # the marker ends the infill section, its distances are evaluated as part of the finished layer
+                    infillBatch.flush(outputFile)
+                    infillBatch = None
+                    currentSection = Section.NOTHING
+                now = time.perf_counter()
+                self.layerSeconds += now - layerStart
+                layerStart = now
+                self.end_layer(len(perimeterSegments) // 4)
+                self.layer = int(currentLine.strip()[len(";LAYER:"):])
+                del perimeterSegments[:]
+
+            if move.marker == Marker.INNER_WALL:
+                currentSection = Section.INNER_WALL
+            elif move.marker == Marker.OUTER_WALL:
+                currentSection = Section.OUTER_WALL
+
+            if currentSection == wallSection and is_extrusion_move(move):
+                perimeterSegments.extend((move.x, move.y, lastPosition.x, lastPosition.y))
+
+            if move.marker == Marker.INFILL:
+                if infillBatch is not None:
+                    infillBatch.flush(outputFile)
+                currentSection = Section.INFILL
+                infillBatch = InfillBatch(perimeterSegments, settings, self.layer_cache, stats, analysis)
+                outputFile.write(currentLine)
+                continue
+
+            if currentSection == Section.INFILL:
+                if move.command == "G1" and move.f is not None:
+                    infillBatch.write("G1 F{:g}\n".format(move.f))
+                if is_extrusion_move(move):
+                    currentPosition = Point2D(move.x, move.y)
+                    if analysis is not None:
+                        analysis.infill_extrusion += move.e
+                    # feed rate of the move, scaled with its flow when gradual speed is on
+                    feed = None
+                    if settings.gradual_speed:
+                        feed = move.f if move.f is not None else currentFeed
+
+                    if settings.infill_type == InfillType.LINEAR:
+                        extrusionLength = move.e
+                        segmentLength = get_points_distance(lastPosition, currentPosition)
+                        segmentSteps = segmentLength / gradientDiscretizationLength
+                        extrusionLengthPerSegment = extrusionLength / segmentSteps
+                        segmentDirection = Point2D(
+                            (currentPosition.x - lastPosition.x) / segmentLength * gradientDiscretizationLength,
+                            (currentPosition.y - lastPosition.y) / segmentLength * gradientDiscretizationLength,
+                        )
+                        if segmentSteps >= 2 and settings.analytic_linear:
+                            infillBatch.add_band_move(
+                                lastPosition, currentPosition, extrusionLength, gradientDiscretizationLength, feed
+                            )
+                        elif segmentSteps >= 2:
+                            segmentStart = lastPosition
+                            segmentEnds = []
+                            for step in range(int(segmentSteps)):
+                                segmentEnd = Point2D(
+                                    lastPosition.x + segmentDirection.x, lastPosition.y + segmentDirection.y
+                                )
+                                segmentEnds.append(segmentEnd)
+                                lastPosition = segmentEnd
+                            # MissingSegment
+                            segmentLengthRatio = get_points_distance(lastPosition, currentPosition) / segmentLength
+
+                            infillBatch.add_linear_move(
+                                segmentStart,
+                                segmentEnds,
+                                extrusionLengthPerSegment,
+                                currentPosition,
+                                segmentLengthRatio * extrusionLength * settings.max_flow / 100,
+                                feed,
+                            )
+                        else:
+                            infillBatch.add_fixed_move(currentLine, extrusionLength, shortDistanceFlow)
+                            stats.infill_moves_modified += 1
+                        writtenToFile = 1
+
+                    # gyroid or honeycomb
+                    if settings.infill_type == InfillType.SMALL_SEGMENTS:
+                        # a move with its own F parameter keeps it
+                        infillBatch.add_segment_move(
+                            currentLine,
+                            move.e,
+                            Segment(lastPosition, currentPosition),
+                            feed if move.f is None else None,
+                        )
+                        writtenToFile = 1
+                if move.marker != Marker.NONE:
+                    currentSection = Section.NOTHING
+
+            # line with move
+            if move.command in ("G0", "G1") and move.x is not None and move.y is not None:
+                lastPosition = Point2D(move.x, move.y)
+            if move.command == "G1" and move.f is not None:
+                currentFeed = move.f
+
+            # write uneditedLine
+            if writtenToFile == 0:
+                (outputFile if infillBatch is None else infillBatch).write(currentLine)
+
+            if infillBatch is not None:
+                if currentSection != Section.INFILL:
+                    infillBatch.flush(outputFile)
+                    infillBatch = None
+                elif len(infillBatch.items) >= self.max_batch_lines:
+                    infillBatch.flush(outputFile)
+
+        self.currentSection, self.lastPosition, self.currentFeed = currentSection, lastPosition, currentFeed
+        self.perimeterSegments = perimeterSegments
+        self.infillBatch = infillBatch
+
+        now = time.perf_counter()
+        self.layerSeconds += now - layerStart
+        stats.lines_read += linesRead
+        workSeconds = stats.wall_seconds + stats.distance_seconds + stats.emit_seconds - workSeconds
+        stats.parse_seconds += now - start - workSeconds
+
+    def end_layer(self, wallSegments: int) -> None:
+        """Record the statistics of the current layer and start the next one."""
+        if self.layer is not None:
+            evaluations = self.stats.distance_evaluations + self.stats.distance_cache_hits
+            self.stats.add_layer(
+                LayerStats(self.layer, wallSegments, evaluations - self.layerEvaluations, round(self.layerSeconds, 6))
+            )
+        self.layerSeconds = 0.0
+        self.layerEvaluations = self.stats.distance_evaluations + self.stats.distance_cache_hits
+        if self.analysis is not None:
+            self.analysis.end_layer(self.layer)
+
+    def flush(self, outputFile: TextIO) -> None:
+        """Write the pending infill to ``outputFile``, the infill section stays open for the next lines."""
+        if self.infillBatch is not None:
+            start = time.perf_counter()
+            self.infillBatch.flush(outputFile)
+            self.layerSeconds += time.perf_counter() - start
+
+    def finish(self, outputFile: TextIO) -> None:
+        """Write the pending infill to ``outputFile`` at the end of the gcode and record the last layer."""
+        self.flush(outputFile)
+        self.infillBatch = None
+        self.end_layer(len(self.perimeterSegments) // 4)
+        self.layer = None
+
+
+def process_lines(
+    lines: Iterable[str],
+    outputFile: TextIO,
+    settings: GradientSettings,
+    state: LayerState,
+    stats: Optional[ProcessingStats] = None,
+) -> LayerState:
+    """Modify the infill portions of ``lines`` with an extrusion width gradient and write them to ``outputFile``.
+
+    Args:
+        lines (Iterable[str]): gcode lines
+        outputFile (TextIO): file the modified lines are written to
+        settings (GradientSettings): gradient parameters
+        state (LayerState): state before the first line
+        stats (Optional[ProcessingStats]): statistics the work is added to
+
+    Returns:
+        LayerState: state after the last line
+    """
+    processor = GradientProcessor(settings, state, stats=stats)
+    processor.process(lines, outputFile)
+    processor.finish(outputFile)
+    return processor.state
+
+
+def transform_layers(
+    layers: Iterable[Union[str, List[str]]],
+    settings: GradientSettings,
+    state: LayerState = INITIAL_STATE,
+    max_batch_lines: int = MAX_BATCH_LINES,
+    stats: Optional[ProcessingStats] = None,
+) -> Iterator[str]:
+    """Transform stage of the streaming pipeline: yield the modified gcode of each layer.
+
+    Args:
+        layers (Iterable[Union[str, List[str]]]): layers as lists of lines, or as strings holding several lines like
+            the layers Cura hands to post processing scripts
+        settings (GradientSettings): gradient parameters
+        state (LayerState): state before the first layer
+        max_batch_lines (int): maximum number of infill lines queued for a batched distance evaluation
+        stats (Optional[ProcessingStats]): statistics the work is added to
+
+    Yields:
+        str: modified gcode of each layer
+    """
+    processor = GradientProcessor(settings, state, max_batch_lines, stats=stats)
+    for layer in layers:
+        if isinstance(layer, str):
+            layer = layer.splitlines(keepends=True)
+        outputFile = io.StringIO()
+        processor.process(layer, outputFile)
+        processor.flush(outputFile)
+        yield outputFile.getvalue()
+    processor.finish(io.StringIO())
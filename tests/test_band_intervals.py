@@ -0,0 +1,62 @@
+"""Tests of ``band_intervals`` against a brute-force sampling of the distances along the line."""
+import os.path
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gradientInfillEngine import Point2D, Segment, band_intervals, dist, get_points_distance  # noqa: E402
+
+RADIUS = 3.0
+SAMPLES = 2000
+
+
+def wall_tuple(segment):
+    px = segment.point2.x - segment.point1.x
+    py = segment.point2.y - segment.point1.y
+    return segment.point1.x, segment.point1.y, px, py, px * px + py * py
+
+
+def distance_to(segment, point):
+    if segment.point1 == segment.point2:
+        return get_points_distance(segment.point1, point)
+    return dist(segment, point)
+
+
+def check_line(start, end, segments):
+    intervals = band_intervals(start, end, [wall_tuple(segment) for segment in segments], RADIUS)
+    for low, high in intervals:
+        assert 0 <= low < high <= 1
+    for (_, high), (low, _) in zip(intervals, intervals[1:]):
+        assert high < low
+    for i in range(SAMPLES + 1):
+        t = i / SAMPLES
+        point = Point2D(start.x + t * (end.x - start.x), start.y + t * (end.y - start.y))
+        distance = min(distance_to(segment, point) for segment in segments)
+        # points on the border of the band may fall on either side
+        if abs(distance - RADIUS) < 1e-6:
+            continue
+        assert (distance < RADIUS) == any(low <= t <= high for low, high in intervals), (start, end, t, distance)
+
+
+def test_band_intervals_match_sampling():
+    generator = random.Random(7)
+    for _ in range(50):
+        points = [Point2D(generator.uniform(0, 50), generator.uniform(0, 50)) for _ in range(6)]
+        segments = [Segment(a, b) for a, b in zip(points, points[1:])]
+        # a wall of a single point
+        segments.append(Segment(points[0], points[0]))
+        start = Point2D(generator.uniform(-5, 55), generator.uniform(-5, 55))
+        end = Point2D(generator.uniform(-5, 55), generator.uniform(-5, 55))
+        check_line(start, end, segments)
+
+
+def test_line_along_a_wall():
+    wall = Segment(Point2D(0, 0), Point2D(10, 0))
+    check_line(Point2D(-5, 1), Point2D(15, 1), [wall])
+    # the line enters and leaves the circles around the ends of the wall 8 ** 0.5 before and after them
+    (low, high), = band_intervals(Point2D(-5, 1), Point2D(15, 1), [wall_tuple(wall)], RADIUS)
+    assert low == pytest.approx((5 - 8 ** 0.5) / 20)
+    assert high == pytest.approx((15 + 8 ** 0.5) / 20)
@@ -0,0 +1,70 @@
+"""Tests of the merging of the pieces of subdivided linear infill lines."""
+import os.path
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from addGradientInfill import Engine, InfillType, process_gcode  # noqa: E402
+from gradientInfillEngine import Point2D, merge_pieces  # noqa: E402
+
+GCODE = [
+    ";FLAVOR:Marlin\n",
+    ";LAYER:0\n",
+    "G0 X0 Y0\n",
+    ";TYPE:WALL-INNER\n",
+    "G1 X40 Y0 E1.0\n",
+    "G1 X40 Y40 E1.0\n",
+    "G1 X0 Y40 E1.0\n",
+    "G1 X0 Y0 E1.0\n",
+    ";TYPE:FILL\n",
+    "G0 X1 Y2\n",
+    "G1 F1800 X39 Y2 E1.2\n",
+    "G1 X39 Y10 E0.25\n",
+    "G1 X1 Y30 E1.4\n",
+    "G1 X20 Y38 E0.6\n",
+    ";MESH:NONMESH\n",
+    "G0 X5 Y5\n",
+    ";End of Gcode\n",
+]
+
+
+def process(tmp_path, name, **options):
+    inputPath = tmp_path / "input.gcode"
+    inputPath.write_text("".join(GCODE))
+    outputPath = tmp_path / name
+    process_gcode(
+        str(inputPath), str(outputPath), InfillType.LINEAR, 350.0, 50.0, 6.0, 4.0, Engine.PYTHON, **options
+    )
+    return outputPath.read_text()
+
+
+def infill_extrusion(gcode):
+    infill = gcode.split(";TYPE:FILL\n")[1].split(";MESH:NONMESH\n")[0]
+    return sum(float(e) for e in re.findall(r"^G1 [^;\n]* E([-0-9.]+)", infill, re.MULTILINE))
+
+
+def test_merge_pieces_keeps_extrusion():
+    ends = [Point2D(i, 0.0) for i in range(1, 9)]
+    extrusions = [0.1, 0.1, 0.2, 0.1, 0.1, 0.3, 0.1, 0.1]
+    multipliers = [3.5, 3.4, 3.38, 2.0, 1.98, 1.97, 0.5, 3.0]
+    mergedEnds, mergedExtrusions, mergedMultipliers = merge_pieces(ends, extrusions, multipliers, 0.05)
+    assert len(mergedEnds) < len(ends)
+    assert mergedEnds[-1] == ends[-1]
+    assert sum(mergedExtrusions) == pytest.approx(sum(extrusions))
+    scaled = sum(e * m for e, m in zip(mergedExtrusions, mergedMultipliers))
+    assert scaled == pytest.approx(sum(e * m for e, m in zip(extrusions, multipliers)))
+
+
+def test_zero_tolerance_keeps_output(tmp_path):
+    assert process(tmp_path, "merged.gcode", merge_tolerance=0.0) == process(tmp_path, "default.gcode")
+
+
+def test_merged_output_keeps_extrusion(tmp_path):
+    split = process(tmp_path, "split.gcode")
+    merged = process(tmp_path, "merged.gcode", merge_tolerance=5.0)
+    assert merged.count("\n") < split.count("\n")
+    # every line rounds its E to 5 decimals
+    assert abs(infill_extrusion(merged) - infill_extrusion(split)) < 1e-5 * split.count("\n")
@@ -0,0 +1,47 @@
+"""Regression tests of ``parse_gcode_line`` and of the processing of firmware macro lines."""
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from addGradientInfill import Engine, InfillType, process_gcode  # noqa: E402
+from gradientInfillEngine import Marker, parse_gcode_line  # noqa: E402
+
+KLIPPER_GCODE = [
+    "PRINT_START EXTRUDER=210 BED=60\n",
+    "SET_PRESSURE_ADVANCE EXTRUDER=extruder ADVANCE=0.05\n",
+    "M117 Eta 5min\n",
+    ";LAYER:0\n",
+    "G0 X0 Y0\n",
+    ";TYPE:WALL-INNER\n",
+    "G1 X20 Y0 E0.1\n",
+    "G1 X20 Y20 E0.1\n",
+    "G1 X0 Y20 E0.1\n",
+    "G1 X0 Y0 E0.1\n",
+    ";TYPE:FILL\n",
+    "G1 F1800 X1 Y1 E0.05\n",
+    "G1 X10 Y3 E0.05\n",
+    ";MESH:NONMESH\n",
+    "PRINT_END\n",
+]
+
+
+def test_macro_parameters_are_not_parsed():
+    move = parse_gcode_line("PRINT_START EXTRUDER=210 BED=60\n")
+    assert move == ("PRINT_START", None, None, None, None, Marker.NONE)
+    assert parse_gcode_line("M117 Eta 5min ; message\n") == ("M117", None, None, None, None, Marker.COMMENT)
+
+
+def test_move_parameters_are_parsed():
+    assert parse_gcode_line("G1 X1.5 Y-2 E0.03 F1800\n") == ("G1", 1.5, -2.0, 0.03, 1800.0, Marker.NONE)
+    assert parse_gcode_line("G0 X3 Y4\n") == ("G0", 3.0, 4.0, None, None, Marker.NONE)
+
+
+def test_process_gcode_keeps_macro_lines(tmp_path):
+    inputPath = tmp_path / "klipper.gcode"
+    outputPath = tmp_path / "klipper_out.gcode"
+    inputPath.write_text("".join(KLIPPER_GCODE))
+    process_gcode(str(inputPath), str(outputPath), InfillType.SMALL_SEGMENTS, 350.0, 50.0, 6.0, 4.0, Engine.PYTHON)
+    output = outputPath.read_text().splitlines(keepends=True)
+    assert output[:3] == KLIPPER_GCODE[:3]
+    assert output[-1] == KLIPPER_GCODE[-1]
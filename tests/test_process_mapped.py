@@ -0,0 +1,50 @@
+"""Tests of the memory-mapped path of ``process_gcode`` against the streaming path."""
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from addGradientInfill import Engine, InfillType, process_gcode  # noqa: E402
+
+GCODE = [
+    ";FLAVOR:Marlin\n",
+    ";LAYER:0\n",
+    "G0 X0 Y0\n",
+    ";TYPE:WALL-INNER\n",
+    "G1 X20 Y0 E0.1\n",
+    "G1 X20 Y20 E0.1\n",
+    "G1 X0 Y20 E0.1\n",
+    "G1 X0 Y0 E0.1\n",
+    ";TYPE:FILL\n",
+    "G1 F1800 X1 Y1 E0.05\n",
+    "G1 X10 Y3 E0.05\n",
+    "G1 X15 Y18 E0.05\n",
+    ";MESH:NONMESH\n",
+    "G0 X5 Y5\n",
+    ";End of Gcode\n",
+]
+
+
+def process_both(tmp_path, newline):
+    inputPath = tmp_path / "input.gcode"
+    inputPath.write_bytes("".join(GCODE).replace("\n", newline).encode())
+    outputs = []
+    for use_mmap in (False, True):
+        outputPath = tmp_path / "output_{}.gcode".format(use_mmap)
+        process_gcode(
+            str(inputPath), str(outputPath), InfillType.SMALL_SEGMENTS, 350.0, 50.0, 6.0, 4.0, Engine.PYTHON,
+            use_mmap=use_mmap,
+        )
+        outputs.append(outputPath.read_bytes())
+    return outputs
+
+
+def test_mapped_output_matches_streaming(tmp_path):
+    streamed, mapped = process_both(tmp_path, "\n")
+    assert mapped == streamed
+
+
+def test_mapped_crlf_output_matches_streaming(tmp_path):
+    streamed, mapped = process_both(tmp_path, "\r\n")
+    assert mapped == streamed
+    assert b"\r" not in mapped